@@ -1,8 +1,8 @@
 import os
 from argparse import ArgumentParser
 
-from flask import Flask, jsonify, request
-from werkzeug.exceptions import Unauthorized
+from flask import Flask, jsonify, request, Response
+from werkzeug.exceptions import Unauthorized, Forbidden
 import zmq
 
 from cc_agency.commons.helper import create_flask_response
@@ -10,10 +10,15 @@ from cc_core.version import VERSION as CORE_VERSION
 from cc_agency.version import VERSION as AGENCY_VERSION
 from cc_agency.commons.conf import Conf
 from cc_agency.commons.db import Mongo
+from cc_agency.commons.metrics import REGISTRY, CONTENT_TYPE
+from cc_agency.commons.serialization import create_serializer, set_serializer
 from cc_agency.commons.secrets import TrusteeClient
 from cc_agency.broker.auth import Auth
+from cc_agency.broker.profiling import RequestProfiler
+from cc_agency.broker.events import BatchEventHub
 from cc_agency.broker.routes.red import red_routes
 from cc_agency.broker.routes.nodes import nodes_routes
+from cc_agency.broker.routes.events import events_routes
 
 
 DESCRIPTION = 'CC-Agency Broker.'
@@ -29,9 +34,20 @@ parser.add_argument(
 args = parser.parse_args()
 
 conf = Conf(args.conf_file)
-mongo = Mongo(conf)
+
+set_serializer(create_serializer(conf.d['broker'].get('serialization', {}).get('backend', 'auto')))
+
+profiling_conf = conf.d['broker'].get('profiling')
+if profiling_conf is None:
+    mongo = Mongo(conf)
+else:
+    profiler = RequestProfiler(profiling_conf)
+    profiler.init_app(app)
+    mongo = Mongo(conf, event_listeners=[profiler.command_listener])
+
 auth = Auth(conf, mongo)
 trustee_client = TrusteeClient(conf)
+event_hub = BatchEventHub(mongo, conf.d['broker'].get('events', {}))
 
 bind_socket_path = os.path.expanduser(conf.d['controller']['bind_socket_path'])
 bind_socket = 'ipc://{}'.format(bind_socket_path)
@@ -58,7 +74,18 @@ def get_version():
     )
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    user = auth.verify_user(request.authorization, request.cookies, request.remote_addr)
+
+    if not user.is_admin:
+        raise Forbidden('Only admins can access metrics.')
+
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+
 red_routes(app, mongo, auth, controller, trustee_client)
 nodes_routes(app, mongo, auth)
+events_routes(app, mongo, auth, event_hub)
 
 controller.send_json({'destination': 'scheduler'})
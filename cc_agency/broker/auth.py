@@ -7,6 +7,7 @@ from werkzeug.exceptions import Unauthorized
 
 from cc_agency.commons.helper import generate_secret, create_kdf, decode_authentication_cookie, \
     encode_authentication_cookie
+from cc_agency.commons.profiling import profile_phase
 
 AUTHORIZATION_COOKIE_KEY = 'authorization_cookie'
 DEFAULT_REALM = 'Please fill in username and password'
@@ -79,6 +80,10 @@ class Auth:
 
         :raise Unauthorized: Raises an Unauthorized exception, if authorization failed.
         """
+        with profile_phase('auth'):
+            return self._verify_user(auth, cookies, ip)
+
+    def _verify_user(self, auth, cookies, ip):
         # check authorization information
         auth_password = None
         cookie_token = None
@@ -0,0 +1,279 @@
+"""
+Batch state events of experiments.
+
+Events are the entries of the state histories of batches. Every event is identified by the time of the history entry
+and the id of its batch, which is used as resume cursor by clients, e.g. as "Last-Event-ID" of server-sent events.
+Events are always read from the batches collection, so reconnecting clients do not miss events. The BatchEventHub only
+decides, when the batches of an experiment are read again. Without change streams, the batches are read every
+poll_interval seconds. With change streams, a single watcher thread per broker process wakes the clients of an
+experiment, as soon as one of its batches changed.
+
+The time of a history entry is not the time it was committed: writers take the timestamp before their update and
+several threads and processes write concurrently. An event with an earlier time can therefore become visible after an
+event with a later time was already delivered. To not skip such events, events of running experiments are only read,
+if they are older than EVENT_SAFETY_LAG seconds. Events of finished experiments are read without lag, because all of
+their history entries are committed.
+
+Every open event stream occupies a worker thread of the WSGI server for up to max_duration seconds. The broker therefore
+has to run with more threads per process than max_streams (or with an asynchronous worker like gevent), and the number
+of concurrent streams per process is capped by max_streams, so other requests are still served.
+"""
+import os
+import sys
+from threading import Thread, Lock, Event
+from time import sleep
+from typing import Dict, Set
+
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError
+
+DEFAULT_POLL_INTERVAL = 5
+DEFAULT_MAX_DURATION = 300
+DEFAULT_MAX_STREAMS = 4
+HEARTBEAT_INTERVAL = 15
+WATCH_RETRY_INTERVAL = 10
+EVENTS_CHUNK_SIZE = 1000
+EVENT_SAFETY_LAG = 10
+
+FINISHED_STATES = ['succeeded', 'failed', 'cancelled']
+
+# matches inserted batches and state transitions and only keeps the experiment id of the changed batch
+_BATCH_CHANGES_PIPELINE = [
+    {'$match': {'$or': [
+        {'operationType': 'insert'},
+        {'operationType': 'update', 'updateDescription.updatedFields.state': {'$exists': True}}
+    ]}},
+    {'$project': {'fullDocument.experimentId': 1}}
+]
+
+
+class EventCursor:
+    """
+    Position in the ordered events of an experiment. Events are ordered by time and batch id.
+    """
+
+    def __init__(self, time=None, batch_id=None):
+        """
+        :param time: The time of the last delivered event or None, to start at the first event
+        :type time: float or None
+        :param batch_id: The batch id of the last delivered event
+        :type batch_id: str or None
+        """
+        self.time = time
+        self.batch_id = batch_id
+
+    @staticmethod
+    def parse(event_id):
+        """
+        Parses an event id as created by EventCursor.event_id().
+
+        :param event_id: The event id to parse or None
+        :type event_id: str or None
+        :return: The cursor pointing behind the given event or a cursor pointing at the first event, if event_id is None
+        :rtype: EventCursor
+        :raise ValueError: If the event id is invalid
+        """
+        if not event_id:
+            return EventCursor()
+
+        time, _, batch_id = event_id.partition(':')
+        if not ObjectId.is_valid(batch_id):
+            raise ValueError('Invalid event id "{}".'.format(event_id))
+
+        return EventCursor(float(time), batch_id)
+
+    @staticmethod
+    def event_id(event):
+        return '{!r}:{}'.format(event['time'], event['batchId'])
+
+    def match(self):
+        """
+        :return: An aggregation match stage, that selects the events after this cursor
+        :rtype: dict
+        """
+        if self.time is None:
+            return {'$match': {}}
+
+        return {'$match': {'$or': [
+            {'time': {'$gt': self.time}},
+            {'time': self.time, '_id': {'$gt': ObjectId(self.batch_id)}}
+        ]}}
+
+    def advance(self, event):
+        self.time = event['time']
+        self.batch_id = event['batchId']
+
+
+def read_events(mongo, experiment_id, cursor, until=None):
+    """
+    Reads the events of the given experiment after the given cursor in chunks of at most EVENTS_CHUNK_SIZE events and
+    advances the cursor with every yielded chunk.
+
+    :param mongo: The mongo client
+    :type mongo: cc_agency.commons.db.Mongo
+    :param experiment_id: The id of the experiment
+    :type experiment_id: str
+    :param cursor: The cursor, which is advanced to the last event of every yielded chunk
+    :type cursor: EventCursor
+    :param until: Only events with a time before until are read. If None, all events are read.
+    :type until: float or None
+    :return: A generator of non empty lists of events ordered by time and batch id
+    :rtype: Generator[List[dict]]
+    """
+    while True:
+        time_conditions = []
+        if cursor.time is not None:
+            time_conditions.append({'$gte': ['$$entry.time', cursor.time]})
+        if until is not None:
+            time_conditions.append({'$lt': ['$$entry.time', until]})
+
+        batch_match = {'experimentId': experiment_id}
+        if cursor.time is not None:
+            batch_match['history.time'] = {'$gte': cursor.time}
+
+        pipeline = [
+            {'$match': batch_match},
+            # only unwinds the history entries, that can follow the cursor
+            {'$project': {'history': {'$filter': {
+                'input': '$history',
+                'as': 'entry',
+                'cond': {'$and': time_conditions}
+            }}}},
+            {'$unwind': '$history'},
+            {'$project': {
+                'state': '$history.state',
+                'time': '$history.time',
+                'node': '$history.node'
+            }},
+            cursor.match(),
+            {'$sort': {'time': 1, '_id': 1}},
+            {'$limit': EVENTS_CHUNK_SIZE}
+        ]
+
+        chunk = list(mongo.db['batches'].aggregate(pipeline, allowDiskUse=True))
+
+        events = [
+            {
+                'batchId': str(entry['_id']),
+                'state': entry['state'],
+                'time': entry['time'],
+                'node': entry['node']
+            }
+            for entry in chunk
+        ]
+
+        if events:
+            cursor.advance(events[-1])
+            yield events
+
+        if len(chunk) < EVENTS_CHUNK_SIZE:
+            return
+
+
+def experiment_finished(mongo, experiment_id):
+    """
+    :return: True, if all batches of the given experiment are in a finished state
+    :rtype: bool
+    """
+    unfinished = mongo.db['batches'].find_one(
+        {'experimentId': experiment_id, 'state': {'$nin': FINISHED_STATES}},
+        {'_id': 1}
+    )
+    return unfinished is None
+
+
+class BatchEventHub:
+    """
+    Wakes clients waiting for events of an experiment. The change stream watcher is started lazily in every process, that
+    subscribes, because WSGI servers might fork the broker after the app was created.
+    """
+
+    def __init__(self, mongo, events_conf):
+        """
+        :param mongo: The mongo client
+        :type mongo: cc_agency.commons.db.Mongo
+        :param events_conf: The broker.events section of the agency config
+        :type events_conf: dict
+        """
+        self._mongo = mongo
+        self.poll_interval = events_conf.get('poll_interval', DEFAULT_POLL_INTERVAL)
+        self.max_duration = events_conf.get('max_duration', DEFAULT_MAX_DURATION)
+        self.max_streams = events_conf.get('max_streams', DEFAULT_MAX_STREAMS)
+        self._use_change_streams = events_conf.get('change_streams', False)
+
+        self._subscriptions = {}  # type: Dict[str, Set[Event]]
+        self._num_streams = 0
+        self._lock = Lock()
+        self._watcher_pid = None
+
+    def acquire_stream(self):
+        """
+        Reserves one of the max_streams event streams of this process.
+
+        :return: True, if a stream was reserved, False if max_streams streams are already open
+        :rtype: bool
+        """
+        with self._lock:
+            if self._num_streams >= self.max_streams:
+                return False
+            self._num_streams += 1
+            return True
+
+    def release_stream(self):
+        with self._lock:
+            self._num_streams -= 1
+
+    def subscribe(self, experiment_id):
+        """
+        :param experiment_id: The experiment to subscribe to
+        :type experiment_id: str
+        :return: An event, that is set, whenever a batch of the given experiment changed
+        :rtype: Event
+        """
+        subscription = Event()
+
+        with self._lock:
+            self._subscriptions.setdefault(experiment_id, set()).add(subscription)
+            self._start_watcher()
+
+        return subscription
+
+    def unsubscribe(self, experiment_id, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(experiment_id)
+            if subscriptions is None:
+                return
+
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[experiment_id]
+
+    def _start_watcher(self):
+        if not self._use_change_streams or self._watcher_pid == os.getpid():
+            return
+
+        self._watcher_pid = os.getpid()
+        Thread(target=self._watch_loop, daemon=True).start()
+
+    def _notify(self, experiment_id):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(experiment_id, []))
+
+        for subscription in subscriptions:
+            subscription.set()
+
+    def _watch_loop(self):
+        while True:
+            try:
+                with self._mongo.db['batches'].watch(_BATCH_CHANGES_PIPELINE, full_document='updateLookup') as stream:
+                    for change in stream:
+                        experiment_id = (change.get('fullDocument') or {}).get('experimentId')
+                        if experiment_id is not None:
+                            self._notify(experiment_id)
+            except PyMongoError as e:
+                debug_info = 'Batch events change stream failed, retry in {} seconds:{}{}'.format(
+                    WATCH_RETRY_INTERVAL, os.linesep, repr(e)
+                )
+                print(debug_info, file=sys.stderr)
+
+            sleep(WATCH_RETRY_INTERVAL)
@@ -0,0 +1,172 @@
+"""
+Opt-in request profiling of the broker.
+
+Every request is split into the following phases:
+- auth: The verification of the user, including its database commands and key derivations
+- db: All MongoDB commands issued while handling the request, measured by a pymongo CommandListener
+- serialization: The conversion of the response data to json
+
+The durations of the phases and of the whole request are recorded per route in histograms of the process wide metrics
+registry. Requests slower than the configured threshold are written to the slow log as one json object per line,
+containing the phases and the MongoDB commands, that ran.
+"""
+import json
+import sys
+from threading import Lock
+from time import time, perf_counter
+
+from flask import request
+from pymongo import monitoring
+
+from cc_agency.commons.metrics import REGISTRY
+from cc_agency.commons.profiling import RequestProfile, current_profile, set_current_profile
+
+DEFAULT_SLOW_REQUEST_THRESHOLD = 1.0
+
+# only the arguments of read commands are logged, because write commands contain document contents
+_LOGGED_COMMAND_ARGUMENTS = {
+    'find': 'filter',
+    'aggregate': 'pipeline',
+    'count': 'query',
+    'distinct': 'query'
+}
+_MAX_LOGGED_ARGUMENT_LENGTH = 2000
+
+_REQUEST_SECONDS = REGISTRY.histogram(
+    'ccagency_broker_request_seconds',
+    'Duration of broker requests.',
+    ['route', 'method', 'status']
+)
+_REQUEST_PHASE_SECONDS = REGISTRY.histogram(
+    'ccagency_broker_request_phase_seconds',
+    'Duration of the auth, db and serialization phases of broker requests.',
+    ['route', 'method', 'phase']
+)
+
+def _command_argument(event):
+    argument_name = _LOGGED_COMMAND_ARGUMENTS.get(event.command_name)
+    if argument_name is None or argument_name not in event.command:
+        return None
+
+    try:
+        dumped = json.dumps(event.command[argument_name], default=str)
+    except (TypeError, ValueError):
+        return None
+
+    if len(dumped) > _MAX_LOGGED_ARGUMENT_LENGTH:
+        dumped = dumped[:_MAX_LOGGED_ARGUMENT_LENGTH] + '...'
+    return dumped
+
+
+class ProfilingCommandListener(monitoring.CommandListener):
+    """
+    Attributes the MongoDB commands to the request handled by the thread, that issued them.
+    """
+
+    def started(self, event):
+        profile = current_profile()
+        if profile is None:
+            return
+
+        collection = event.command.get(event.command_name)
+        profile.pending_commands[event.request_id] = {
+            'command': event.command_name,
+            'collection': collection if isinstance(collection, str) else None,
+            'argument': _command_argument(event)
+        }
+
+    def _finished(self, event, failed):
+        profile = current_profile()
+        if profile is None:
+            return
+
+        command = profile.pending_commands.pop(event.request_id, None)
+        if command is None:
+            return
+
+        duration = event.duration_micros / 1000000
+        profile.phases['db'] += duration
+
+        command['duration'] = duration
+        if failed:
+            command['failed'] = True
+        profile.commands.append(command)
+
+    def succeeded(self, event):
+        self._finished(event, False)
+
+    def failed(self, event):
+        self._finished(event, True)
+
+
+class RequestProfiler:
+    """
+    Flask middleware, that profiles every request of the given app.
+    """
+
+    def __init__(self, profiling_conf):
+        """
+        :param profiling_conf: The broker.profiling section of the agency config
+        :type profiling_conf: dict
+        """
+        self._slow_request_threshold = profiling_conf.get('slow_request_threshold', DEFAULT_SLOW_REQUEST_THRESHOLD)
+        self._slow_log_path = profiling_conf.get('slow_log_path')
+        self._slow_log_lock = Lock()
+
+        self.command_listener = ProfilingCommandListener()
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    @staticmethod
+    def _before_request():
+        set_current_profile(RequestProfile())
+
+    @staticmethod
+    def _after_request(response):
+        profile = current_profile()
+        if profile is not None:
+            profile.status = response.status_code
+        return response
+
+    def _teardown_request(self, _exception):
+        profile = current_profile()
+        set_current_profile(None)
+
+        if profile is None:
+            return
+
+        duration = perf_counter() - profile.start
+
+        route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        method = request.method
+        status = profile.status
+
+        _REQUEST_SECONDS.observe(duration, route=route, method=method, status=status or 'unknown')
+        for phase, phase_duration in profile.phases.items():
+            _REQUEST_PHASE_SECONDS.observe(phase_duration, route=route, method=method, phase=phase)
+
+        if duration >= self._slow_request_threshold:
+            self._write_slow_log({
+                'time': time(),
+                'method': method,
+                'route': route,
+                'path': request.path,
+                'status': status,
+                'duration': duration,
+                'phases': profile.phases,
+                'commands': profile.commands
+            })
+
+    def _write_slow_log(self, entry):
+        line = json.dumps(entry, default=str)
+
+        with self._slow_log_lock:
+            if self._slow_log_path is None:
+                print('Slow request: {}'.format(line), file=sys.stderr)
+                return
+
+            with open(self._slow_log_path, 'a') as f:
+                print(line, file=f)
@@ -0,0 +1,113 @@
+from time import time
+
+import flask
+from flask import request
+from werkzeug.exceptions import BadRequest, NotFound, ServiceUnavailable
+from bson.objectid import ObjectId
+
+from cc_agency.commons.helper import set_authentication_cookie
+from cc_agency.commons.serialization import dumps
+from cc_agency.broker.events import EventCursor, read_events, experiment_finished, HEARTBEAT_INTERVAL, \
+    EVENT_SAFETY_LAG
+
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+
+
+def _format_event(event):
+    return b'id: ' + EventCursor.event_id(event).encode('utf-8') + b'\nevent: state\ndata: ' + dumps(event) + b'\n\n'
+
+
+def _stream_events(mongo, event_hub, experiment_id, cursor):
+    """
+    Yields the state events of the given experiment as server-sent events, until all batches of the experiment are
+    finished, which is signaled by an "end" event, or until the max duration of the event hub is reached. Clients
+    reconnect with the id of the last received event as Last-Event-ID.
+    """
+    subscription = event_hub.subscribe(experiment_id)
+    try:
+        # the reconnection delay of EventSource clients in milliseconds
+        yield 'retry: {}\n\n'.format(int(event_hub.poll_interval * 1000)).encode('utf-8')
+
+        deadline = time() + event_hub.max_duration
+        last_write = time()
+
+        while True:
+            subscription.clear()
+
+            # finished batches do not change anymore, so all of their events are read below without safety lag
+            finished = experiment_finished(mongo, experiment_id)
+            until = None if finished else time() - EVENT_SAFETY_LAG
+
+            for events in read_events(mongo, experiment_id, cursor, until):
+                yield b''.join(_format_event(event) for event in events)
+                last_write = time()
+
+            if finished:
+                yield b'event: end\ndata: {}\n\n'
+                return
+
+            now = time()
+            if now >= deadline:
+                return
+
+            if now - last_write >= HEARTBEAT_INTERVAL:
+                yield b': heartbeat\n\n'
+                last_write = now
+
+            subscription.wait(min(event_hub.poll_interval, HEARTBEAT_INTERVAL, deadline - now))
+    finally:
+        event_hub.unsubscribe(experiment_id, subscription)
+
+
+def events_routes(app, mongo, auth, event_hub):
+    """
+    Creates the event broker endpoints.
+
+    :param app: The flask app to attach to
+    :param mongo: The mongo client
+    :param auth: The authorization module to use
+    :param event_hub: The hub, that wakes event streams, when batches changed
+    :type event_hub: cc_agency.broker.events.BatchEventHub
+    """
+
+    @app.route('/experiments/<object_id>/events', methods=['GET'])
+    def get_experiments_id_events(object_id):
+        user = auth.verify_user(request.authorization, request.cookies, request.remote_addr)
+
+        try:
+            bson_id = ObjectId(object_id)
+        except Exception:
+            raise BadRequest('Not a valid BSON ObjectId.')
+
+        match = {'_id': bson_id}
+
+        if not user.is_admin:
+            match['username'] = user.username
+
+        if not mongo.db['experiments'].find_one(match, {'_id': 1}):
+            raise NotFound('Could not find Object.')
+
+        # EventSource clients send Last-Event-ID on reconnect, other clients can use the lastEventId parameter
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+
+        try:
+            cursor = EventCursor.parse(last_event_id)
+        except ValueError as e:
+            raise BadRequest(str(e))
+
+        # every stream occupies a worker thread, so the number of streams is limited to keep serving other requests
+        if not event_hub.acquire_stream():
+            raise ServiceUnavailable('Too many open event streams, retry later.')
+
+        flask_response = flask.Response(
+            _stream_events(mongo, event_hub, object_id, cursor),
+            200,
+            mimetype=EVENT_STREAM_MIMETYPE
+        )
+        flask_response.call_on_close(event_hub.release_stream)
+        flask_response.headers['Cache-Control'] = 'no-cache'
+        # disables response buffering of nginx reverse proxies
+        flask_response.headers['X-Accel-Buffering'] = 'no'
+        set_authentication_cookie(flask_response, auth, user.authentication_cookie)
+
+        return flask_response
@@ -1,7 +1,11 @@
+import hashlib
+
 from flask import request
 from bson.objectid import ObjectId
 
-from cc_agency.commons.helper import create_flask_response
+from cc_agency.commons.helper import create_flask_response, create_not_modified_response, request_etag_matches
+
+_CURRENT_BATCH_STATES = ['scheduled', 'processing']
 
 
 def _get_node_gpu_info(conf_nodes, node_name):
@@ -15,42 +19,80 @@ def _get_node_gpu_info(conf_nodes, node_name):
     return None
 
 
+def _nodes_etag(nodes, batches):
+    """
+    Derives the etag of the nodes listing from the versions of the nodes and of the batches currently running on them.
+    The resources of experiments are not part of the etag, because they do not change after registration.
+
+    :param nodes: The node documents, containing at least the version
+    :type nodes: List[dict]
+    :param batches: The batches in state scheduled or processing on the given nodes, containing at least the version
+    :type batches: List[dict]
+    :return: The etag of the nodes listing
+    :rtype: str
+    """
+    versions = sorted(
+        '{}:{}'.format(document['_id'], document.get('version', 0)) for document in nodes + batches
+    )
+    return hashlib.sha1(','.join(versions).encode('utf-8')).hexdigest()
+
+
 def nodes_routes(app, mongo, auth):
+    def find_current_batches(node_names, projection):
+        cursor = mongo.db['batches'].find(
+            {
+                'node': {'$in': node_names},
+                'state': {'$in': _CURRENT_BATCH_STATES}
+            },
+            projection
+        )
+        return list(cursor)
+
     @app.route('/nodes', methods=['GET'])
     def get_nodes():
         user = auth.verify_user(request.authorization, request.cookies, request.remote_addr)
 
+        # conditional requests only fetch the versions, so unchanged listings are neither read nor serialized
+        if request.if_none_match:
+            nodes = list(mongo.db['nodes'].find({}, {'nodeName': 1, 'version': 1}))
+            batches = find_current_batches([node['nodeName'] for node in nodes], {'version': 1})
+
+            etag = _nodes_etag(nodes, batches)
+            if request_etag_matches(etag):
+                return create_not_modified_response(etag, auth, user.authentication_cookie)
+
         cursor = mongo.db['nodes'].find()
 
         nodes = list(cursor)
         node_names = [node['nodeName'] for node in nodes]
 
-        cursor = mongo.db['batches'].find(
-            {
-                'node': {'$in': node_names},
-                'state': {'$in': ['scheduled', 'processing']}
-            },
-            {'experimentId': 1, 'node': 1}
-        )
-        batches = list(cursor)
+        batches = find_current_batches(node_names, {'experimentId': 1, 'node': 1, 'version': 1})
+        etag = _nodes_etag(nodes, batches)
         experiment_ids = list(set([ObjectId(b['experimentId']) for b in batches]))
 
         cursor = mongo.db['experiments'].find(
             {'_id': {'$in': experiment_ids}},
-            {'container.settings.ram': 1}
+            {'container.settings.ram': 1, 'container.settings.cpus': 1}
         )
         experiments = {str(e['_id']): e for e in cursor}
 
         for node in nodes:
-            batches_ram = [
+            batches_resources = [
                 {
                     'batchId': str(b['_id']),
-                    'ram': experiments[b['experimentId']]['container']['settings']['ram']
+                    'ram': experiments[b['experimentId']]['container']['settings']['ram'],
+                    'cpus': experiments[b['experimentId']]['container']['settings'].get('cpus')
                 }
                 for b in batches
                 if b['node'] == node['nodeName']
             ]
-            node['currentBatches'] = batches_ram
+            node['currentBatches'] = batches_resources
+
+            cpus_available = None
+            if node.get('cpus') is not None:
+                cpus_available = node['cpus'] - sum([b['cpus'] or 0 for b in batches_resources])
+            node['cpusAvailable'] = cpus_available
+
             del node['_id']
 
-        return create_flask_response(nodes, auth, user.authentication_cookie)
+        return create_flask_response(nodes, auth, user.authentication_cookie, etag=etag)
@@ -11,8 +11,65 @@ from cc_core.commons.templates import get_template_keys, get_secret_values, norm
 from cc_core.commons.exceptions import exception_format
 from cc_core.commons.red_to_blue import convert_red_to_blue
 
-from cc_agency.commons.helper import str_to_bool, create_flask_response
+from cc_agency.commons.helper import str_to_bool, create_flask_response, create_streaming_flask_response, \
+    create_not_modified_response, document_etag, request_etag_matches
 from cc_agency.commons.secrets import separate_secrets_batch, separate_secrets_experiment
+from cc_agency.commons.tracing import trace_span, batch_timeline, SPAN_REGISTRATION, TIMELINE_BATCH_PROJECTION
+
+# fields of batch documents, that are only used internally and are not returned by the API. The trace is returned by
+# the timeline endpoint.
+_INTERNAL_BATCH_FIELDS = {'blueBatch': 0, 'trace': 0}
+
+
+def _pop_engine_setting(data, engine_key, setting):
+    """
+    Removes a setting from the engine settings of the given red data, before they are validated by cc_core.
+
+    :param data: The red data
+    :type data: dict
+    :param engine_key: The key of the engine in the red data, e.g. "container"
+    :type engine_key: str
+    :param setting: The setting to remove
+    :type setting: str
+    :return: The value of the removed setting or None, if the engine settings do not contain the setting or are
+             invalid, which is reported by the engine validation
+    """
+    engine = data.get(engine_key)
+    if not isinstance(engine, dict):
+        return None
+
+    settings = engine.get('settings')
+    if not isinstance(settings, dict):
+        return None
+
+    return settings.pop(setting, None)
+
+
+def _render_blue_batches(experiment, batches):
+    """
+    Converts the given batches, whose secrets are already separated, into blue batches with a single call of
+    convert_red_to_blue. Every blue batch is stored as compact json string in the "blueBatch" field of its batch, so that
+    only the secrets need to be filled in, when the batch is started.
+
+    :param experiment: The experiment of the given batches
+    :type experiment: dict
+    :param batches: The batches as prepared for insertion. The batches are modified in place.
+    :type batches: List[dict]
+    :raise ValueError: If convert_red_to_blue did not return a blue batch for every batch
+    """
+    red_data = {
+        'redVersion': experiment['redVersion'],
+        'cli': experiment['cli'],
+        'batches': [{'inputs': batch['inputs'], 'outputs': batch['outputs']} for batch in batches]
+    }
+
+    blue_batches = convert_red_to_blue(red_data)
+
+    if len(blue_batches) != len(batches):
+        raise ValueError('Got {} blue batches for {} batches.'.format(len(blue_batches), len(batches)))
+
+    for batch, blue_batch in zip(batches, blue_batches):
+        batch['blueBatch'] = json.dumps(blue_batch, separators=(',', ':'))
 
 
 def _prepare_red_data(data, user):
@@ -24,7 +81,8 @@ def _prepare_red_data(data, user):
         'redVersion': data['redVersion'],
         'cli': data['cli'],
         'container': data['container'],
-        'protectedKeysVoided': False
+        'protectedKeysVoided': False,
+        'version': 1
     }
 
     if 'execution' in data:
@@ -71,6 +129,7 @@ def _prepare_red_data(data, user):
                 'dockerStats': None
             }],
             'attempts': 0,
+            'version': 1,
             'inputs': rb['inputs'],
             'outputs': rb['outputs']
         }
@@ -109,6 +168,7 @@ def red_routes(app, mongo, auth, controller, trustee_client):
 
     @app.route('/red', methods=['POST'])
     def post_red():
+        registration_start = time()
         user = auth.verify_user(request.authorization, request.cookies, request.remote_addr)
 
         if not request.json:
@@ -144,6 +204,9 @@ def red_routes(app, mongo, auth, controller, trustee_client):
         elif 'outputs' not in data:
             raise BadRequest('CC-Agency requires outputs to be defined in RED data.')
 
+        # cpus is a CC-Agency specific container setting, that is not part of the docker engine schema of cc_core
+        cpus = _pop_engine_setting(data, 'container', 'cpus')
+
         try:
             engine_validation(data, 'container', ['docker'])
         except Exception:
@@ -152,24 +215,56 @@ def red_routes(app, mongo, auth, controller, trustee_client):
         if 'ram' not in data['container']['settings']:
             raise BadRequest('CC-Agency requires \'ram\' to be defined in the container settings.')
 
+        if cpus is not None:
+            if isinstance(cpus, bool) or not isinstance(cpus, (int, float)) or cpus <= 0:
+                raise BadRequest('The \'cpus\' container setting must be a positive number.')
+            data['container']['settings']['cpus'] = cpus
+
+        # reuseContainers is a CC-Agency specific execution setting, that is not part of the ccagency engine schema of
+        # cc_core
+        reuse_containers = _pop_engine_setting(data, 'execution', 'reuseContainers')
+
         try:
             engine_validation(data, 'execution', ['ccagency'], optional=True)
+        except Exception:
+            raise BadRequest('\n'.join(exception_format(secret_values=secret_values)))
+
+        if reuse_containers is not None:
+            if not isinstance(reuse_containers, bool):
+                raise BadRequest('The \'reuseContainers\' execution setting must be a boolean.')
+            data['execution']['settings']['reuseContainers'] = reuse_containers
+
+        try:
             normalize_keys(data)
-            _ = convert_red_to_blue(data)
         except Exception:
             raise BadRequest('\n'.join(exception_format(secret_values=secret_values)))
 
         experiment, batches, secrets = _prepare_red_data(data, user)
 
-        response = trustee_client.store(secrets)
+        try:
+            _render_blue_batches(experiment, batches)
+        except Exception:
+            raise BadRequest('\n'.join(exception_format(secret_values=secret_values)))
+
+        # the experiment id is generated in advance, because it is used as namespace of the secrets
+        bson_experiment_id = ObjectId()
+        experiment_id = str(bson_experiment_id)
+        experiment['_id'] = bson_experiment_id
+        experiment['secretsNamespace'] = experiment_id
+        # decremented by the controller, whenever the protected keys of a finished batch are voided
+        experiment['remainingBatches'] = len(batches)
+
+        response = trustee_client.store(secrets, namespace=experiment_id)
         if response['state'] == 'failed':
             raise InternalServerError('Trustee service failed:\n{}'.format(response['debug_info']))
 
-        bson_experiment_id = mongo.db['experiments'].insert_one(experiment).inserted_id
-        experiment_id = str(bson_experiment_id)
+        mongo.db['experiments'].insert_one(experiment)
 
+        registration_span = trace_span(SPAN_REGISTRATION, registration_start)
         for batch in batches:
             batch['experimentId'] = experiment_id
+            batch['secretsNamespace'] = experiment_id
+            batch['trace'] = [registration_span]
 
         mongo.db['batches'].insert_many(batches)
 
@@ -212,11 +307,13 @@ def red_routes(app, mongo, auth, controller, trustee_client):
                         'ccagent': None,
                         'dockerStats': None
                     }
+                },
+                '$inc': {
+                    'version': 1
                 }
             })
 
-        o = mongo.db['batches'].find_one(match)
-        o['_id'] = str(o['_id'])
+        o = mongo.db['batches'].find_one(match, _INTERNAL_BATCH_FIELDS)
 
         controller.send_json({'destination': 'scheduler'})
 
@@ -246,6 +343,28 @@ def red_routes(app, mongo, auth, controller, trustee_client):
     def get_batches_id(object_id):
         return get_collection_id('batches', object_id)
 
+    @app.route('/batches/<object_id>/timeline', methods=['GET'])
+    def get_batches_id_timeline(object_id):
+        user = auth.verify_user(request.authorization, request.cookies, request.remote_addr)
+
+        try:
+            bson_id = ObjectId(object_id)
+        except Exception:
+            raise BadRequest('Not a valid BSON ObjectId.')
+
+        match = {'_id': bson_id}
+
+        if not user.is_admin:
+            match['username'] = user.username
+
+        batch = mongo.db['batches'].find_one(match, TIMELINE_BATCH_PROJECTION)
+        if not batch:
+            raise NotFound('Could not find Object.')
+
+        notification = mongo.db['notifications'].find_one({'batchId': object_id}, {'deliveredTime': 1})
+
+        return create_flask_response(batch_timeline(batch, notification), auth, user.authentication_cookie)
+
     def get_collection_id(collection, object_id):
         user = auth.verify_user(request.authorization, request.cookies, request.remote_addr)
 
@@ -259,12 +378,23 @@ def red_routes(app, mongo, auth, controller, trustee_client):
         if not user.is_admin:
             match['username'] = user.username
 
-        o = mongo.db[collection].find_one(match)
+        # conditional requests only fetch the version, so unchanged documents are neither read nor serialized
+        if request.if_none_match:
+            o = mongo.db[collection].find_one(match, {'version': 1})
+            if not o:
+                raise NotFound('Could not find Object.')
+
+            etag = document_etag(o)
+            if request_etag_matches(etag):
+                return create_not_modified_response(etag, auth, user.authentication_cookie)
+
+        projection = _INTERNAL_BATCH_FIELDS if collection == 'batches' else None
+
+        o = mongo.db[collection].find_one(match, projection)
         if not o:
             raise NotFound('Could not find Object.')
 
-        o['_id'] = str(o['_id'])
-        return create_flask_response(o, auth, user.authentication_cookie)
+        return create_flask_response(o, auth, user.authentication_cookie, etag=document_etag(o))
 
     def get_collection_count(collection):
         user = auth.verify_user(request.authorization, request.cookies, request.remote_addr)
@@ -364,15 +494,8 @@ def red_routes(app, mongo, auth, controller, trustee_client):
 
         aggregate.append({'$match': match})
 
-        aggregate.append({'$project': {
-            'username': 1,
-            'registrationTime': 1,
-            'state': 1,
-            'experimentId': 1,
-            'node': 1,
-            'batchesListIndex': 1
-        }})
-
+        # sorting directly after matching allows mongodb to use the registrationTime index, so that the first documents
+        # are returned without sorting the whole collection
         aggregate.append({'$sort': {'registrationTime': 1 if ascending else -1}})
 
         if skip is not None:
@@ -385,11 +508,15 @@ def red_routes(app, mongo, auth, controller, trustee_client):
                 raise BadRequest('limit cannot be lower than 1.')
             aggregate.append({'$limit': limit})
 
-        cursor = mongo.db[collection].aggregate(aggregate)
+        aggregate.append({'$project': {
+            'username': 1,
+            'registrationTime': 1,
+            'state': 1,
+            'experimentId': 1,
+            'node': 1,
+            'batchesListIndex': 1
+        }})
 
-        result = []
-        for e in cursor:
-            e['_id'] = str(e['_id'])
-            result.append(e)
+        cursor = mongo.db[collection].aggregate(aggregate, allowDiskUse=True)
 
-        return create_flask_response(result, auth, user.authentication_cookie)
+        return create_streaming_flask_response(cursor, auth, user.authentication_cookie)
@@ -18,3 +18,24 @@ class Conf:
             self.d = yaml.load(f)
 
         jsonschema.validate(self.d, conf_schema)
+        _validate_image_gc(self.d)
+
+
+def _validate_image_gc(d):
+    """
+    Checks the image gc watermarks, which can not be compared by the conf schema.
+
+    :param d: The agency config, which is valid according to the conf schema
+    :type d: dict
+    :raise jsonschema.ValidationError: If the low watermark is greater than the high watermark
+    """
+    image_gc = d['controller']['docker'].get('image_gc')
+    if image_gc is None or 'low_watermark' not in image_gc:
+        return
+
+    if image_gc['low_watermark'] > image_gc['high_watermark']:
+        raise jsonschema.ValidationError(
+            'controller.docker.image_gc.low_watermark ({}) must not be greater than high_watermark ({}).'.format(
+                image_gc['low_watermark'], image_gc['high_watermark']
+            )
+        )
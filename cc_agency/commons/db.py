@@ -2,7 +2,7 @@ import pymongo
 
 
 class Mongo:
-    def __init__(self, conf):
+    def __init__(self, conf, event_listeners=None):
         host = conf.d['mongo'].get('host', 'localhost')
         port = conf.d['mongo'].get('port', 27017)
         db = conf.d['mongo']['db']
@@ -15,6 +15,6 @@ class Mongo:
             host=host,
             port=port,
             db=db
-        ))
+        ), event_listeners=event_listeners)
 
         self.db = self.client[db]
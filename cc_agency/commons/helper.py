@@ -10,6 +10,14 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.hashes import SHA256
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+from cc_agency.commons.profiling import profile_phase
+from cc_agency.commons.serialization import dumps
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# number of documents encoded into a single chunk of a streamed response
+STREAM_CHUNK_SIZE = 256
+
 
 def decode_authentication_cookie(cookie_value):
     """
@@ -46,25 +54,141 @@ def encode_authentication_cookie(username, token):
     )
 
 
-def create_flask_response(data, auth, authentication_cookie=None):
+def document_etag(document):
     """
-    Creates a flask response object, containing the given json data and the given authentication cookie.
+    Returns the etag of the given database document, which is derived from the version counter of the document. The
+    version is incremented by every update of the document, that changes its api representation.
 
-    :param data: The data to send as json object
+    :param document: A document containing at least the version field. Documents without version have version 0.
+    :type document: dict
+    :return: The etag of the given document
+    :rtype: str
+    """
+    return 'v{}'.format(document.get('version', 0))
+
+
+def request_etag_matches(etag):
+    """
+    :param etag: The current etag of the requested resource
+    :type etag: str
+    :return: True, if the If-None-Match header of the current request contains the given etag
+    :rtype: bool
+    """
+    return request.if_none_match.contains_weak(etag)
+
+
+def set_authentication_cookie(flask_response, auth, authentication_cookie):
+    """
+    Sets the given authentication cookie on the given flask response, if an authentication cookie is given.
+
+    :param flask_response: The response to set the cookie on
     :param auth: The auth object to use
-    :param authentication_cookie: The value for the authentication cookie
-    :return: A flask response object
+    :param authentication_cookie: The value for the authentication cookie or None
     """
-    flask_response = flask.make_response(
-        flask.jsonify(data),
-        200
-    )
     if authentication_cookie:
         flask_response.set_cookie(
             authentication_cookie[0],
             authentication_cookie[1],
             expires=time() + auth.tokens_valid_for_seconds
         )
+
+
+def _set_cache_headers(flask_response, etag):
+    # the representation depends on the user and clients have to revalidate before using a cached response
+    flask_response.set_etag(etag, weak=True)
+    flask_response.cache_control.private = True
+    flask_response.cache_control.no_cache = True
+
+
+def create_not_modified_response(etag, auth, authentication_cookie=None):
+    """
+    Creates a flask response object with status 304 for the given etag and the given authentication cookie.
+
+    :param etag: The etag of the unmodified resource
+    :type etag: str
+    :param auth: The auth object to use
+    :param authentication_cookie: The value for the authentication cookie
+    :return: A flask response object
+    """
+    flask_response = flask.Response(status=304)
+    _set_cache_headers(flask_response, etag)
+    set_authentication_cookie(flask_response, auth, authentication_cookie)
+    return flask_response
+
+
+def create_flask_response(data, auth, authentication_cookie=None, etag=None):
+    """
+    Creates a flask response object, containing the given json data and the given authentication cookie. The data is
+    serialized by the configured serializer of cc_agency.commons.serialization, so ObjectIds do not have to be
+    converted to strings beforehand.
+
+    :param data: The data to send as json object
+    :param auth: The auth object to use
+    :param authentication_cookie: The value for the authentication cookie
+    :param etag: The optional etag of the given data
+    :type etag: str
+    :return: A flask response object
+    """
+    with profile_phase('serialization'):
+        body = dumps(data)
+
+    flask_response = flask.Response(body, 200, mimetype=JSON_MIMETYPE)
+    if etag is not None:
+        _set_cache_headers(flask_response, etag)
+    set_authentication_cookie(flask_response, auth, authentication_cookie)
+    return flask_response
+
+
+def _stream_json_array(documents):
+    yield b'['
+    chunk = []
+    first = True
+    for document in documents:
+        chunk.append(dumps(document))
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield (b'' if first else b',') + b','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield (b'' if first else b',') + b','.join(chunk)
+    yield b']\n'
+
+
+def _stream_ndjson(documents):
+    chunk = []
+    for document in documents:
+        chunk.append(dumps(document))
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield b'\n'.join(chunk) + b'\n'
+            chunk = []
+    if chunk:
+        yield b'\n'.join(chunk) + b'\n'
+
+
+def create_streaming_flask_response(documents, auth, authentication_cookie=None):
+    """
+    Creates a flask response object, that streams the given documents as chunked json array or, if the client accepts
+    "application/x-ndjson", as newline delimited json. The documents are encoded while the response is sent, so the
+    memory usage does not depend on the number of documents.
+
+    Errors, that occur while the documents are iterated, e.g. if the database connection breaks, abort the response,
+    because the status code was already sent.
+
+    :param documents: An iterable of json serializable documents, e.g. a mongodb cursor
+    :type documents: Iterable[dict]
+    :param auth: The auth object to use
+    :param authentication_cookie: The value for the authentication cookie
+    :return: A flask response object
+    """
+    mimetype = request.accept_mimetypes.best_match([JSON_MIMETYPE, NDJSON_MIMETYPE], default=JSON_MIMETYPE)
+
+    if mimetype == NDJSON_MIMETYPE:
+        body = _stream_ndjson(documents)
+    else:
+        body = _stream_json_array(documents)
+
+    flask_response = flask.Response(body, 200, mimetype=mimetype)
+    set_authentication_cookie(flask_response, auth, authentication_cookie)
     return flask_response
 
 
@@ -101,7 +225,8 @@ def batch_failure(
         ccagent,
         current_state,
         disable_retry_if_failed=False,
-        docker_stats=None
+        docker_stats=None,
+        trace_spans=None
 ):
     """
     Changes the db entry of the given batch to failed, if disable_retry_if_failed is set to True or if the maximal
@@ -119,6 +244,8 @@ def batch_failure(
     :param docker_stats: The optional stats of the docker container, that will written under the "docker_stats" key in
                          the history of this batch
     :type docker_stats: dict
+    :param trace_spans: Optional spans, that are pushed to the trace of this batch
+    :type trace_spans: List[list]
     """
     if current_state in ['succeeded', 'failed', 'cancelled']:
         return
@@ -151,6 +278,20 @@ def batch_failure(
             new_state = 'failed'
             new_node = node_name
 
+    push = {
+        'history': {
+            'state': new_state,
+            'time': timestamp,
+            'debugInfo': debug_info,
+            'node': new_node,
+            'ccagent': ccagent,
+            'dockerStats': docker_stats
+        }
+    }
+
+    if trace_spans:
+        push['trace'] = {'$each': trace_spans}
+
     mongo.db['batches'].update_one(
         {'_id': bson_id, 'state': current_state},
         {
@@ -158,15 +299,9 @@ def batch_failure(
                 'state': new_state,
                 'node': new_node
             },
-            '$push': {
-                'history': {
-                    'state': new_state,
-                    'time': timestamp,
-                    'debugInfo': debug_info,
-                    'node': new_node,
-                    'ccagent': ccagent,
-                    'dockerStats': docker_stats
-                }
+            '$push': push,
+            '$inc': {
+                'version': 1
             }
         }
     )
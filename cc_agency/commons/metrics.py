@@ -0,0 +1,265 @@
+"""
+Minimal metrics in the Prometheus text exposition format.
+
+Metrics are registered in a process wide registry by name. Registering a metric twice returns the existing metric, so
+modules can define their metrics at import time. Collectors are functions, that are called before rendering, to update
+gauges, that are expensive to keep up to date continuously.
+"""
+import math
+import sys
+from functools import wraps
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value))
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape_label_value(value)) for name, value in pairs) + '}'
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+
+    def _labelvalues(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('Metric "{}" requires the labels {}, but got {}.'.format(
+                self.name, list(self.labelnames), sorted(labels)
+            ))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        """
+        :return: The lines of this metric in the Prometheus text format
+        :rtype: List[str]
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation.replace('\n', ' ')),
+            '# TYPE {} {}'.format(self.name, self.metric_type)
+        ]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self):
+        raise NotImplementedError()
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}  # type: Dict[Tuple[str, ...], float]
+
+    def set(self, value, **labels):
+        labelvalues = self._labelvalues(labels)
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def _render_samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [
+            '{}{} {}'.format(self.name, _format_labels(self.labelnames, labelvalues), _format_value(value))
+            for labelvalues, value in values
+        ]
+
+
+class _HistogramTimer:
+    """
+    Observes durations in seconds. Can be used as context manager or as decorator.
+    """
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._histogram.observe(perf_counter() - self._start, **self._labels)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _HistogramTimer(self._histogram, self._labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts = {}  # type: Dict[Tuple[str, ...], List[int]]
+        self._sums = {}  # type: Dict[Tuple[str, ...], float]
+
+    def observe(self, value, **labels):
+        labelvalues = self._labelvalues(labels)
+        with self._lock:
+            counts = self._counts.get(labelvalues)
+            if counts is None:
+                counts = [0] * len(self._buckets)
+                self._counts[labelvalues] = counts
+                self._sums[labelvalues] = 0.0
+
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._sums[labelvalues] += value
+
+    def time(self, **labels):
+        """
+        Returns a timer, that observes the duration of a block, if used as context manager, or the duration of every
+        call, if used as decorator.
+        """
+        return _HistogramTimer(self, labels)
+
+    def _render_samples(self):
+        with self._lock:
+            items = sorted((labelvalues, list(counts), self._sums[labelvalues])
+                           for labelvalues, counts in self._counts.items())
+
+        lines = []
+        for labelvalues, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.labelnames, labelvalues, ('le', _format_value(bound))), cumulative
+                ))
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}  # type: Dict[str, _Metric]
+        self._collectors = []
+
+    def _register(self, metric_class, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, documentation, labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class) or metric.labelnames != tuple(labelnames):
+                raise ValueError('Metric "{}" is already registered with another type or labels.'.format(name))
+            return metric
+
+    def gauge(self, name, documentation, labelnames=()):
+        """
+        :rtype: Gauge
+        """
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :rtype: Histogram
+        """
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def add_collector(self, collector):
+        """
+        Adds a function without arguments, that is called before the metrics are rendered.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """
+        :return: All registered metrics in the Prometheus text format
+        :rtype: str
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                print('Metrics collector failed: {}'.format(repr(e)), file=sys.stderr)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host, port):
+    """
+    Serves the metrics of the process wide registry under /metrics in a background thread.
+
+    :param host: The host to bind to
+    :type host: str
+    :param port: The port to bind to
+    :type port: int
+    :return: The started server
+    :rtype: HTTPServer
+    """
+    server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    Thread(target=server.serve_forever).start()
+    return server
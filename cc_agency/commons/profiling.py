@@ -0,0 +1,64 @@
+"""
+Request profiles shared by the broker and the helpers, that build its responses.
+
+A profile is bound to the thread handling a request by the RequestProfiler of the broker. This module does not depend
+on the broker, so the helpers can measure their phases without loading the broker profiling and its metrics in the
+controller or the trustee, where no profile is ever bound.
+"""
+from contextlib import contextmanager
+from threading import local
+from time import perf_counter
+from typing import List
+
+PHASES = ['auth', 'db', 'serialization']
+
+_current = local()
+
+
+class RequestProfile:
+    """
+    Collects the phase durations and database commands of one request.
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.phases = {phase: 0.0 for phase in PHASES}
+        self.commands = []  # type: List[dict]
+        self.pending_commands = {}
+        self.status = None  # type: int or None
+
+
+def current_profile():
+    """
+    :return: The profile of the request handled by the current thread or None, if profiling is disabled
+    :rtype: RequestProfile or None
+    """
+    return getattr(_current, 'profile', None)
+
+
+def set_current_profile(profile):
+    """
+    :param profile: The profile of the request handled by the current thread or None, to unbind the profile
+    :type profile: RequestProfile or None
+    """
+    _current.profile = profile
+
+
+@contextmanager
+def profile_phase(phase):
+    """
+    Adds the duration of the block to the given phase of the current request. Does nothing, if profiling is disabled.
+
+    :param phase: One of "auth", "db" or "serialization"
+    :type phase: str
+    """
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        profile.phases[phase] += perf_counter() - start
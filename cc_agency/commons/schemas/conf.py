@@ -13,6 +13,31 @@ conf_schema = {
                     },
                     'additionalProperties': False,
                     'required': ['num_login_attempts', 'block_for_seconds', 'tokens_valid_for_seconds']
+                },
+                'profiling': {
+                    'type': 'object',
+                    'properties': {
+                        'slow_request_threshold': {'type': 'number', 'minimum': 0},
+                        'slow_log_path': {'type': 'string'}
+                    },
+                    'additionalProperties': False
+                },
+                'serialization': {
+                    'type': 'object',
+                    'properties': {
+                        'backend': {'enum': ['auto', 'orjson', 'json']}
+                    },
+                    'additionalProperties': False
+                },
+                'events': {
+                    'type': 'object',
+                    'properties': {
+                        'change_streams': {'type': 'boolean'},
+                        'poll_interval': {'type': 'number', 'minimum': 0.1},
+                        'max_duration': {'type': 'number', 'minimum': 1},
+                        'max_streams': {'type': 'integer', 'minimum': 1}
+                    },
+                    'additionalProperties': False
                 }
             },
             'additionalProperties': False,
@@ -22,6 +47,23 @@ conf_schema = {
             'type': 'object',
             'properties': {
                 'bind_socket_path': {'type': 'string'},
+                'placement_strategy': {'enum': ['default', 'bin-packing', 'spread', 'gpu-topology']},
+                'metrics': {
+                    'type': 'object',
+                    'properties': {
+                        'host': {'type': 'string'},
+                        'port': {'type': 'integer', 'minimum': 1, 'maximum': 65535}
+                    },
+                    'additionalProperties': False,
+                    'required': ['port']
+                },
+                'change_streams': {
+                    'type': 'object',
+                    'properties': {
+                        'fallback_interval': {'type': 'number', 'minimum': 1}
+                    },
+                    'additionalProperties': False
+                },
                 'docker': {
                     'type': 'object',
                     'properties': {
@@ -61,6 +103,16 @@ conf_schema = {
                                                 }
                                             },
                                             'additionalProperties': False
+                                        },
+                                        'limits': {
+                                            'type': 'object',
+                                            'properties': {
+                                                'max_concurrent_starts': {'type': 'integer', 'minimum': 1},
+                                                'max_concurrent_pulls': {'type': 'integer', 'minimum': 1},
+                                                'max_running_batches': {'type': 'integer', 'minimum': 1},
+                                                'pooled_execution_timeout': {'type': 'number', 'minimum': 1}
+                                            },
+                                            'additionalProperties': False
                                         }
                                     },
                                     'required': ['base_url'],
@@ -70,16 +122,37 @@ conf_schema = {
                             'additionalProperties': False
                         },
                         'allow_insecure_capabilities': {'type': 'boolean'},
-                        'image_prune_duration': {'type': 'number'}
+                        'image_prune_duration': {'type': 'number'},
+                        'image_gc': {
+                            'type': 'object',
+                            'properties': {
+                                'high_watermark': {'type': 'number', 'minimum': 0},
+                                'low_watermark': {'type': 'number', 'minimum': 0}
+                            },
+                            'additionalProperties': False,
+                            'required': ['high_watermark']
+                        },
+                        'image_pull_policy': {'enum': ['always', 'if-not-present', 'refresh-after-ttl']},
+                        'image_pull_ttl': {'type': 'number', 'minimum': 0},
+                        'image_prefetch': {
+                            'type': 'object',
+                            'properties': {
+                                'experiments': {'type': 'integer', 'minimum': 1},
+                                'nodes': {'type': 'integer', 'minimum': 1}
+                            },
+                            'additionalProperties': False
+                        }
                     },
                     'additionalProperties': False,
                     'required': ['nodes']
                 },
+                'notification_retention': {'type': 'integer', 'minimum': 0},
                 'notification_hooks': {
                     'type': 'array',
                     'items': {
                         'type': 'object',
                         'properties': {
+                            'id': {'type': 'string'},
                             'url': {'type': 'string'},
                             'auth': {
                                 'type': 'object',
@@ -104,7 +177,16 @@ conf_schema = {
             'properties': {
                 'internal_url': {'type': 'string'},
                 'username': {'type': 'string'},
-                'password': {'type': 'string'}
+                'password': {'type': 'string'},
+                'store': {
+                    'type': 'object',
+                    'properties': {
+                        'backend': {'enum': ['memory', 'sqlite']},
+                        'path': {'type': 'string'}
+                    },
+                    'additionalProperties': False,
+                    'required': ['backend']
+                }
             },
             'additionalProperties': False,
             'required': ['internal_url', 'username', 'password']
@@ -1,48 +1,110 @@
 import os
-import json
-from copy import deepcopy
 from uuid import uuid4
 
 import requests
 
+from cc_agency.commons.metrics import REGISTRY
 
 _RECEIVE_TIMEOUT = 2000
 
+_TRUSTEE_REQUEST_SECONDS = REGISTRY.histogram(
+    'ccagency_trustee_request_seconds',
+    'Duration of requests to the trustee service.',
+    ['operation']
+)
+
+
+def _freeze(value):
+    """
+    Returns a hashable representation of the given json value, that is equal for equal json values. Scalars are tagged
+    with their type, because for example True == 1 in python, but not in json.
+
+    :param value: A json value
+    :return: A hashable representation of the given value
+    """
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value.__class__, value
+
+
+def _replace_connector_access(cwl_val, access):
+    """
+    Returns a copy of the given input or output value, whose connector access is replaced. Only the value and its
+    connector are copied, all other nested objects are shared with the given value.
+    """
+    cwl_val = dict(cwl_val)
+    cwl_val['connector'] = dict(cwl_val['connector'])
+    cwl_val['connector']['access'] = access
+    return cwl_val
+
+
+def _replace_image_auth(experiment, auth):
+    """
+    Returns a copy of the given experiment, whose image auth is replaced. Only the objects on the path to the image auth
+    are copied, all other nested objects are shared with the given experiment.
+    """
+    experiment = dict(experiment)
+    experiment['container'] = dict(experiment['container'])
+    experiment['container']['settings'] = dict(experiment['container']['settings'])
+    experiment['container']['settings']['image'] = dict(experiment['container']['settings']['image'])
+    experiment['container']['settings']['image']['auth'] = auth
+    return experiment
+
 
 def separate_secrets_batch(batch):
-    batch = deepcopy(batch)
+    """
+    Replaces the connector access information of the given batch by secret keys. Equal access information is replaced by
+    the same key. The given batch is not modified, but the returned batch shares all objects, that are not on the path
+    to a connector access, with the given batch.
+
+    :param batch: The batch containing connector access information
+    :type batch: dict
+    :return: A tuple (batch, secrets) containing the batch with secret keys and a dictionary mapping the secret keys to
+             the access information
+    :rtype: Tuple[dict, dict]
+    """
+    batch = dict(batch)
     secrets = {}
     reversed_secrets = {}  # only for deduplication
 
     for io in ['inputs', 'outputs']:
+        batch[io] = dict(batch[io])
         for cwl_key, cwl_val in batch[io].items():
             if not isinstance(cwl_val, dict):
                 continue
             secret = cwl_val['connector']['access']
-            dumped = json.dumps(secret, sort_keys=True)
-            if dumped in reversed_secrets:
-                key = reversed_secrets[dumped]
+            frozen = _freeze(secret)
+            if frozen in reversed_secrets:
+                key = reversed_secrets[frozen]
             else:
                 key = str(uuid4())
-                reversed_secrets[dumped] = key
+                reversed_secrets[frozen] = key
                 secrets[key] = secret
 
-            cwl_val['connector']['access'] = key
+            batch[io][cwl_key] = _replace_connector_access(cwl_val, key)
 
     return batch, secrets
 
 
 def separate_secrets_experiment(experiment):
-    experiment = deepcopy(experiment)
+    """
+    Replaces the image auth of the given experiment by a secret key. The given experiment is not modified, but the
+    returned experiment shares all objects, that are not on the path to the image auth, with the given experiment.
+
+    :param experiment: The experiment containing image auth information
+    :type experiment: dict
+    :return: A tuple (experiment, secrets) containing the experiment with secret keys and a dictionary mapping the
+             secret keys to the auth information
+    :rtype: Tuple[dict, dict]
+    """
     secrets = {}
-    reversed_secrets = {}  # only for deduplication
 
     if 'auth' in experiment['container']['settings']['image']:
         key = str(uuid4())
-        secret = experiment['container']['settings']['image']['auth']
-        experiment['container']['settings']['image']['auth'] = key
-        secrets[key] = secret
-        reversed_secrets[json.dumps(secret, sort_keys=True)] = key
+        secrets[key] = experiment['container']['settings']['image']['auth']
+        experiment = _replace_image_auth(experiment, key)
 
     return experiment, secrets
 
@@ -58,18 +120,53 @@ def get_batch_secret_keys(batch):
 
 
 def fill_batch_secrets(batch, secrets):
-    batch = deepcopy(batch)
+    """
+    Fills the given secrets into the connector access information of the given batch. The given batch is not modified,
+    but the returned batch shares all objects, that are not on the path to a connector access, with the given batch.
+
+    :param batch: The batch containing secret keys instead of connector access information
+    :type batch: dict
+    :param secrets: The secrets as returned by the trustee service
+    :type secrets: dict
+    :return: The batch containing the connector access information
+    :rtype: dict
+    """
+    batch = dict(batch)
     for io in ['inputs', 'outputs']:
+        batch[io] = dict(batch[io])
         for cwl_key, cwl_val in batch[io].items():
             if not isinstance(cwl_val, dict):
                 continue
 
             key = cwl_val['connector']['access']
             secret = secrets[key]
-            cwl_val['connector']['access'] = secret
+            batch[io][cwl_key] = _replace_connector_access(cwl_val, secret)
     return batch
 
 
+def fill_blue_batch_secrets(blue_batch, secrets):
+    """
+    Fills the given secrets into a blue batch, that was rendered from a batch with separated secrets. The given blue batch
+    is modified in place.
+
+    :param blue_batch: The blue batch containing secret keys instead of connector access information
+    :type blue_batch: dict
+    :param secrets: The secrets as returned by the trustee service
+    :type secrets: dict
+    :return: The given blue batch containing the connector access information
+    :rtype: dict
+    """
+    for io in ['inputs', 'outputs']:
+        for cwl_key, cwl_val in blue_batch[io].items():
+            if not isinstance(cwl_val, dict):
+                continue
+
+            key = cwl_val['connector']['access']
+            secret = secrets[key]
+            cwl_val['connector']['access'] = secret
+    return blue_batch
+
+
 def get_experiment_secret_keys(experiment):
     keys = []
     if 'auth' in experiment['container']['settings']['image']:
@@ -78,11 +175,21 @@ def get_experiment_secret_keys(experiment):
 
 
 def fill_experiment_secrets(experiment, secrets):
-    experiment = deepcopy(experiment)
+    """
+    Fills the given secrets into the image auth of the given experiment. The given experiment is not modified, but the
+    returned experiment shares all objects, that are not on the path to the image auth, with the given experiment.
+
+    :param experiment: The experiment containing a secret key instead of image auth information
+    :type experiment: dict
+    :param secrets: The secrets as returned by the trustee service
+    :type secrets: dict
+    :return: The experiment containing the image auth information
+    :rtype: dict
+    """
     if 'auth' in experiment['container']['settings']['image']:
         key = experiment['container']['settings']['image']['auth']
         secret = secrets[key]
-        experiment['container']['settings']['image']['auth'] = secret
+        experiment = _replace_image_auth(experiment, secret)
     return experiment
 
 
@@ -91,30 +198,51 @@ class TrusteeClient:
         self._url = conf.d['trustee']['internal_url'].rstrip('/')
         self._auth = (conf.d['trustee']['username'], conf.d['trustee']['password'])
 
-    def store(self, secrets):
+    @staticmethod
+    def _namespace_params(namespace):
+        if namespace is None:
+            return None
+        return {'namespace': namespace}
+
+    @_TRUSTEE_REQUEST_SECONDS.time(operation='store')
+    def store(self, secrets, namespace=None):
         r = requests.post(
             '{}/secrets'.format(self._url),
             auth=self._auth,
-            json=secrets
+            json=secrets,
+            params=self._namespace_params(namespace)
         )
         return self._evaluate_request(r)
 
-    def delete(self, keys):
+    @_TRUSTEE_REQUEST_SECONDS.time(operation='delete')
+    def delete(self, keys, namespace=None):
         r = requests.delete(
             '{}/secrets'.format(self._url),
             auth=self._auth,
-            json=keys
+            json=keys,
+            params=self._namespace_params(namespace)
+        )
+        return self._evaluate_request(r)
+
+    @_TRUSTEE_REQUEST_SECONDS.time(operation='delete_namespace')
+    def delete_namespace(self, namespace):
+        r = requests.delete(
+            '{}/namespaces/{}'.format(self._url, namespace),
+            auth=self._auth
         )
         return self._evaluate_request(r)
 
-    def collect(self, keys):
+    @_TRUSTEE_REQUEST_SECONDS.time(operation='collect')
+    def collect(self, keys, namespace=None):
         r = requests.get(
             '{}/secrets'.format(self._url),
             auth=self._auth,
-            json=keys
+            json=keys,
+            params=self._namespace_params(namespace)
         )
         return self._evaluate_request(r)
 
+    @_TRUSTEE_REQUEST_SECONDS.time(operation='inspect')
     def inspect(self):
         r = requests.get(
             '{}/'.format(self._url),
@@ -0,0 +1,111 @@
+"""
+JSON serialization of broker responses.
+
+Two backends are available:
+- orjson: Used if the optional orjson package is installed. It is considerably faster than the standard library,
+  especially for large documents with long histories.
+- json: The json module of the standard library with compact separators, which keeps it on the fast path of its c
+  extension.
+
+Both backends encode ObjectIds as strings and bytes as base64 strings, so documents from mongodb can be serialized
+without converting their ids first.
+"""
+import base64
+import json
+
+from bson.objectid import ObjectId
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SERIALIZATION_BACKENDS = ['auto', 'orjson', 'json']
+
+
+def _encode_default(o):
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, (bytes, bytearray)):
+        return base64.b64encode(o).decode('ascii')
+    raise TypeError('Object of type "{}" is not JSON serializable'.format(type(o).__name__))
+
+
+class Serializer:
+    name = None
+
+    def dumps(self, data):
+        """
+        :param data: The data to serialize
+        :return: The given data as utf-8 encoded json
+        :rtype: bytes
+        """
+        raise NotImplementedError()
+
+
+class OrjsonSerializer(Serializer):
+    name = 'orjson'
+
+    def dumps(self, data):
+        return orjson.dumps(data, default=_encode_default)
+
+
+class StdlibSerializer(Serializer):
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(',', ':'), default=_encode_default)
+
+    def dumps(self, data):
+        return self._encoder.encode(data).encode('utf-8')
+
+
+def create_serializer(backend='auto'):
+    """
+    Creates a serializer for the given backend.
+
+    :param backend: One of SERIALIZATION_BACKENDS. "auto" selects orjson, if it is installed, otherwise json.
+    :type backend: str
+    :return: A new serializer
+    :rtype: Serializer
+    :raise ValueError: If the orjson backend is requested, but orjson is not installed
+    """
+    if backend == 'orjson' or (backend == 'auto' and orjson is not None):
+        if orjson is None:
+            raise ValueError('The orjson serialization backend is configured, but orjson is not installed.')
+        return OrjsonSerializer()
+
+    return StdlibSerializer()
+
+
+_serializer = create_serializer()
+
+
+def set_serializer(serializer):
+    """
+    Replaces the serializer used by dumps().
+
+    :param serializer: The serializer to use
+    :type serializer: Serializer
+    """
+    global _serializer
+    _serializer = serializer
+
+
+def get_serializer():
+    """
+    :return: The serializer used by dumps()
+    :rtype: Serializer
+    """
+    return _serializer
+
+
+def dumps(data):
+    """
+    Serializes the given data with the configured serializer.
+
+    :param data: The data to serialize
+    :return: The given data as utf-8 encoded json
+    :rtype: bytes
+    """
+    return _serializer.dumps(data)
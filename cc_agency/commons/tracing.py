@@ -0,0 +1,103 @@
+"""
+Lifecycle tracing of batches.
+
+The broker and the controller measure spans of the work, that is done for a batch, and push them to the "trace" array
+of the batch document. Wherever possible, spans are pushed with the update of the state transition, that ends them, so
+tracing does not need additional database round trips. To keep batch documents small, a span is stored as list
+[name, start, duration] with start as unix timestamp and duration in seconds.
+
+The waiting times between the measured spans are derived from the state history of the batch, the delivery of the
+notification from the notifications collection. batch_timeline() combines all three into one timeline.
+"""
+from time import time
+
+SPAN_REGISTRATION = 'registration'
+SPAN_SCHEDULING = 'scheduling'
+SPAN_PULL = 'pull'
+SPAN_CONTAINER_START = 'containerStart'
+SPAN_EXECUTION = 'execution'
+SPAN_HARVEST = 'harvest'
+SPAN_NOTIFICATION = 'notification'
+
+# the fields of batch documents needed to build timelines, history entries can be large because of ccagent data
+TIMELINE_BATCH_PROJECTION = {
+    'experimentId': 1,
+    'state': 1,
+    'registrationTime': 1,
+    'history.state': 1,
+    'history.time': 1,
+    'history.node': 1,
+    'trace': 1
+}
+
+
+def trace_span(name, start, end=None):
+    """
+    Creates a span in the compact format of the trace array.
+
+    :param name: The name of the span, e.g. SPAN_PULL
+    :type name: str
+    :param start: The unix timestamp at which the span started
+    :type start: float
+    :param end: The unix timestamp at which the span ended. Defaults to now.
+    :type end: float or None
+    :return: The span as list [name, start, duration]
+    :rtype: list
+    """
+    if end is None:
+        end = time()
+    return [name, start, max(end - start, 0.0)]
+
+
+def _span_dict(name, start, end, **kwargs):
+    span = {
+        'name': name,
+        'start': start,
+        'end': end,
+        'duration': end - start if end is not None else None
+    }
+    span.update(kwargs)
+    return span
+
+
+def batch_timeline(batch, notification=None):
+    """
+    Builds the timeline of a batch from its state history, its trace and its notification.
+
+    :param batch: The batch document, containing at least the fields of TIMELINE_BATCH_PROJECTION
+    :type batch: dict
+    :param notification: The notification document of this batch or None, if the batch was not notified yet
+    :type notification: dict or None
+    :return: A dictionary containing the "phases" the batch spent in every state, the measured "spans" sorted by
+             start and "timeToResult", which is the time from registration to the last finished state or None, if the
+             batch is not finished yet
+    :rtype: dict
+    """
+    history = batch.get('history', [])
+
+    phases = []
+    for i, entry in enumerate(history):
+        end = history[i + 1]['time'] if i + 1 < len(history) else None
+        phases.append(_span_dict(entry['state'], entry['time'], end, node=entry.get('node')))
+
+    spans = [_span_dict(name, start, start + duration) for name, start, duration in batch.get('trace', [])]
+
+    time_to_result = None
+    if history and history[-1]['state'] in ('succeeded', 'failed', 'cancelled'):
+        finished_time = history[-1]['time']
+        time_to_result = finished_time - batch['registrationTime']
+
+        if notification is not None and notification.get('deliveredTime') is not None:
+            spans.append(_span_dict(SPAN_NOTIFICATION, finished_time, notification['deliveredTime']))
+
+    spans.sort(key=lambda span: span['start'])
+
+    return {
+        'batchId': str(batch['_id']),
+        'experimentId': batch['experimentId'],
+        'state': batch['state'],
+        'registrationTime': batch['registrationTime'],
+        'timeToResult': time_to_result,
+        'phases': phases,
+        'spans': spans
+    }
@@ -0,0 +1,121 @@
+import io
+import json
+import os
+import tarfile
+from copy import copy
+from threading import Lock
+
+from cc_core.commons.docker_utils import create_batch_archive
+from cc_core.commons.files import create_directory_tarinfo
+from cc_core.commons.red_to_blue import CONTAINER_BLUE_FILE_PATH
+
+END_OF_ARCHIVE = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+class BatchArchiveBuilder:
+    """
+    Builds the tar archives, that are put into batch containers.
+
+    The archive created by cc_core contains the blue agent, the blue file and the inputs/outputs directories. Everything
+    except the blue file is equal for every batch, so this part is built once as prebuilt tar segment and reused. For
+    every batch only the blue file entry and the end of archive marker are appended to this segment.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._segment = None  # type: bytes or None
+        self._blue_file_tarinfo = None  # type: tarfile.TarInfo or None
+
+    def _prebuild(self):
+        """
+        Creates the prebuilt tar segment from a reference archive created by cc_core, if it was not created before.
+        """
+        with self._lock:
+            if self._segment is not None:
+                return
+
+            blue_file_name = CONTAINER_BLUE_FILE_PATH.lstrip('/')
+            blue_file_tarinfo = None
+            segment = io.BytesIO()
+
+            with tarfile.open(fileobj=create_batch_archive({}), mode='r') as reference_tar:
+                # the segment tar is never closed, because closing would append the end of archive marker
+                segment_tar = tarfile.open(fileobj=segment, mode='w', format=tarfile.DEFAULT_FORMAT)
+
+                for member in reference_tar.getmembers():
+                    if member.name.lstrip('/') == blue_file_name:
+                        blue_file_tarinfo = member
+                        continue
+
+                    fileobj = reference_tar.extractfile(member) if member.isfile() else None
+                    segment_tar.addfile(member, fileobj)
+
+            if blue_file_tarinfo is None:
+                raise ValueError('Reference batch archive does not contain "{}"'.format(CONTAINER_BLUE_FILE_PATH))
+
+            self._blue_file_tarinfo = blue_file_tarinfo
+            self._segment = segment.getvalue()
+
+    def create(self, blue_data):
+        """
+        Creates a tar archive containing the blue agent, the inputs/outputs directories and a blue file filled with the
+        given blue data. The archive is equal to the archive created by cc_core.commons.docker_utils.create_batch_archive.
+
+        :param blue_data: The data to put into the blue file of the returned archive
+        :type blue_data: dict
+        :return: A tar archive. The archive is built with a single buffer allocation and wrapped in a BytesIO, which
+                 shares this buffer instead of copying it.
+        :rtype: io.BytesIO
+        """
+        self._prebuild()
+
+        content = json.dumps(blue_data).encode('utf-8')
+
+        tarinfo = copy(self._blue_file_tarinfo)
+        tarinfo.size = len(content)
+        header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+
+        padding = tarfile.NUL * (-len(content) % tarfile.BLOCKSIZE)
+
+        return io.BytesIO(b''.join([self._segment, header, content, padding, END_OF_ARCHIVE]))
+
+    def create_base(self):
+        """
+        Creates a tar archive containing the blue agent and the inputs/outputs directories, but no blue file.
+
+        :return: A tar archive
+        :rtype: io.BytesIO
+        """
+        self._prebuild()
+
+        return io.BytesIO(b''.join([self._segment, END_OF_ARCHIVE]))
+
+    def create_blue_file(self, blue_data, directory):
+        """
+        Creates a tar archive containing the given directory owned by the container user and a blue file filled with
+        the given blue data inside this directory.
+
+        :param blue_data: The data to put into the blue file of the returned archive
+        :type blue_data: dict
+        :param directory: The absolute path of the directory inside the container
+        :type directory: str
+        :return: A tuple (archive, blue_file_path) containing the tar archive and the absolute path of the blue file
+                 inside the container
+        :rtype: Tuple[io.BytesIO, str]
+        """
+        self._prebuild()
+
+        content = json.dumps(blue_data).encode('utf-8')
+        blue_file_path = os.path.join(directory, os.path.basename(CONTAINER_BLUE_FILE_PATH))
+
+        tarinfo = copy(self._blue_file_tarinfo)
+        tarinfo.name = blue_file_path
+        tarinfo.size = len(content)
+
+        data_file = io.BytesIO()
+        with tarfile.open(mode='w', fileobj=data_file) as tar_file:
+            tar_file.addfile(create_directory_tarinfo(directory, owner_name='cc'))
+            tar_file.addfile(tarinfo, io.BytesIO(content))
+        data_file.seek(0)
+
+        return data_file, blue_file_path
@@ -0,0 +1,121 @@
+import os
+import sys
+from threading import Thread
+from time import time, sleep
+
+from pymongo.errors import PyMongoError, OperationFailure
+
+DEFAULT_FALLBACK_INTERVAL = 300
+RESUME_TOKEN_SAVE_INTERVAL = 5
+WATCH_RETRY_INTERVAL = 10
+
+# mongodb error code, if the oplog entry of a resume token does not exist anymore
+_CHANGE_STREAM_HISTORY_LOST = 286
+
+FINISHED_STATES = ['succeeded', 'failed', 'cancelled']
+
+
+def batch_state_pipeline(states, node_name=None):
+    """
+    Creates a change stream pipeline, that matches inserted batches and batch updates, which set the state of a batch
+    to one of the given states.
+
+    :param states: The batch states to match
+    :type states: List[str]
+    :param node_name: If given, only updates, which also set the node of the batch to node_name, are matched
+    :type node_name: str or None
+    :return: A change stream pipeline
+    :rtype: List[dict]
+    """
+    update_match = {
+        'operationType': 'update',
+        'updateDescription.updatedFields.state': {'$in': states}
+    }
+
+    if node_name is not None:
+        update_match['updateDescription.updatedFields.node'] = node_name
+        return [{'$match': update_match}]
+
+    return [{'$match': {'$or': [{'operationType': 'insert'}, update_match]}}]
+
+
+class ChangeStreamWatcher:
+    """
+    Watches a mongodb change stream in a background thread and calls a callback for every change. The resume token of
+    the last change is persisted in the "resumeTokens" collection, so that changes, which happened while the
+    controller was stopped, are reported after a restart. Change streams require a replica set deployment. If watching
+    fails, the watcher retries after WATCH_RETRY_INTERVAL seconds, in the meantime the fallback polling of the caller
+    picks up the work.
+    """
+
+    def __init__(self, mongo, collection, pipeline, name, callback):
+        """
+        :param mongo: The mongo client
+        :type mongo: cc_agency.commons.db.Mongo
+        :param collection: The collection to watch
+        :type collection: str
+        :param pipeline: The aggregation pipeline filtering the changes
+        :type pipeline: List[dict]
+        :param name: The unique name of this watcher, used as id of the persisted resume token
+        :type name: str
+        :param callback: A function without arguments, that is called for every change
+        :type callback: Callable[[], None]
+        """
+        self._mongo = mongo
+        self._collection = collection
+        self._pipeline = pipeline
+        self._name = name
+        self._callback = callback
+
+    def start(self):
+        Thread(target=self._watch_loop).start()
+
+    def _load_resume_token(self):
+        resume_token = self._mongo.db['resumeTokens'].find_one({'_id': self._name})
+        if resume_token is None:
+            return None
+        return resume_token['token']
+
+    def _save_resume_token(self, token):
+        self._mongo.db['resumeTokens'].update_one(
+            {'_id': self._name},
+            {'$set': {'token': token}},
+            upsert=True
+        )
+
+    def _watch_loop(self):
+        while True:
+            try:
+                self._watch()
+            except OperationFailure as e:
+                if e.code == _CHANGE_STREAM_HISTORY_LOST:
+                    # the changes since the last resume token are lost, the fallback polling picks up the work
+                    self._mongo.db['resumeTokens'].delete_one({'_id': self._name})
+                    self._callback()
+                    continue
+                self._log_failure(e)
+            except PyMongoError as e:
+                self._log_failure(e)
+
+            self._callback()
+            sleep(WATCH_RETRY_INTERVAL)
+
+    def _watch(self):
+        resume_token = self._load_resume_token()
+        last_save = 0
+
+        with self._mongo.db[self._collection].watch(self._pipeline, resume_after=resume_token) as stream:
+            for change in stream:
+                self._callback()
+
+                # resume tokens are saved at most every RESUME_TOKEN_SAVE_INTERVAL seconds, changes reported again after
+                # a restart only trigger an additional check
+                if last_save + RESUME_TOKEN_SAVE_INTERVAL < time():
+                    self._save_resume_token(change['_id'])
+                    last_save = time()
+
+    def _log_failure(self, e):
+        debug_info = 'Change stream "{}" failed, retry in {} seconds:{}{}'.format(
+            self._name, WATCH_RETRY_INTERVAL, os.linesep, repr(e)
+        )
+        print(debug_info, file=sys.stderr)
@@ -1,15 +1,18 @@
+import calendar
 import io
 import json
 import os
+import re
 import sys
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 import concurrent.futures
+from collections import OrderedDict
 import time
 from traceback import format_exc
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Set
 
 import docker
-from docker.errors import DockerException, APIError
+from docker.errors import DockerException, APIError, NotFound
 from docker.models.containers import Container
 from docker.models.images import Image
 from docker.tls import TLSConfig
@@ -23,12 +26,19 @@ import bson.errors
 from cc_core.commons.gpu_info import GPUDevice, NVIDIA_GPU_VENDOR
 from cc_agency.commons.schemas.callback import agent_result_schema
 from cc_agency.commons.secrets import get_experiment_secret_keys, fill_experiment_secrets, fill_batch_secrets, \
-    get_batch_secret_keys, TrusteeClient
-from cc_core.commons.docker_utils import create_container_with_gpus, create_batch_archive, image_to_str, \
-    detect_nvidia_docker_gpus
-from cc_core.commons.red_to_blue import convert_red_to_blue, CONTAINER_OUTPUT_DIR, CONTAINER_AGENT_PATH, \
-    CONTAINER_BLUE_FILE_PATH
+    get_batch_secret_keys, fill_blue_batch_secrets, TrusteeClient
+from cc_core.commons.docker_utils import create_container_with_gpus, detect_nvidia_docker_gpus
+from cc_core.commons.red_to_blue import convert_red_to_blue, CONTAINER_OUTPUT_DIR, CONTAINER_INPUT_DIR, \
+    CONTAINER_AGENT_PATH, CONTAINER_BLUE_FILE_PATH
 from cc_agency.commons.helper import batch_failure
+from cc_agency.commons.metrics import REGISTRY
+from cc_agency.commons.tracing import trace_span, SPAN_PULL, SPAN_CONTAINER_START, SPAN_EXECUTION, \
+    SPAN_HARVEST
+from cc_agency.controller.archives import BatchArchiveBuilder
+from cc_agency.controller.pool import ContainerPool, POOL_CONTAINER_PREFIX, POOL_CONTAINER_COMMAND, \
+    pool_container_name
+from cc_agency.controller.change_streams import ChangeStreamWatcher, batch_state_pipeline, DEFAULT_FALLBACK_INTERVAL
+from cc_agency.controller.images import ImageCache, image_inventory_entry, image_inventory_key, normalize_image_url
 
 INSPECTION_IMAGE = 'docker.io/busybox:latest'
 NVIDIA_INSPECTION_IMAGE = 'nvidia/cuda:8.0-runtime'
@@ -37,6 +47,40 @@ CHECK_EXITED_CONTAINERS_INTERVAL = 1.0
 OFFLINE_INSPECTION_INTERVAL = 10
 CHECK_FOR_BATCHES_INTERVAL = 20
 IMAGE_PRUNE_INTERVAL = 3600
+IMAGE_GC_INTERVAL = 300
+BYTES_PER_MB = 1024 * 1024
+NANO_CPUS_PER_CPU = 10 ** 9
+MAX_PENDING_PREFETCHES = 4
+CONTAINER_SPEC_CACHE_SIZE = 128
+POOL_IDLE_TIMEOUT = 60
+POOLED_EXECUTION_TIMEOUT = 3600
+
+# docker reports container times in RFC 3339 with nanoseconds, e.g. 2019-01-01T12:00:00.123456789Z
+_DOCKER_TIME_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?Z$')
+
+# shared by all client proxies, because the prebuilt part of the batch archives is equal for all nodes
+_batch_archive_builder = BatchArchiveBuilder()
+
+_RUN_CONTAINER_SECONDS = REGISTRY.histogram(
+    'ccagency_controller_run_container_seconds',
+    'Duration of creating and starting batch containers.',
+    ['node']
+)
+_CHECK_EXITED_CONTAINER_SECONDS = REGISTRY.histogram(
+    'ccagency_controller_check_exited_container_seconds',
+    'Duration of evaluating the result of exited batch containers.',
+    ['node']
+)
+_THREAD_POOL_QUEUED_TASKS = REGISTRY.gauge(
+    'ccagency_controller_thread_pool_queued_tasks',
+    'Number of tasks waiting for a worker of a thread pool of a node.',
+    ['node', 'pool']
+)
+_THREAD_POOL_WORKERS = REGISTRY.gauge(
+    'ccagency_controller_thread_pool_workers',
+    'Number of started worker threads of a thread pool of a node.',
+    ['node', 'pool']
+)
 
 
 class ImagePullResult:
@@ -63,31 +107,6 @@ class ImagePullResult:
         self.depending_batches = depending_batches
 
 
-def _pull_image(docker_client, image_url, auth, depending_batches):
-    """
-    Pulls the given docker image and returns a ImagePullResult object.
-
-    :param docker_client: The docker client, which is used to pull the image
-    :type docker_client: docker.DockerClient
-    :param image_url: The image to pull
-    :type image_url: str
-    :param auth: A tuple containing (username, password) or None
-    :type auth: Tuple[str, str] or None
-    :param depending_batches: A list of batches, which depend on the given image
-    :type depending_batches: List[Dict]
-
-    :return: An ImagePullResult describing the pull
-    :rtype: ImagePullResult
-    """
-    try:
-        docker_client.images.pull(image_url, auth_config=auth)
-    except Exception as e:
-        debug_info = str(e).split('\n')
-        return ImagePullResult(image_url, auth, False, debug_info, depending_batches)
-
-    return ImagePullResult(image_url, auth, True, None, depending_batches)
-
-
 def fill_experiment_secret_keys(trustee_client, experiment):
     """
     Returns the given experiment with filled template keys and values.
@@ -102,7 +121,7 @@ def fill_experiment_secret_keys(trustee_client, experiment):
                                 requested keys
     """
     experiment_secret_keys = get_experiment_secret_keys(experiment)
-    response = trustee_client.collect(experiment_secret_keys)
+    response = trustee_client.collect(experiment_secret_keys, namespace=experiment.get('secretsNamespace'))
     if response['state'] == 'failed':
 
         debug_info = response['debugInfo']
@@ -159,6 +178,7 @@ class ClientProxy:
       then waits for the "online-flag" to be set.
     """
     NUM_WORKERS = 4
+    NUM_POOL_WORKERS = 16
 
     def __init__(self, node_name, conf, mongo, trustee_client, scheduling_event):
         self._node_name = node_name
@@ -169,6 +189,9 @@ class ClientProxy:
 
         node_conf = conf.d['controller']['docker']['nodes'][node_name]
         self._image_prune_duration = conf.d['controller']['docker'].get('image_prune_duration')
+        image_gc = conf.d['controller']['docker'].get('image_gc', {})
+        self._image_gc_high_watermark = image_gc.get('high_watermark')
+        self._image_gc_low_watermark = image_gc.get('low_watermark', self._image_gc_high_watermark)
         self._last_prune_timestamp = 0
         self._base_url = node_conf['base_url']
         self._tls = False
@@ -179,6 +202,18 @@ class ClientProxy:
         self._network = node_conf.get('network')
         self._gpu_blacklist = node_conf.get('hardware', {}).get('gpu_blacklist')  # type: List[GPUDevice]
 
+        limits = node_conf.get('limits', {})
+        self._max_concurrent_starts = limits.get('max_concurrent_starts', ClientProxy.NUM_WORKERS)
+        self._max_concurrent_pulls = limits.get('max_concurrent_pulls', ClientProxy.NUM_WORKERS)
+        self._max_running_batches = limits.get('max_running_batches')  # type: int or None
+        self._pooled_execution_timeout = limits.get('pooled_execution_timeout', POOLED_EXECUTION_TIMEOUT)
+
+        # with change streams the check for batches interval only serves as fallback
+        change_streams = conf.d['controller'].get('change_streams')
+        self._check_for_batches_interval = CHECK_FOR_BATCHES_INTERVAL
+        if change_streams is not None:
+            self._check_for_batches_interval = change_streams.get('fallback_interval', DEFAULT_FALLBACK_INTERVAL)
+
         # create db entry for this node
         node = {
             'nodeName': node_name,
@@ -186,7 +221,9 @@ class ClientProxy:
             'history': [],
             'ram': None,
             'cpus': None,
-            'gpus': None
+            'gpus': None,
+            'images': {},
+            'version': 1
         }
 
         bson_node_id = self._mongo.db['nodes'].insert_one(node).inserted_id
@@ -204,6 +241,39 @@ class ClientProxy:
         self._check_for_batches_event = Event()  # type: Event
         self._check_exited_containers_event = Event()  # type: Event
 
+        # initialize Executor Pools
+        self._pull_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_concurrent_pulls)
+        self._run_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_concurrent_starts)
+
+        # prefetching uses a single worker to limit the load on the docker daemon and the registries
+        self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending_prefetches = set()
+        self._pending_prefetches_lock = Lock()
+
+        # pooled containers of experiments with reuseContainers
+        self._pool_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._max_running_batches or ClientProxy.NUM_POOL_WORKERS
+        )
+        self._container_pools = {}  # type: Dict[str, ContainerPool]
+        self._container_pools_lock = Lock()
+        # pooled batches in execution with their container and the deadline of their execution
+        self._pooled_batches = {}  # type: Dict[str, Tuple[Container, float]]
+        # pooled batches, whose containers were removed, because they exceeded the pooled execution timeout
+        self._timed_out_pooled_batches = set()  # type: Set[str]
+        # pooled batches, that wait for a pool worker and are still in state scheduled
+        self._queued_pooled_batches = set()  # type: Set[str]
+        self._pooled_batches_lock = Lock()
+
+        # container creation arguments per experiment id
+        self._container_specs = OrderedDict()  # type: OrderedDict[str, Dict]
+        self._container_specs_lock = Lock()
+
+        self._image_cache = ImageCache(
+            self._pull_executor,
+            pull_policy=conf.d['controller']['docker'].get('image_pull_policy'),
+            pull_ttl=conf.d['controller']['docker'].get('image_pull_ttl')
+        )
+
         if not self._init_docker_client():
             self.do_inspect()
             self._set_offline(format_exc())
@@ -212,13 +282,41 @@ class ClientProxy:
         Thread(target=self._check_for_batches_loop).start()
         Thread(target=self._check_exited_containers_loop).start()
 
-        # initialize Executor Pools
-        self._pull_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ClientProxy.NUM_WORKERS)
-        self._run_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ClientProxy.NUM_WORKERS)
+        REGISTRY.add_collector(self._collect_thread_pool_metrics)
+
+        # batches scheduled to this node trigger a check for batches
+        if change_streams is not None:
+            ChangeStreamWatcher(
+                mongo,
+                'batches',
+                batch_state_pipeline(['scheduled'], node_name),
+                'node:{}'.format(node_name),
+                self.do_check_for_batches
+            ).start()
 
     def get_gpus(self):
         return self._gpus
 
+    def _collect_thread_pool_metrics(self):
+        """
+        Updates the saturation gauges of the thread pools of this node.
+        """
+        thread_pools = {
+            'pull': self._pull_executor,
+            'run': self._run_executor,
+            'prefetch': self._prefetch_executor,
+            'pool': self._pool_executor
+        }
+
+        for pool_name, executor in thread_pools.items():
+            # noinspection PyProtectedMember
+            _THREAD_POOL_QUEUED_TASKS.set(executor._work_queue.qsize(), node=self._node_name, pool=pool_name)
+            # noinspection PyProtectedMember
+            _THREAD_POOL_WORKERS.set(len(executor._threads), node=self._node_name, pool=pool_name)
+
+    def get_max_running_batches(self):
+        return self._max_running_batches
+
     def is_online(self):
         return self._online.is_set()
 
@@ -235,7 +333,8 @@ class ClientProxy:
                     'state': 'online',
                     'ram': ram,
                     'cpus': cpus,
-                    'gpus': gpus
+                    'gpus': gpus,
+                    'images': self._image_inventory()
                 },
                 '$push': {
                     'history': {
@@ -243,6 +342,9 @@ class ClientProxy:
                         'time': time.time(),
                         'debugInfo': None
                     }
+                },
+                '$inc': {
+                    'version': 1
                 }
             }
         )
@@ -266,6 +368,9 @@ class ClientProxy:
                         'time': timestamp,
                         'debugInfo': debug_info
                     }
+                },
+                '$inc': {
+                    'version': 1
                 }
             }
         )
@@ -292,6 +397,56 @@ class ClientProxy:
         runtimes = info['Runtimes']
         return ram, cpus, runtimes
 
+    def _image_inventory(self):
+        """
+        Returns the inventory of docker images, that are present on this node.
+
+        :return: A dictionary mapping image ids to inventory entries containing the normalized urls and the size of
+                 the image. If the images could not be listed, an empty dictionary is returned.
+        :rtype: Dict[str, dict]
+        """
+        try:
+            images = self._client.images.list()
+        except (DockerException, ConnectionError) as e:
+            self._log('Failed to list images of node "{}":\n{}'.format(self._node_name, repr(e)))
+            return {}
+
+        return {image.id: image_inventory_entry(image) for image in images}
+
+    def _publish_image(self, image):
+        """
+        Adds the given image to the image inventory of this node in the database. The inventory is informational, so
+        failures are only logged and do not affect the batches, that use this image.
+
+        :param image: The image, that is present on this node
+        :type image: Image
+        """
+        try:
+            key = image_inventory_key(image.id)
+            entry = image_inventory_entry(image)
+        except Exception as e:
+            self._log('Failed to publish image of node "{}":\n{}'.format(self._node_name, repr(e)))
+            return
+
+        # images are published after every pull, the filter keeps the version of the node, if nothing changed
+        self._mongo.db['nodes'].update_one(
+            {'_id': ObjectId(self._node_id), key: {'$ne': entry}},
+            {'$set': {key: entry}, '$inc': {'version': 1}}
+        )
+
+    def _unpublish_image(self, image_id):
+        """
+        Removes the image with the given id from the image inventory of this node in the database.
+
+        :param image_id: The id of the image, that was removed from this node
+        :type image_id: str
+        """
+        key = image_inventory_key(image_id)
+        self._mongo.db['nodes'].update_one(
+            {'_id': ObjectId(self._node_id), key: {'$exists': True}},
+            {'$unset': {key: ''}, '$inc': {'version': 1}}
+        )
+
     @staticmethod
     def _log(message):
         """
@@ -342,7 +497,8 @@ class ClientProxy:
 
     def _remove_cancelled_containers(self):
         """
-        Stops all docker containers, whose batches got cancelled.
+        Stops all docker containers, whose batches got cancelled, and pooled containers, whose batches exceeded the
+        pooled execution timeout.
 
         :raise DockerException: If the docker server returns an error
         """
@@ -363,6 +519,36 @@ class ClientProxy:
             c.remove(force=True)
             resources_freed = True
 
+        # pooled containers are removed, if the batch they are executing got cancelled
+        with self._pooled_batches_lock:
+            pooled_batches = dict(self._pooled_batches)
+
+        if pooled_batches:
+            cursor = self._mongo.db['batches'].find(
+                {
+                    '_id': {'$in': [ObjectId(_id) for _id in pooled_batches]},
+                    'state': 'cancelled'
+                },
+                {'_id': 1}
+            )
+            for batch in cursor:
+                container, _deadline = pooled_batches[str(batch['_id'])]
+                ClientProxy._remove_container_quietly(container)
+                resources_freed = True
+
+        # pooled containers are removed, if the batch they are executing exceeded the pooled execution timeout
+        now = time.time()
+        with self._pooled_batches_lock:
+            timed_out_containers = []
+            for batch_id, (container, deadline) in self._pooled_batches.items():
+                if deadline <= now and batch_id not in self._timed_out_pooled_batches:
+                    self._timed_out_pooled_batches.add(batch_id)
+                    timed_out_containers.append(container)
+
+        for container in timed_out_containers:
+            ClientProxy._remove_container_quietly(container)
+            resources_freed = True
+
         return resources_freed
 
     def _can_execute_container(self):
@@ -422,6 +608,7 @@ class ClientProxy:
                 self._runtimes = runtimes
                 self._init_gpus()  # try to detect gpus
                 if not self.is_online():
+                    self._remove_stale_pooled_containers()
                     self._set_online(ram, cpus)
                     init_succeeded = True
                     self._printed_failed_docker_client_init = False
@@ -498,7 +685,8 @@ class ClientProxy:
 
             exited_container = exited_containers[batch_id]
 
-            self._check_exited_container(exited_container, batch)
+            with _CHECK_EXITED_CONTAINER_SECONDS.time(node=self._node_name):
+                self._check_exited_container(exited_container, batch)
 
             exited_container.remove()
 
@@ -536,8 +724,8 @@ class ClientProxy:
         :param batch: The batch to update according to the result of the container execution.
         :type batch: dict
         """
-        bson_batch_id = batch['_id']
-        batch_id = str(bson_batch_id)
+        batch_id = str(batch['_id'])
+        harvest_start = time.time()
 
         try:
             stdout_logs = container.logs(stderr=False).decode('utf-8')
@@ -547,16 +735,52 @@ class ClientProxy:
             err_str = repr(e)
             self._log('Failed to get container logs:\n{}'.format(err_str))
             debug_info = 'Could not get logs or stats of container: {}'.format(err_str)
-            batch_failure(self._mongo, batch_id, debug_info, None, batch['state'])
+            batch_failure(
+                self._mongo, batch_id, debug_info, None, batch['state'],
+                trace_spans=[trace_span(SPAN_HARVEST, harvest_start)]
+            )
             return
 
+        trace_spans = []
+        execution_span = _container_execution_span(container)
+        if execution_span is not None:
+            trace_spans.append(execution_span)
+
+        self._process_agent_result(batch, stdout_logs, stderr_logs, docker_stats, harvest_start, trace_spans)
+
+    def _process_agent_result(self, batch, stdout_logs, stderr_logs, docker_stats, harvest_start, trace_spans):
+        """
+        Evaluates the output of the blue agent for the given batch and updates the database accordingly.
+
+        :param batch: The batch to update according to the result of the blue agent.
+        :type batch: dict
+        :param stdout_logs: The stdout of the blue agent
+        :type stdout_logs: str
+        :param stderr_logs: The stderr of the blue agent
+        :type stderr_logs: str
+        :param docker_stats: The stats of the docker container or None
+        :type docker_stats: dict or None
+        :param harvest_start: The unix timestamp at which the evaluation of the batch result started
+        :type harvest_start: float
+        :param trace_spans: Spans, that are pushed to the trace of the batch together with the harvest span
+        :type trace_spans: List[list]
+        """
+        bson_batch_id = batch['_id']
+        batch_id = str(bson_batch_id)
+
+        def finished_spans():
+            return trace_spans + [trace_span(SPAN_HARVEST, harvest_start)]
+
         data = None
         try:
             data = json.loads(stdout_logs)
         except json.JSONDecodeError as e:
             err_str = repr(e)
             debug_info = 'CC-Agent data is not a valid json object: {}\n\nstdout was:\n{}'.format(err_str, stdout_logs)
-            batch_failure(self._mongo, batch_id, debug_info, data, batch['state'], docker_stats=docker_stats)
+            batch_failure(
+                self._mongo, batch_id, debug_info, data, batch['state'], docker_stats=docker_stats,
+                trace_spans=finished_spans()
+            )
             self._log('Failed to load json from blue agent:\n{}'.format(err_str))
             return
 
@@ -565,13 +789,19 @@ class ClientProxy:
         except jsonschema.ValidationError as e:
             err_str = repr(e)
             debug_info = 'CC-Agent data sent by callback does not comply with jsonschema: {}'.format(err_str)
-            batch_failure(self._mongo, batch_id, debug_info, data, batch['state'], docker_stats=docker_stats)
+            batch_failure(
+                self._mongo, batch_id, debug_info, data, batch['state'], docker_stats=docker_stats,
+                trace_spans=finished_spans()
+            )
             self._log('Failed to validate blue agent output:\n{}'.format(err_str))
             return
 
         if data['state'] == 'failed':
             debug_info = 'Batch failed.\nContainer stderr:\n{}\ndebug info:\n{}'.format(stderr_logs, data['debugInfo'])
-            batch_failure(self._mongo, batch_id, debug_info, data, batch['state'], docker_stats=docker_stats)
+            batch_failure(
+                self._mongo, batch_id, debug_info, data, batch['state'], docker_stats=docker_stats,
+                trace_spans=finished_spans()
+            )
             return
 
         batch = self._mongo.db['batches'].find_one(
@@ -580,7 +810,10 @@ class ClientProxy:
         )
         if batch['state'] != 'processing':
             debug_info = 'Batch failed.\nExited container, but not in state processing.'
-            batch_failure(self._mongo, batch_id, debug_info, data, batch['state'], docker_stats=docker_stats)
+            batch_failure(
+                self._mongo, batch_id, debug_info, data, batch['state'], docker_stats=docker_stats,
+                trace_spans=finished_spans()
+            )
             return
 
         self._mongo.db['batches'].update_one(
@@ -600,7 +833,11 @@ class ClientProxy:
                         'node': batch['node'],
                         'ccagent': data,
                         'dockerStats': docker_stats
-                    }
+                    },
+                    'trace': {'$each': finished_spans()}
+                },
+                '$inc': {
+                    'version': 1
                 }
             }
         )
@@ -617,6 +854,41 @@ class ClientProxy:
         """
         self._check_exited_containers_event.set()
 
+    def do_prefetch_image(self, image_url, auth):
+        """
+        Pulls the given image in the background, if it is not already pulled or queued for prefetching. Prefetches are
+        executed one after another and at most MAX_PENDING_PREFETCHES are queued per node.
+
+        :param image_url: The image to pull
+        :type image_url: str
+        :param auth: A tuple containing (username, password) or None
+        :type auth: Tuple[str, str] or None
+        """
+        if not self.is_online():
+            return
+
+        with self._pending_prefetches_lock:
+            if image_url in self._pending_prefetches or len(self._pending_prefetches) >= MAX_PENDING_PREFETCHES:
+                return
+            self._pending_prefetches.add(image_url)
+
+        future = self._image_cache.pull(self._client, image_url, auth, executor=self._prefetch_executor)
+        future.add_done_callback(lambda f: self._prefetch_done(image_url, f))
+
+    def _prefetch_done(self, image_url, future):
+        with self._pending_prefetches_lock:
+            self._pending_prefetches.discard(image_url)
+
+        # prefetches are cancelled, if a batch needs the image before the prefetch started
+        if future.cancelled():
+            return
+
+        successful, debug_info, image = future.result()
+        if not successful:
+            self._log('Failed to prefetch image "{}":\n{}'.format(image_url, '\n'.join(debug_info)))
+        elif image is not None:
+            self._publish_image(image)
+
     def do_inspect(self):
         """
         Triggers an inspection cycle.
@@ -631,7 +903,7 @@ class ClientProxy:
         while True:
             self._online.wait()
 
-            self._check_for_batches_event.wait(timeout=CHECK_FOR_BATCHES_INTERVAL)
+            self._check_for_batches_event.wait(timeout=self._check_for_batches_interval)
             self._check_for_batches_event.clear()
 
             try:
@@ -642,74 +914,126 @@ class ClientProxy:
                 continue
 
             self._prune_docker_images()
+            self._remove_pooled_containers(idle_timeout=POOL_IDLE_TIMEOUT)
 
-    def _get_images_with_last_registration_time(self):
+    def _get_image_last_use_times(self):
         """
-        Returns a dict with images as keys and  last_registration_timestamps as values.
-        The images are gathered from all experiments executed in this agency. The resulting list only contains images,
-        which are present on the host.
-        The last_registration_timestamp is the latest timestamp when an experiment was registered that uses this image.
+        Returns the time an image was last used by an experiment for all images used by experiments of this agency. The
+        times are read with a single aggregation.
 
-        :return: A dict {images: last_execution_timestamps}
-                 key: the docker image as Image object
-                 value: last_execution_timestamp is a unix timestamp defining the last execution of the given image
-        :rtype: Dict[Image, float]
+        :return: A dictionary mapping normalized image urls to the latest registration time of an experiment, which
+                 uses this image
+        :rtype: Dict[str, float]
         """
-        images_with_execution_time = {}
+        cursor = self._mongo.db['experiments'].aggregate([
+            {'$group': {'_id': '$container.settings.image.url', 'lastUse': {'$max': '$registrationTime'}}}
+        ])
 
-        for image_url in self._mongo.db.experiments.distinct('container.settings.image.url'):
-            try:
-                image = self._client.images.get(image_url)
-            except docker.errors.ImageNotFound:
-                # if image does not exist on this host, proceed
-                continue
-            except ConnectionError as e:
-                self.do_inspect()
-                self._log('Failed to get image "{}" with registration time:\n{}'.format(image_url, repr(e)))
+        last_use_times = {}  # type: Dict[str, float]
+        for e in cursor:
+            if e['_id'] is None:
                 continue
+            image_url = normalize_image_url(e['_id'])
+            last_use_times[image_url] = max(last_use_times.get(image_url, 0), e['lastUse'])
 
-            latest_experiment = self._mongo.db.experiments.find_one(
-                {'container.settings.image.url': image_url},
-                sort=[('registrationTime', pymongo.DESCENDING)]
-            )
+        return last_use_times
 
-            registration_time = latest_experiment['registrationTime']
+    def _get_images_in_use(self):
+        """
+        Returns the images of the batches, that are scheduled to or processing on this node.
 
-            # update dict, except the image is already present with later timestamp
-            if images_with_execution_time.get(image, 0) < registration_time:
-                images_with_execution_time[image] = registration_time
+        :return: A set of normalized image urls
+        :rtype: Set[str]
+        """
+        experiment_ids = self._mongo.db['batches'].distinct(
+            'experimentId',
+            {'node': self._node_name, 'state': {'$in': ['scheduled', 'processing']}}
+        )
+
+        cursor = self._mongo.db['experiments'].find(
+            {'_id': {'$in': [ObjectId(experiment_id) for experiment_id in experiment_ids]}},
+            {'container.settings.image.url': 1}
+        )
 
-        return images_with_execution_time
+        return {normalize_image_url(e['container']['settings']['image']['url']) for e in cursor}
 
     def _prune_docker_images(self):
         """
-        Removes all docker images, that are created longer ago than self._image_prune_duration.
+        Removes docker images of experiments from this node, least recently used images first. Images are removed, if
+        they were last used longer ago than self._image_prune_duration, or if the size of all image layers on this node
+        exceeds the high watermark. In the latter case images are removed until the low watermark is reached.
+        Images used by scheduled or processing batches on this node and images not used by any experiment are never
+        removed.
         """
-        if self._image_prune_duration is None:
+        if self._image_prune_duration is None and self._image_gc_high_watermark is None:
             return
 
         t = time.time()
         # check if it is time to prune images
-        if self._last_prune_timestamp + IMAGE_PRUNE_INTERVAL > t:
+        prune_interval = IMAGE_PRUNE_INTERVAL if self._image_gc_high_watermark is None else IMAGE_GC_INTERVAL
+        if self._last_prune_timestamp + prune_interval > t:
             return
 
         self._last_prune_timestamp = t
 
-        used_images = self._get_images_with_last_registration_time()
+        last_use_times = self._get_image_last_use_times()
+        images_in_use = self._get_images_in_use()
+
+        try:
+            disk_usage = self._client.df()
+        except (DockerException, ConnectionError) as e:
+            self.do_inspect()
+            self._log('Failed to get disk usage:\n{}'.format(repr(e)))
+            return
+
+        # images used by experiments, least recently used first
+        candidates = []  # type: List[Tuple[float, dict]]
+        for image in disk_usage.get('Images') or []:
+            image_urls = {normalize_image_url(tag) for tag in (image.get('RepoTags') or [])}
+            if not image_urls or (image_urls & images_in_use):
+                continue
+
+            image_last_use_times = [last_use_times[url] for url in image_urls if url in last_use_times]
+            if not image_last_use_times:
+                continue
+
+            candidates.append((max(image_last_use_times), image))
+
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        layers_size = disk_usage.get('LayersSize') or 0
+        until_filter = None
+        if self._image_prune_duration is not None:
+            until_filter = t - self._image_prune_duration
+
+        disk_pressure = False
+        if self._image_gc_high_watermark is not None:
+            disk_pressure = layers_size > self._image_gc_high_watermark * BYTES_PER_MB
+
+        for last_use_time, image in candidates:
+            if disk_pressure and layers_size <= self._image_gc_low_watermark * BYTES_PER_MB:
+                disk_pressure = False
 
-        until_filter = time.time() - self._image_prune_duration
+            expired = (until_filter is not None) and (last_use_time < until_filter)
+            if not (expired or disk_pressure):
+                # candidates are sorted by last use, so none of the following images is expired
+                break
 
-        for image, last_registration_timestamp in used_images.items():
-            if last_registration_timestamp < until_filter:
-                try:
-                    self._client.images.remove(image.id)
-                except APIError:
-                    continue  # if image is used by other images
-                except ConnectionError as e:
-                    self.do_inspect()
-                    self._log('Failed to remove image:\n{}'.format(repr(e)))
-                    break
-                print('removed image {}'.format(image_to_str(image)))
+            try:
+                self._client.images.remove(image['Id'])
+            except APIError:
+                continue  # if image is used by other images or containers
+            except ConnectionError as e:
+                self.do_inspect()
+                self._log('Failed to remove image:\n{}'.format(repr(e)))
+                break
+
+            # shared layers are not freed, if other images still use them
+            layers_size -= image.get('Size', 0) - max(image.get('SharedSize', 0), 0)
+
+            self._image_cache.forget(image['Id'])
+            self._unpublish_image(image['Id'])
+            print('removed image {}'.format(image['RepoTags'][0]))
 
     def _check_for_batches(self):
         """
@@ -717,6 +1041,8 @@ class ClientProxy:
         ClientProxy.
         First all docker images are pulled, which are used to process these batches. Afterwards the batch processing is
         run. The state in the database for these batches is then updated to 'processing'.
+        If max_running_batches is configured for this node, only as many batches are started as there are free slots.
+        The remaining batches stay scheduled and are started in a later cycle.
 
         :raise TrusteeServiceError: If the trustee service is unavailable or the trustee service could not fulfill all
         requested keys
@@ -729,13 +1055,29 @@ class ClientProxy:
             'node': self._node_name
         }
 
+        # pooled batches waiting for a pool worker are still scheduled, but must not be started again
+        with self._pooled_batches_lock:
+            queued_pooled_batches = list(self._queued_pooled_batches)
+        if queued_pooled_batches:
+            query['_id'] = {'$nin': [ObjectId(_id) for _id in queued_pooled_batches]}
+
+        cursor = self._mongo.db['batches'].find(query).sort('_id', pymongo.ASCENDING)
+
+        # admission control
+        if self._max_running_batches is not None:
+            num_processing = self._mongo.db['batches'].count({'state': 'processing', 'node': self._node_name})
+            free_slots = self._max_running_batches - num_processing - len(queued_pooled_batches)
+            if free_slots <= 0:
+                return
+            cursor = cursor.limit(free_slots)
+
         # list containing batches that are scheduled to this node and save them together with their experiment
         batches_with_experiments = []  # type: List[Tuple[Dict, Dict]]
 
         # dictionary, that maps docker image authentications to batches, which need this docker image
         image_to_batches = {}  # type: Dict[Tuple, List[Dict]]
 
-        for batch in self._mongo.db['batches'].find(query):
+        for batch in cursor:
             experiment = self._get_experiment_with_secrets(batch['experimentId'])
             batches_with_experiments.append((batch, experiment))
 
@@ -745,14 +1087,23 @@ class ClientProxy:
             image_to_batches[image_authentication].append(batch)
 
         # pull images
-        pull_futures = []
+        pull_start = time.time()
+        pull_futures = []  # type: List[Tuple[concurrent.futures.Future, str, Tuple, List[Dict]]]
         for image_authentication, depending_batches in image_to_batches.items():
             image_url, auth = image_authentication
-            future = self._pull_executor.submit(_pull_image, self._client, image_url, auth, depending_batches)
-            pull_futures.append(future)
+            future = self._image_cache.pull(self._client, image_url, auth)
+            pull_futures.append((future, image_url, auth, depending_batches))
+
+        # maps batch ids to the pull span of their image. The futures are waited for in order, so a pull span may end
+        # later than the pull itself, if an earlier pull took longer.
+        pull_spans = {}  # type: Dict[str, list]
+        for pull_future, image_url, auth, depending_batches in pull_futures:
+            successful, debug_info, image = pull_future.result()
+            image_pull_result = ImagePullResult(image_url, auth, successful, debug_info, depending_batches)
 
-        for pull_future in pull_futures:
-            image_pull_result = pull_future.result()  # type: ImagePullResult
+            pull_span = trace_span(SPAN_PULL, pull_start)
+            for batch in depending_batches:
+                pull_spans[str(batch['_id'])] = pull_span
 
             # If pulling failed, the batches, which needed this image fail and are removed from the
             # batches_with_experiments list
@@ -760,13 +1111,15 @@ class ClientProxy:
                 for batch in image_pull_result.depending_batches:
                     # fail the batch
                     batch_id = str(batch['_id'])
-                    self._pull_image_failure(image_pull_result.debug_info, batch_id, batch['state'])
+                    self._pull_image_failure(image_pull_result.debug_info, batch_id, batch['state'], pull_span)
 
                     # remove batches that are failed
                     batches_with_experiments = list(filter(
                         lambda batch_with_experiment: str(batch_with_experiment[0]['_id']) != batch_id,
                         batches_with_experiments
                     ))
+            elif image is not None:
+                self._publish_image(image)
 
         # run every batch, that has not failed
         run_futures = []  # type: List[concurrent.futures.Future]
@@ -775,7 +1128,8 @@ class ClientProxy:
                 ClientProxy._run_batch_container_and_handle_exceptions,
                 self,
                 batch,
-                experiment
+                experiment,
+                pull_spans[str(batch['_id'])]
             )
             run_futures.append(future)
 
@@ -847,7 +1201,7 @@ class ClientProxy:
 
         return image_url, image_auth
 
-    def _run_batch_container_and_handle_exceptions(self, batch, experiment):
+    def _run_batch_container_and_handle_exceptions(self, batch, experiment, pull_span):
         """
         Runs the given batch by calling _run_batch_container(), but handles exceptions, by calling
         _run_batch_container_failure().
@@ -856,25 +1210,66 @@ class ClientProxy:
         :type batch: dict
         :param experiment: The experiment of this batch
         :type experiment: dict
+        :param pull_span: The span of pulling the image of this batch
+        :type pull_span: list
         """
         try:
-            self._run_batch_container(batch, experiment)
+            self._run_batch_container(batch, experiment, pull_span)
         except Exception as e:
             batch_id = str(batch['_id'])
             self._run_batch_container_failure(batch_id, str(e), batch['state'])
 
-    def _run_batch_container(self, batch, experiment):
+    def _run_batch_container(self, batch, experiment, pull_span):
         """
         Creates a docker container and runs the given batch, with settings described in the given batch and experiment.
-        Sets the state of the given batch to 'processing'.
+        Sets the state of the given batch to 'processing'. Batches, that reuse containers, are queued for a pool worker
+        and stay scheduled, until a pool worker picks them up.
 
         :param batch: The batch to run
         :type batch: dict
         :param experiment: The experiment of this batch
         :type experiment: dict
+        :param pull_span: The span of pulling the image of this batch, which is pushed to the trace of the batch
+        :type pull_span: list
         """
         batch_id = str(batch['_id'])
 
+        if ClientProxy._reuses_containers(batch, experiment):
+            with self._pooled_batches_lock:
+                self._queued_pooled_batches.add(batch_id)
+
+            self._pool_executor.submit(
+                ClientProxy._run_pooled_batch_and_handle_exceptions,
+                self,
+                batch,
+                experiment,
+                pull_span
+            )
+            return
+
+        # only run the docker container, if the batch was successfully updated
+        if not self._set_processing(batch_id, pull_span, False):
+            return
+
+        container_start = time.time()
+        with _RUN_CONTAINER_SECONDS.time(node=self._node_name):
+            self._run_container(batch, experiment)
+        self._push_trace_spans(batch_id, [trace_span(SPAN_CONTAINER_START, container_start)])
+
+    def _set_processing(self, batch_id, pull_span, pooled):
+        """
+        Sets the state of the given batch from 'scheduled' to 'processing'.
+
+        :param batch_id: The id of the batch to update
+        :type batch_id: str
+        :param pull_span: The span of pulling the image of this batch, which is pushed to the trace of the batch
+        :type pull_span: list
+        :param pooled: Whether the batch is executed in a pooled container
+        :type pooled: bool
+        :return: True, if the batch was updated, False if the batch is not scheduled anymore, e.g. because it was
+                 cancelled
+        :rtype: bool
+        """
         update_result = self._mongo.db['batches'].update_one(
             {
                 '_id': ObjectId(batch_id),
@@ -883,6 +1278,7 @@ class ClientProxy:
             {
                 '$set': {
                     'state': 'processing',
+                    'pooled': pooled
                 },
                 '$push': {
                     'history': {
@@ -892,14 +1288,372 @@ class ClientProxy:
                         'node': self._node_name,
                         'ccagent': None,
                         'dockerStats': None
-                    }
+                    },
+                    'trace': pull_span
+                },
+                '$inc': {
+                    'version': 1
                 }
             }
         )
 
-        # only run the docker container, if the batch was successfully updated
-        if update_result.modified_count == 1:
-            self._run_container(batch, experiment)
+        return update_result.modified_count == 1
+
+    def _push_trace_spans(self, batch_id, trace_spans):
+        """
+        Pushes the given spans to the trace of the given batch, for spans that do not end with a state transition.
+
+        :param batch_id: The id of the batch to trace
+        :type batch_id: str
+        :param trace_spans: The spans to push
+        :type trace_spans: List[list]
+        """
+        self._mongo.db['batches'].update_one(
+            {'_id': ObjectId(batch_id)},
+            {'$push': {'trace': {'$each': trace_spans}}}
+        )
+
+    @staticmethod
+    def _reuses_containers(batch, experiment):
+        """
+        Returns whether the given batch is executed in a pooled container.
+
+        :param batch: The batch to run
+        :type batch: dict
+        :param experiment: The experiment of this batch
+        :type experiment: dict
+        :return: True, if the experiment enables reuseContainers and the batch neither uses GPUs nor FUSE mounts
+        :rtype: bool
+        """
+        if batch['usedGPUs'] or batch['mount']:
+            return False
+
+        return bool(experiment.get('execution', {}).get('settings', {}).get('reuseContainers'))
+
+    def _get_container_pool(self, experiment_id):
+        """
+        Returns the container pool of the given experiment on this node. The pool is created, if it does not exist.
+
+        :param experiment_id: The experiment id
+        :type experiment_id: str
+        :return: The container pool of the given experiment
+        :rtype: ContainerPool
+        """
+        with self._container_pools_lock:
+            container_pool = self._container_pools.get(experiment_id)
+            if container_pool is None:
+                container_pool = ContainerPool(experiment_id)
+                self._container_pools[experiment_id] = container_pool
+            return container_pool
+
+    def _acquire_pooled_container(self, experiment):
+        """
+        Returns a running idle container from the pool of the given experiment. If no container is idle, a new pooled
+        container is created and started.
+
+        :param experiment: The experiment of the batch to execute
+        :type experiment: dict
+        :return: A tuple (container_pool, container)
+        :rtype: Tuple[ContainerPool, Container]
+
+        :raise DockerException: If the connection to the docker daemon is broken
+        """
+        container_pool = self._get_container_pool(str(experiment['_id']))
+
+        container = container_pool.acquire()
+        while container is not None:
+            try:
+                container.reload()
+                if container.status == 'running':
+                    return container_pool, container
+                container.remove(force=True)
+            except NotFound:
+                pass
+            container_pool.discard()
+            container = container_pool.acquire()
+
+        try:
+            container_spec = dict(self._get_container_spec(experiment), command=POOL_CONTAINER_COMMAND)
+
+            container = create_container_with_gpus(
+                client=self._client,
+                available_runtimes=self._runtimes,
+                name=pool_container_name(container_pool.experiment_id),
+                environment=dict(self._environment or {}),
+                **container_spec
+            )  # type: Container
+
+            # copy blue agent to container
+            with _batch_archive_builder.create_base() as tar_archive:
+                container.put_archive('/', tar_archive)
+
+            container.start()
+        except Exception:
+            container_pool.discard()
+            raise
+
+        return container_pool, container
+
+    def _run_pooled_batch_and_handle_exceptions(self, batch, experiment, pull_span):
+        """
+        Sets the given batch to 'processing' and runs it by calling _run_pooled_batch(), but handles exceptions, by
+        calling _run_batch_container_failure().
+
+        :param batch: The batch to run, which is in state scheduled
+        :type batch: dict
+        :param experiment: The experiment of this batch
+        :type experiment: dict
+        :param pull_span: The span of pulling the image of this batch
+        :type pull_span: list
+        """
+        batch_id = str(batch['_id'])
+
+        try:
+            processing = self._set_processing(batch_id, pull_span, True)
+
+            with self._pooled_batches_lock:
+                self._queued_pooled_batches.discard(batch_id)
+
+            if processing:
+                batch = dict(batch, state='processing')
+                self._run_pooled_batch(batch, experiment)
+        except Exception as e:
+            self._run_batch_container_failure(batch_id, str(e), batch['state'])
+        finally:
+            with self._pooled_batches_lock:
+                self._pooled_batches.pop(batch_id, None)
+                self._timed_out_pooled_batches.discard(batch_id)
+                self._queued_pooled_batches.discard(batch_id)
+
+        self._scheduling_event.set()
+
+    def _run_pooled_batch(self, batch, experiment):
+        """
+        Executes the given batch in a pooled container and evaluates the result of the blue agent. The batch is executed
+        in its own working directory, which is removed afterwards, together with the input directories of the batch.
+        Afterwards the container is returned to its pool. Containers of batches, that exceed the pooled execution timeout,
+        are removed by the check for exited containers, which ends the exec of the batch.
+
+        :param batch: The batch to run, which is in state processing
+        :type batch: dict
+        :param experiment: The experiment of this batch
+        :type experiment: dict
+
+        :raise DockerException: If the connection to the docker daemon is broken
+        :raise TimeoutError: If the batch exceeded the pooled execution timeout
+        """
+        batch_id = str(batch['_id'])
+        blue_data = self._create_blue_batch(batch)
+
+        container_start = time.time()
+        container_pool, container = self._acquire_pooled_container(experiment)
+        trace_spans = [trace_span(SPAN_CONTAINER_START, container_start)]
+
+        with self._pooled_batches_lock:
+            self._pooled_batches[batch_id] = (container, time.time() + self._pooled_execution_timeout)
+
+        work_dir = os.path.join(CONTAINER_OUTPUT_DIR, batch_id)
+        tar_archive, blue_file_path = _batch_archive_builder.create_blue_file(blue_data, work_dir)
+
+        try:
+            with tar_archive:
+                container.put_archive('/', tar_archive)
+
+            command = ['python3', CONTAINER_AGENT_PATH, '--outputs', '--debug', blue_file_path]
+            execution_start = time.time()
+            _exit_code, (stdout, stderr) = container.exec_run(
+                command, user='1000:1000', workdir=work_dir, demux=True
+            )
+            harvest_start = time.time()
+            trace_spans.append(trace_span(SPAN_EXECUTION, execution_start, harvest_start))
+
+            cleanup_command = ['rm', '-rf', work_dir] + _blue_input_directories(blue_data)
+            cleanup_result = container.exec_run(cleanup_command, user='1000:1000')
+        except Exception:
+            timed_out = self._unregister_pooled_batch(batch_id)
+            container_pool.discard()
+            ClientProxy._remove_container_quietly(container)
+            if timed_out:
+                raise TimeoutError(self._pooled_execution_timeout_info())
+            raise
+
+        # the container is not returned to the pool, if it is removed because of the timeout
+        if self._unregister_pooled_batch(batch_id):
+            container_pool.discard()
+            ClientProxy._remove_container_quietly(container)
+            raise TimeoutError(self._pooled_execution_timeout_info())
+
+        if cleanup_result.exit_code == 0:
+            container_pool.release(container)
+        else:
+            container_pool.discard()
+            ClientProxy._remove_container_quietly(container)
+
+        stdout_logs = (stdout or b'').decode('utf-8')
+        stderr_logs = (stderr or b'').decode('utf-8')
+        self._process_agent_result(batch, stdout_logs, stderr_logs, None, harvest_start, trace_spans)
+
+    def _unregister_pooled_batch(self, batch_id):
+        """
+        Removes the given batch from the pooled batches in execution, so its container is not removed because of the
+        pooled execution timeout anymore.
+
+        :param batch_id: The id of the pooled batch
+        :type batch_id: str
+        :return: True, if the container of the batch was removed, because the batch exceeded the pooled execution
+                 timeout
+        :rtype: bool
+        """
+        with self._pooled_batches_lock:
+            self._pooled_batches.pop(batch_id, None)
+            timed_out = batch_id in self._timed_out_pooled_batches
+            self._timed_out_pooled_batches.discard(batch_id)
+        return timed_out
+
+    def _pooled_execution_timeout_info(self):
+        return 'The pooled execution of the batch exceeded the timeout of {} seconds on node "{}".'.format(
+            self._pooled_execution_timeout, self._node_name
+        )
+
+    @staticmethod
+    def _remove_container_quietly(container):
+        """
+        Force removes the given container and ignores errors, e.g. if the container was already removed.
+        """
+        try:
+            container.remove(force=True)
+        except (DockerException, ConnectionError):
+            pass
+
+    def _remove_pooled_containers(self, idle_timeout=None):
+        """
+        Removes idle pooled containers.
+
+        :param idle_timeout: If given, only containers of pools, which were not used for idle_timeout seconds, are
+                             removed
+        :type idle_timeout: float or None
+        """
+        with self._container_pools_lock:
+            container_pools = list(self._container_pools.values())
+
+        for container_pool in container_pools:
+            for container in container_pool.drain(idle_timeout):
+                ClientProxy._remove_container_quietly(container)
+
+        with self._container_pools_lock:
+            for experiment_id, container_pool in list(self._container_pools.items()):
+                if container_pool.is_unused():
+                    del self._container_pools[experiment_id]
+
+    def _remove_stale_pooled_containers(self):
+        """
+        Removes all pooled containers of this node, e.g. containers left over from an earlier run of the controller.
+        Batches, that were processed in pooled containers of this node, can not be finished anymore and are failed, so
+        that they are retried, if the experiment allows it.
+        """
+        with self._container_pools_lock:
+            self._container_pools = {}
+
+        try:
+            containers = self._client.containers.list(all=True, filters={'name': POOL_CONTAINER_PREFIX})
+        except (DockerException, ConnectionError) as e:
+            self._log('Failed to list pooled containers:\n{}'.format(repr(e)))
+            return
+
+        for container in containers:
+            if container.name.startswith(POOL_CONTAINER_PREFIX):
+                ClientProxy._remove_container_quietly(container)
+
+        cursor = self._mongo.db['batches'].find(
+            {'node': self._node_name, 'state': 'processing', 'pooled': True},
+            {'state': 1}
+        )
+
+        for batch in cursor:
+            debug_info = 'Pooled container of node "{}" was removed, while processing the batch.'.format(
+                self._node_name
+            )
+            batch_failure(self._mongo, str(batch['_id']), debug_info, None, batch['state'])
+
+    def _get_container_spec(self, experiment):
+        """
+        Returns the arguments for the creation of docker containers on this node, which are equal for all batches of
+        the given experiment. The arguments are computed once per experiment and cached.
+
+        :param experiment: The experiment with filled secrets
+        :type experiment: Dict[str, Any]
+        :return: A dictionary containing keyword arguments for create_container_with_gpus(). This dictionary must not
+                 be modified.
+        :rtype: Dict[str, Any]
+        """
+        experiment_id = str(experiment['_id'])
+
+        with self._container_specs_lock:
+            container_spec = self._container_specs.get(experiment_id)
+            if container_spec is not None:
+                self._container_specs.move_to_end(experiment_id)
+                return container_spec
+
+        ram = experiment['container']['settings']['ram']
+        mem_limit = '{}m'.format(ram)
+
+        # limit cpu time via the completely fair scheduler quota of the docker engine
+        nano_cpus = None
+        cpus = experiment['container']['settings'].get('cpus')
+        if cpus is not None:
+            nano_cpus = int(cpus * NANO_CPUS_PER_CPU)
+
+        container_spec = {
+            'image': experiment['container']['settings']['image']['url'],
+            'command': [
+                'python3',
+                CONTAINER_AGENT_PATH,
+                '--outputs',
+                '--debug',
+                CONTAINER_BLUE_FILE_PATH
+            ],
+            'user': '1000:1000',
+            'working_dir': CONTAINER_OUTPUT_DIR,
+            'detach': True,
+            'mem_limit': mem_limit,
+            'memswap_limit': mem_limit,
+            'nano_cpus': nano_cpus,
+            'network': self._network,
+            'ulimits': [
+                docker.types.Ulimit(
+                    name='nofile',
+                    soft=NOFILE_LIMIT,
+                    hard=NOFILE_LIMIT
+                )
+            ]
+        }
+
+        with self._container_specs_lock:
+            self._container_specs[experiment_id] = container_spec
+            if len(self._container_specs) > CONTAINER_SPEC_CACHE_SIZE:
+                self._container_specs.popitem(last=False)
+
+        return container_spec
+
+    def _remove_existing_container(self, name):
+        """
+        Removes the container with the given name, if it exists.
+
+        :param name: The name of the container to remove
+        :type name: str
+
+        :raise DockerException: If the connection to the docker daemon is broken
+        """
+        try:
+            existing_container = self._client.containers.get(name)
+        except NotFound:
+            return
+        except ConnectionError as e:
+            raise DockerException(
+                'Could not get container "{}". Failed with the following message:\n{}'.format(name, str(e))
+            )
+
+        existing_container.remove(force=True)
 
     def _run_container(self, batch, experiment):
         """
@@ -921,12 +1675,13 @@ class ClientProxy:
         """
         batch_id = str(batch['_id'])
 
+        container_spec = self._get_container_spec(experiment)
+
+        # the environment is copied, because gpu variables are added to it
         environment = {}
         if self._environment:
             environment = self._environment.copy()
 
-        gpus = batch['usedGPUs']
-
         # set mount variables
         devices = []
         capabilities = []
@@ -936,52 +1691,19 @@ class ClientProxy:
             capabilities.append('SYS_ADMIN')
             security_opt.append('apparmor:unconfined')
 
-        # set image
-        image = experiment['container']['settings']['image']['url']
-
-        command = [
-            'python3',
-            CONTAINER_AGENT_PATH,
-            '--outputs',
-            '--debug',
-            CONTAINER_BLUE_FILE_PATH
-        ]
-
-        ram = experiment['container']['settings']['ram']
-        mem_limit = '{}m'.format(ram)
-
-        # set ulimits
-        ulimits = [
-            docker.types.Ulimit(
-                name='nofile',
-                soft=NOFILE_LIMIT,
-                hard=NOFILE_LIMIT
-            )
-        ]
-
         # remove container if it exists from earlier attempt
-        existing_container = self._batch_containers(None).get(batch_id)
-        if existing_container is not None:
-            existing_container.remove(force=True)
+        self._remove_existing_container(batch_id)
 
         container = create_container_with_gpus(
             client=self._client,
-            image=image,
-            command=command,
             available_runtimes=self._runtimes,
             name=batch_id,
-            user='1000:1000',
-            working_dir=CONTAINER_OUTPUT_DIR,
-            detach=True,
-            mem_limit=mem_limit,
-            memswap_limit=mem_limit,
-            gpus=gpus,
+            gpus=batch['usedGPUs'],
             environment=environment,
-            network=self._network,
             devices=devices,
             cap_add=capabilities,
             security_opt=security_opt,
-            ulimits=ulimits
+            **container_spec
         )  # type: Container
 
         # copy blue agent and blue file to container
@@ -992,7 +1714,9 @@ class ClientProxy:
 
     def _create_blue_batch(self, batch):
         """
-        Creates a dictionary containing the data for a blue batch.
+        Creates a dictionary containing the data for a blue batch. Batches contain the blue batch without secrets, as
+        rendered by the broker at registration time, so that only the secrets are filled in. Batches registered before
+        blue batches were rendered at registration time are converted with convert_red_to_blue.
 
         :param batch: The batch description
         :type batch: dict
@@ -1003,7 +1727,7 @@ class ClientProxy:
         """
         batch_id = str(batch['_id'])
         batch_secret_keys = get_batch_secret_keys(batch)
-        response = self._trustee_client.collect(batch_secret_keys)
+        response = self._trustee_client.collect(batch_secret_keys, namespace=batch.get('secretsNamespace'))
 
         if response['state'] == 'failed':
             debug_info = 'Trustee service failed:\n{}'.format(response['debug_info'])
@@ -1019,6 +1743,11 @@ class ClientProxy:
             raise TrusteeServiceError(debug_info)
 
         batch_secrets = response['secrets']
+
+        blue_batch = batch.get('blueBatch')
+        if blue_batch is not None:
+            return fill_blue_batch_secrets(json.loads(blue_batch), batch_secrets)
+
         batch = fill_batch_secrets(batch, batch_secrets)
 
         experiment_id = batch['experimentId']
@@ -1049,17 +1778,17 @@ class ClientProxy:
         :param batch: The data to put into the blue file of the returned archive
         :type batch: dict
         :return: A tar archive containing the blue agent and the given blue batch
-        :rtype: io.BytesIO or bytes
+        :rtype: io.BytesIO
         """
         blue_data = self._create_blue_batch(batch)
 
-        return create_batch_archive(blue_data)
+        return _batch_archive_builder.create(blue_data)
 
     def _run_batch_container_failure(self, batch_id, debug_info, current_state):
         batch_failure(self._mongo, batch_id, debug_info, None, current_state)
 
-    def _pull_image_failure(self, debug_info, batch_id, current_state):
-        batch_failure(self._mongo, batch_id, debug_info, None, current_state)
+    def _pull_image_failure(self, debug_info, batch_id, current_state, pull_span):
+        batch_failure(self._mongo, batch_id, debug_info, None, current_state, trace_spans=[pull_span])
 
     def _has_nvidia_gpus(self):
         """
@@ -1074,6 +1803,66 @@ class ClientProxy:
         return any(map(lambda gpu: gpu.vendor == NVIDIA_GPU_VENDOR, self._gpus))
 
 
+def _parse_docker_time(value):
+    """
+    Converts a time reported by docker into a unix timestamp.
+
+    :param value: A time in the format of _DOCKER_TIME_PATTERN
+    :type value: str
+    :return: The unix timestamp or None, if the time could not be parsed
+    :rtype: float or None
+    """
+    match = _DOCKER_TIME_PATTERN.match(value or '')
+    if match is None:
+        return None
+
+    seconds, fraction = match.groups()
+    timestamp = calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S'))
+    if fraction:
+        timestamp += float('0' + fraction)
+    return timestamp
+
+
+def _container_execution_span(container):
+    """
+    Creates the execution span of the given exited container from the start and finish times reported by docker.
+
+    :param container: An exited container
+    :type container: Container
+    :return: The execution span or None, if docker did not report valid times
+    :rtype: list or None
+    """
+    state = container.attrs.get('State', {})
+    started_at = _parse_docker_time(state.get('StartedAt'))
+    finished_at = _parse_docker_time(state.get('FinishedAt'))
+
+    if started_at is None or finished_at is None:
+        return None
+
+    return trace_span(SPAN_EXECUTION, started_at, finished_at)
+
+
+def _blue_input_directories(blue_data):
+    """
+    Returns the directories inside the container, which are created for the inputs of the given blue batch.
+
+    :param blue_data: The blue batch
+    :type blue_data: dict
+    :return: A list of absolute directory paths below the inputs directory
+    :rtype: List[str]
+    """
+    directories = []
+    for input_value in blue_data.get('inputs', {}).values():
+        input_values = input_value if isinstance(input_value, list) else [input_value]
+        for value in input_values:
+            if not isinstance(value, dict) or not value.get('path'):
+                continue
+            directory = os.path.dirname(value['path'])
+            if directory.startswith(CONTAINER_INPUT_DIR + '/'):
+                directories.append(directory)
+    return directories
+
+
 class TrusteeServiceError(Exception):
     pass
 
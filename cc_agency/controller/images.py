@@ -0,0 +1,265 @@
+import concurrent.futures
+from threading import RLock
+from time import time
+from typing import Dict, Set
+
+from docker.errors import ImageNotFound
+
+from cc_agency.commons.metrics import REGISTRY
+
+DEFAULT_REGISTRY = 'docker.io'
+DEFAULT_TAG = 'latest'
+
+PULL_POLICY_ALWAYS = 'always'
+PULL_POLICY_IF_NOT_PRESENT = 'if-not-present'
+PULL_POLICY_REFRESH_AFTER_TTL = 'refresh-after-ttl'
+DEFAULT_PULL_TTL = 3600
+
+_IMAGE_PULL_SECONDS = REGISTRY.histogram(
+    'ccagency_controller_image_pull_seconds',
+    'Duration of pulling or inspecting docker images, if required by the pull policy.'
+)
+
+
+def normalize_image_url(image_url):
+    """
+    Returns the given image url in its fully qualified form, so that different notations of the same image can be
+    compared. For example "busybox" and "docker.io/library/busybox:latest" are both normalized to
+    "docker.io/library/busybox:latest".
+
+    :param image_url: The image url to normalize
+    :type image_url: str
+    :return: The normalized image url
+    :rtype: str
+    """
+    name, separator, digest = image_url.partition('@')
+
+    components = name.split('/')
+    if len(components) > 1 and ('.' in components[0] or ':' in components[0] or components[0] == 'localhost'):
+        registry = components[0]
+        components = components[1:]
+    else:
+        registry = DEFAULT_REGISTRY
+
+    if registry == 'index.docker.io':
+        registry = DEFAULT_REGISTRY
+
+    if registry == DEFAULT_REGISTRY and len(components) == 1:
+        components = ['library'] + components
+
+    if not separator and ':' not in components[-1]:
+        components[-1] = '{}:{}'.format(components[-1], DEFAULT_TAG)
+
+    return '{}/{}{}{}'.format(registry, '/'.join(components), separator, digest)
+
+
+def split_image_url(image_url):
+    """
+    Splits the given image url into repository and tag. The tag defaults to "latest". If the image url contains a digest,
+    the digest (e.g. "sha256:...") is returned as tag.
+
+    :param image_url: The image url to split
+    :type image_url: str
+    :return: A tuple (repository, tag)
+    :rtype: Tuple[str, str]
+    """
+    normalized = normalize_image_url(image_url)
+
+    repository, separator, digest = normalized.partition('@')
+    if separator:
+        return repository, digest
+
+    repository, _, tag = normalized.rpartition(':')
+    return repository, tag
+
+
+def image_inventory_entry(image):
+    """
+    Creates the entry of the given image in the image inventory of a node document.
+
+    :param image: The docker image
+    :type image: docker.models.images.Image
+    :return: A dictionary containing the normalized urls and the size of the given image
+    :rtype: dict
+    """
+    return {
+        'urls': [normalize_image_url(tag) for tag in image.tags],
+        'size': image.attrs.get('Size')
+    }
+
+
+def image_inventory_key(image_id):
+    """
+    Returns the key of the given image in the image inventory of a node document.
+
+    :param image_id: The id of a docker image given as digest (e.g. "sha256:...")
+    :type image_id: str
+    :return: The key under which the image is stored in the "images" field of a node document
+    :rtype: str
+    """
+    return 'images.{}'.format(image_id)
+
+
+class ImageCacheEntry:
+    """
+    Describes the state of a docker image on a node as known by an ImageCache.
+    """
+
+    def __init__(self, digest, present, last_pull):
+        """
+        :param digest: The id of the image given as digest (e.g. "sha256:...")
+        :type digest: str or None
+        :param present: Whether the image is present on the node
+        :type present: bool
+        :param last_pull: The unix timestamp of the last successful pull or None, if the image was never pulled by this
+                          cache
+        :type last_pull: float or None
+        """
+        self.digest = digest
+        self.present = present
+        self.last_pull = last_pull
+
+
+class ImageCache:
+    """
+    Pulls docker images for one node and remembers which images are present on this node, to avoid registry round trips
+    for images that do not need to be pulled again according to the configured pull policy.
+    Concurrent requests for the same image share one pull.
+
+    Pull policies:
+      always: Every request pulls the image from the registry.
+      if-not-present: The image is only pulled, if it is not present on the node.
+      refresh-after-ttl: The image is pulled, if it is not present or if the last successful pull is older than the
+                         pull ttl.
+    """
+
+    def __init__(self, executor, pull_policy=None, pull_ttl=None):
+        """
+        :param executor: The executor used to run pulls
+        :type executor: concurrent.futures.Executor
+        :param pull_policy: One of "always", "if-not-present" or "refresh-after-ttl". Defaults to "always".
+        :type pull_policy: str or None
+        :param pull_ttl: The number of seconds after which an image is pulled again with the "refresh-after-ttl" policy
+        :type pull_ttl: float or None
+        """
+        self._executor = executor
+        self._pull_policy = pull_policy or PULL_POLICY_ALWAYS
+        self._pull_ttl = DEFAULT_PULL_TTL if pull_ttl is None else pull_ttl
+
+        self._lock = RLock()
+        self._entries = {}  # type: Dict[str, ImageCacheEntry]
+        self._in_flight = {}  # type: Dict[str, concurrent.futures.Future]
+        # in flight pulls, that run in another executor than the executor of this cache, e.g. prefetches
+        self._background_pulls = set()  # type: Set[concurrent.futures.Future]
+
+    def pull(self, docker_client, image_url, auth, executor=None):
+        """
+        Makes sure the given image is present on the node according to the pull policy of this cache.
+
+        :param docker_client: The docker client of the node
+        :type docker_client: docker.DockerClient
+        :param image_url: The image to pull
+        :type image_url: str
+        :param auth: A tuple containing (username, password) or None
+        :type auth: Tuple[str, str] or None
+        :param executor: The executor to run the pull in. If None the executor of this cache is used. Pulls in another
+                         executor are background pulls. A background pull, that has not started yet, is cancelled and
+                         replaced, if the same image is pulled with the executor of this cache, so the pull does not wait
+                         behind queued background pulls.
+        :type executor: concurrent.futures.Executor or None
+        :return: A future resolving to a tuple (successful, debug_info, image). debug_info is a list of strings
+                 describing the error if the pull failed, otherwise None. image is the docker image, if it was pulled
+                 or inspected, or None if the cached state was used.
+        :rtype: concurrent.futures.Future
+        """
+        key = normalize_image_url(image_url)
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                if executor is not None or future not in self._background_pulls or not future.cancel():
+                    return future
+
+            if not self._pull_required(self._entries.get(key)):
+                future = concurrent.futures.Future()
+                future.set_result((True, None, None))
+                return future
+
+            future = (executor or self._executor).submit(self._pull, docker_client, image_url, auth, key)
+            self._in_flight[key] = future
+            if executor is not None:
+                self._background_pulls.add(future)
+            future.add_done_callback(lambda f: self._pull_done(key, f))
+
+        return future
+
+    def forget(self, digest):
+        """
+        Marks the image with the given digest as not present, e.g. because it was removed from the node.
+
+        :param digest: The id of the image given as digest
+        :type digest: str
+        """
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.digest == digest:
+                    entry.present = False
+
+    def _pull_done(self, key, future):
+        with self._lock:
+            self._background_pulls.discard(future)
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _pull_required(self, entry):
+        if self._pull_policy == PULL_POLICY_ALWAYS:
+            return True
+
+        if entry is None or not entry.present:
+            return True
+
+        if self._pull_policy == PULL_POLICY_REFRESH_AFTER_TTL:
+            return entry.last_pull is None or entry.last_pull + self._pull_ttl < time()
+
+        return False
+
+    @_IMAGE_PULL_SECONDS.time()
+    def _pull(self, docker_client, image_url, auth, key):
+        """
+        Pulls the given image, if required. With the "if-not-present" policy the image is only inspected, if it is
+        already present on the node.
+
+        The image is pulled with an explicit tag, because docker-py returns a list of images for pulls without tag.
+        Afterwards the pulled image is resolved by its normalized url, so that callers always get a single image.
+        """
+        try:
+            if self._pull_policy == PULL_POLICY_IF_NOT_PRESENT:
+                try:
+                    image = docker_client.images.get(key)
+                    self._update_entry(key, image, None)
+                    return True, None, image
+                except ImageNotFound:
+                    pass
+
+            repository, tag = split_image_url(image_url)
+            docker_client.images.pull(repository, tag=tag, auth_config=auth)
+            image = docker_client.images.get(key)
+
+            self._update_entry(key, image, time())
+        except Exception as e:
+            debug_info = str(e).split('\n')
+            return False, debug_info, None
+
+        return True, None, image
+
+    def _update_entry(self, key, image, last_pull):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = ImageCacheEntry(image.id, True, last_pull)
+                return
+
+            entry.digest = image.id
+            entry.present = True
+            if last_pull is not None:
+                entry.last_pull = last_pull
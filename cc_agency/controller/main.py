@@ -5,13 +5,16 @@ from pprint import pprint
 
 import zmq
 import pymongo
+from pymongo.errors import OperationFailure
 
 from cc_core.version import VERSION as CORE_VERSION
 from cc_agency.version import VERSION as AGENCY_VERSION
 from cc_agency.commons.conf import Conf
 from cc_agency.commons.db import Mongo
 from cc_agency.commons.secrets import TrusteeClient
+from cc_agency.commons.metrics import start_metrics_server
 from cc_agency.controller.scheduler import Scheduler
+from cc_agency.controller.notifications import NOTIFICATION_RETENTION
 
 
 DESCRIPTION = 'CC-Agency Controller'
@@ -38,14 +41,42 @@ def main():
     mongo.db['batches'].create_index([('notificationsSent', pymongo.ASCENDING)])
     mongo.db['batches'].create_index([('experimentId', pymongo.ASCENDING)])
     mongo.db['batches'].create_index([('username', pymongo.ASCENDING)])
+    # allows the broker to stream sorted listings without sorting all documents first
+    mongo.db['batches'].create_index([('registrationTime', pymongo.ASCENDING)])
+    mongo.db['experiments'].create_index([('registrationTime', pymongo.ASCENDING)])
+    mongo.db['notifications'].create_index([('batchId', pymongo.ASCENDING)], unique=True)
+    mongo.db['notifications'].create_index([('delivered', pymongo.ASCENDING)])
+    # removes delivered notifications after the retention
+    notification_retention = conf.d['controller'].get('notification_retention', NOTIFICATION_RETENTION)
+    try:
+        mongo.db['notifications'].create_index(
+            [('deliveredAt', pymongo.ASCENDING)], expireAfterSeconds=notification_retention
+        )
+    except OperationFailure:
+        # the index exists with another retention
+        mongo.db.command(
+            'collMod', 'notifications',
+            index={'keyPattern': {'deliveredAt': 1}, 'expireAfterSeconds': notification_retention}
+        )
 
     print('MongoDB Indexes:')
-    pprint(list(mongo.db['experiments'].list_indexes()) + list(mongo.db['batches'].list_indexes()))
+    pprint(
+        list(mongo.db['experiments'].list_indexes()) +
+        list(mongo.db['batches'].list_indexes()) +
+        list(mongo.db['notifications'].list_indexes())
+    )
 
     # Singletons
     trustee_client = TrusteeClient(conf)
     scheduler = Scheduler(conf, mongo, trustee_client)
 
+    # Prometheus metrics
+    metrics_conf = conf.d['controller'].get('metrics')
+    if metrics_conf is not None:
+        metrics_host = metrics_conf.get('host', '127.0.0.1')
+        start_metrics_server(metrics_host, metrics_conf['port'])
+        print('Metrics endpoint: http://{}:{}/metrics'.format(metrics_host, metrics_conf['port']))
+
     # ZeroMQ socket
     bind_socket_path = os.path.expanduser(conf.d['controller']['bind_socket_path'])
     bind_socket_dir, _ = os.path.split(bind_socket_path)
@@ -0,0 +1,245 @@
+import os
+import sys
+import concurrent.futures
+from datetime import datetime
+from threading import Lock
+from time import time
+from typing import Dict
+
+import requests
+from pymongo.errors import BulkWriteError
+
+NOTIFICATION_CHUNK_SIZE = 500
+NOTIFICATION_TIMEOUT = 10
+NOTIFICATION_BACKOFF_BASE = 5
+NOTIFICATION_BACKOFF_MAX = 3600
+MAX_CONCURRENT_HOOKS = 8
+# seconds delivered notifications are kept in the outbox, before they are removed by a ttl index
+NOTIFICATION_RETENTION = 7 * 24 * 3600
+
+# mongodb error code of duplicate key errors
+_DUPLICATE_KEY_ERROR = 11000
+
+
+def hook_key(hook):
+    """
+    Identifies a notification hook, to key its backoff and its cursor. Hooks without id are identified by their url only,
+    so several hooks with the same url need different ids.
+
+    :param hook: The hook as given in the agency config
+    :type hook: dict
+    :return: The key of the given hook
+    :rtype: str
+    """
+    hook_id = hook.get('id')
+    if hook_id is None:
+        return hook['url']
+    return '{}#{}'.format(hook_id, hook['url'])
+
+
+class HookBackoff:
+    """
+    Remembers consecutive delivery failures of a notification hook, to delay retries exponentially.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def is_due(self):
+        return self.next_attempt <= time()
+
+    def failed(self):
+        self.failures += 1
+        delay = min(NOTIFICATION_BACKOFF_BASE * 2 ** (self.failures - 1), NOTIFICATION_BACKOFF_MAX)
+        self.next_attempt = time() + delay
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.next_attempt = 0.0
+
+
+class NotificationOutbox:
+    """
+    Delivers notifications about finished batches to the notification hooks of the agency config.
+
+    Finished batches are first written to the persistent "notifications" collection (the outbox). Every hook has its own
+    cursor in the "notificationCursors" collection, which holds the id of the last notification delivered to this hook.
+    Notifications are delivered to every hook in the order of their ids in chunks of NOTIFICATION_CHUNK_SIZE. A cursor is
+    only advanced, if the hook accepted the chunk, so notifications are delivered at least once. Hooks are served
+    concurrently and with timeouts, failing hooks are retried with exponential backoff. Notifications are marked as
+    delivered, when all hooks received them, and are removed by a ttl index on "deliveredAt" after the notification
+    retention.
+    """
+
+    def __init__(self, conf, mongo):
+        """
+        :param conf: The agency config
+        :type conf: cc_agency.commons.conf.Conf
+        :param mongo: The mongo client
+        :type mongo: cc_agency.commons.db.Mongo
+        """
+        self._hooks = conf.d['controller'].get('notification_hooks', [])
+        self._mongo = mongo
+
+        hook_keys = [hook_key(hook) for hook in self._hooks]
+        if len(set(hook_keys)) < len(hook_keys):
+            raise ValueError('Notification hooks with the same url must have different ids.')
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_HOOKS)
+        self._backoffs = {}  # type: Dict[str, HookBackoff]
+        self._backoffs_lock = Lock()
+
+    def enqueue_finished_batches(self):
+        """
+        Writes a notification for every finished batch, that was not notified yet, into the outbox and marks these
+        batches as notified.
+        """
+        cursor = self._mongo.db['batches'].find(
+            {
+                'state': {'$in': ['succeeded', 'failed', 'cancelled']},
+                'notificationsSent': False
+            },
+            {'state': 1}
+        )
+
+        timestamp = time()
+        bson_ids = []
+        notifications = []
+
+        for batch in cursor:
+            bson_id = batch['_id']
+            bson_ids.append(bson_id)
+
+            notifications.append({
+                'batchId': str(bson_id),
+                'state': batch['state'],
+                'time': timestamp,
+                'delivered': False
+            })
+
+        if not notifications:
+            return
+
+        # batchId is unique, so notifications written before a crash of the controller are not duplicated
+        try:
+            self._mongo.db['notifications'].insert_many(notifications, ordered=False)
+        except BulkWriteError as e:
+            if any(error['code'] != _DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+                raise
+
+        self._mongo.db['batches'].update_many(
+            {'_id': {'$in': bson_ids}},
+            {'$set': {'notificationsSent': True}, '$inc': {'version': 1}}
+        )
+
+    def deliver(self):
+        """
+        Delivers pending notifications to all hooks, whose backoff delay is over, and marks notifications as delivered,
+        if all hooks received them. Blocks until all deliveries are finished.
+        """
+        futures = [self._executor.submit(self._deliver_to_hook, hook) for hook in self._hooks]
+        concurrent.futures.wait(futures)
+
+        self._mark_delivered()
+
+    def _get_backoff(self, key):
+        with self._backoffs_lock:
+            backoff = self._backoffs.get(key)
+            if backoff is None:
+                backoff = HookBackoff()
+                self._backoffs[key] = backoff
+            return backoff
+
+    def _deliver_to_hook(self, hook):
+        """
+        Delivers the pending notifications of the given hook chunk by chunk and advances the cursor of the hook after
+        every successful chunk. Stops at the first failure.
+
+        :param hook: The hook as given in the agency config
+        :type hook: dict
+        """
+        url = hook['url']
+        key = hook_key(hook)
+        backoff = self._get_backoff(key)
+
+        if not backoff.is_due():
+            return
+
+        auth = hook.get('auth')
+        if auth is not None:
+            auth = (auth['username'], auth['password'])
+
+        hook_cursor = self._mongo.db['notificationCursors'].find_one({'_id': key})
+
+        # a new hook only receives notifications, that were not delivered to all other hooks yet
+        if hook_cursor is None:
+            query = {'delivered': False}
+        else:
+            query = {'_id': {'$gt': hook_cursor['lastId']}}
+
+        while True:
+            notifications = list(
+                self._mongo.db['notifications']
+                .find(query, {'batchId': 1, 'state': 1})
+                .sort('_id', 1)
+                .limit(NOTIFICATION_CHUNK_SIZE)
+            )
+
+            if not notifications:
+                return
+
+            payload = {
+                'batches': [
+                    {'batchId': notification['batchId'], 'state': notification['state']}
+                    for notification in notifications
+                ]
+            }
+
+            try:
+                r = requests.post(url, auth=auth, json=payload, timeout=NOTIFICATION_TIMEOUT)
+                r.raise_for_status()
+            except Exception as e:
+                delay = backoff.failed()
+                debug_info = 'Notification post hook failed, retry in {3:.0f} seconds:{0}{1}{0}{2}'.format(
+                    os.linesep, repr(e), e, delay
+                )
+                print(debug_info, file=sys.stderr)
+                return
+
+            backoff.succeeded()
+
+            last_id = notifications[-1]['_id']
+            self._mongo.db['notificationCursors'].update_one(
+                {'_id': key},
+                {'$set': {'lastId': last_id}},
+                upsert=True
+            )
+            query = {'_id': {'$gt': last_id}}
+
+    def _mark_delivered(self):
+        """
+        Marks all notifications as delivered, that were delivered to all hooks. The delivery time is used as end of the
+        notification span in batch timelines, deliveredAt is the same time as date for the ttl index of the outbox.
+        """
+        query = {'delivered': False}
+
+        if self._hooks:
+            keys = [hook_key(hook) for hook in self._hooks]
+            hook_cursors = list(self._mongo.db['notificationCursors'].find({'_id': {'$in': keys}}))
+
+            if len(hook_cursors) < len(keys):
+                return
+
+            query['_id'] = {'$lte': min(hook_cursor['lastId'] for hook_cursor in hook_cursors)}
+
+        timestamp = time()
+        self._mongo.db['notifications'].update_many(
+            query,
+            {'$set': {
+                'delivered': True,
+                'deliveredTime': timestamp,
+                'deliveredAt': datetime.utcfromtimestamp(timestamp)
+            }}
+        )
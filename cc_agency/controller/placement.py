@@ -0,0 +1,142 @@
+from typing import List
+
+from cc_core.commons.gpu_info import match_gpus, get_gpu_requirements, InsufficientGPUError
+
+from cc_agency.controller.images import normalize_image_url
+
+
+class PlacementStrategy:
+    """
+    A placement strategy decides, which of the nodes sufficient for an experiment a batch is scheduled to.
+    If nodes are otherwise equal, every strategy prefers nodes on which the docker image of the experiment is already
+    present.
+    """
+
+    def select_node(self, nodes, experiment):
+        """
+        Returns the node, that fits best for the given experiment according to this strategy.
+
+        :param nodes: The nodes that are sufficient for the given experiment. This list is never empty.
+        :type nodes: List[CompleteNode]
+        :param experiment: The description of the experiment
+        :type experiment: dict
+        :return: The selected node
+        :rtype: CompleteNode
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def _requires_gpus(experiment):
+        return bool(get_gpu_requirements(experiment['container']['settings'].get('gpus')))
+
+    @staticmethod
+    def _image_missing(node, experiment):
+        """
+        Returns 0 if the docker image of the given experiment is present on the given node, otherwise 1. Intended to be
+        used in sort keys.
+        """
+        image_url = normalize_image_url(experiment['container']['settings']['image']['url'])
+        return 0 if image_url in node.images else 1
+
+    @staticmethod
+    def _prefer_nodes_without_gpus(nodes, experiment):
+        """
+        Returns the nodes without GPUs, if the given experiment does not require GPUs and such nodes exist. Otherwise
+        the given nodes are returned unchanged.
+        """
+        if PlacementStrategy._requires_gpus(experiment):
+            return nodes
+
+        nodes_without_gpus = [node for node in nodes if not node.gpus]
+        if nodes_without_gpus:
+            return nodes_without_gpus
+        return nodes
+
+
+class DefaultStrategy(PlacementStrategy):
+    """
+    Prefers nodes without GPUs, then nodes with few running batches and then nodes with less free ram.
+    """
+
+    def select_node(self, nodes, experiment):
+        nodes = PlacementStrategy._prefer_nodes_without_gpus(nodes, experiment)
+        return min(nodes, key=lambda n: (
+            n.num_batches_running, PlacementStrategy._image_missing(n, experiment), n.ram_available
+        ))
+
+
+class BinPackingStrategy(PlacementStrategy):
+    """
+    Best fit: Selects the node with the least ram left after placing the batch, to pack batches densely and keep whole
+    nodes free for large experiments.
+    """
+
+    def select_node(self, nodes, experiment):
+        nodes = PlacementStrategy._prefer_nodes_without_gpus(nodes, experiment)
+        return min(nodes, key=lambda n: (
+            n.ram_available, PlacementStrategy._image_missing(n, experiment), -n.num_batches_running
+        ))
+
+
+class SpreadStrategy(PlacementStrategy):
+    """
+    Worst fit: Selects the node with the most ram left, to spread batches across the cluster and reduce interference
+    between batches running on the same node.
+    """
+
+    def select_node(self, nodes, experiment):
+        nodes = PlacementStrategy._prefer_nodes_without_gpus(nodes, experiment)
+        return min(nodes, key=lambda n: (
+            -n.ram_available, PlacementStrategy._image_missing(n, experiment), n.num_batches_running
+        ))
+
+
+class GPUTopologyStrategy(PlacementStrategy):
+    """
+    Places GPU experiments on the node, where the fewest GPUs stay unused after placing the batch. If this is equal, a
+    node is preferred, where the matched GPU device ids are adjacent, because adjacent devices usually share the same
+    PCIe switch. Experiments without GPU requirements never use GPU nodes if other nodes are sufficient and are then
+    placed like in the default strategy.
+    """
+
+    def select_node(self, nodes, experiment):
+        if not PlacementStrategy._requires_gpus(experiment):
+            return DefaultStrategy().select_node(nodes, experiment)
+
+        gpu_requirements = get_gpu_requirements(experiment['container']['settings'].get('gpus'))
+
+        def gpu_fit(node):
+            try:
+                matched_gpus = match_gpus(node.gpus_available, gpu_requirements)
+            except InsufficientGPUError:
+                return len(node.gpus_available), 0
+            device_ids = sorted(gpu.device_id for gpu in matched_gpus)
+            spread = device_ids[-1] - device_ids[0] - (len(device_ids) - 1) if device_ids else 0
+            return len(node.gpus_available) - len(matched_gpus), spread
+
+        return min(nodes, key=lambda n: (
+            gpu_fit(n), PlacementStrategy._image_missing(n, experiment), n.num_batches_running, n.ram_available
+        ))
+
+
+PLACEMENT_STRATEGIES = {
+    'default': DefaultStrategy,
+    'bin-packing': BinPackingStrategy,
+    'spread': SpreadStrategy,
+    'gpu-topology': GPUTopologyStrategy
+}
+
+
+def create_placement_strategy(name):
+    """
+    Creates the placement strategy with the given name.
+
+    :param name: The name of the placement strategy as given by the agency config. If None the default strategy is used.
+    :type name: str or None
+    :return: A new placement strategy
+    :rtype: PlacementStrategy
+    """
+    if name is None:
+        name = 'default'
+
+    return PLACEMENT_STRATEGIES[name]()
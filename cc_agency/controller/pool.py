@@ -0,0 +1,122 @@
+"""
+Warm container pools for experiments with the execution setting "reuseContainers".
+
+A pooled container is created once with the image, limits and environment of an experiment and is kept running idle. The
+blue agent is copied into the container at creation time. Batches are fed into idle containers one after another: every
+batch gets its blue file via put_archive and the blue agent is started via exec. The agent result is read from the exec
+output instead of the container logs.
+
+Isolation guarantees of pooled batches:
+- A pooled container is only used by batches of the same experiment, so all batches sharing a container have the same
+  owner, image, ram and cpu limits.
+- A container executes at most one batch at a time.
+- Every batch runs in its own working directory below the outputs directory. The working directory and the input
+  directories of the batch are removed after the batch finished.
+- Files written outside of these directories and processes left running in the background are NOT isolated and are
+  visible to following batches of the same experiment.
+- Batches requiring GPUs or FUSE mounts are never executed in pooled containers.
+- Docker stats are not recorded for pooled batches, because they would describe the whole container lifetime.
+- The execution of a pooled batch is bounded by the pooled_execution_timeout limit of the node. The container of a batch
+  exceeding it is removed and the batch fails.
+
+The throughput gained by reusing containers can be measured with "ccagency benchmark-pool", which compares running
+short commands in fresh containers with running them via exec in a single pooled container.
+"""
+from threading import Lock
+from time import time
+from typing import List
+from uuid import uuid4
+
+from docker.models.containers import Container
+
+POOL_CONTAINER_PREFIX = 'ccpool-'
+POOL_CONTAINER_COMMAND = ['tail', '-f', '/dev/null']
+
+
+class ContainerPool:
+    """
+    Holds the idle pooled containers of one experiment on one node.
+    """
+
+    def __init__(self, experiment_id):
+        """
+        :param experiment_id: The id of the experiment, whose batches are executed by the containers of this pool
+        :type experiment_id: str
+        """
+        self.experiment_id = experiment_id
+        self._idle_containers = []  # type: List[Container]
+        self._num_active = 0
+        self._lock = Lock()
+        self._last_used = time()
+
+    def acquire(self):
+        """
+        Removes an idle container from this pool and returns it. Every call has to be followed by release() or
+        discard(), because the caller either executes a batch in the returned container or in a newly created container,
+        which belongs to this pool.
+
+        :return: An idle container or None, if no container is idle
+        :rtype: Container or None
+        """
+        with self._lock:
+            self._last_used = time()
+            self._num_active += 1
+            if self._idle_containers:
+                return self._idle_containers.pop()
+        return None
+
+    def release(self, container):
+        """
+        Returns the given container to this pool, so that it can execute the next batch.
+
+        :param container: The container, that finished executing a batch
+        :type container: Container
+        """
+        with self._lock:
+            self._last_used = time()
+            self._num_active -= 1
+            self._idle_containers.append(container)
+
+    def discard(self):
+        """
+        Notifies this pool, that an acquired container is not returned, e.g. because it was removed after an error.
+        """
+        with self._lock:
+            self._num_active -= 1
+
+    def is_unused(self):
+        """
+        :return: True, if this pool has neither idle nor active containers
+        :rtype: bool
+        """
+        with self._lock:
+            return not self._idle_containers and self._num_active == 0
+
+    def drain(self, idle_timeout=None):
+        """
+        Removes idle containers from this pool and returns them.
+
+        :param idle_timeout: If given, containers are only removed, if this pool was not used for idle_timeout seconds
+        :type idle_timeout: float or None
+        :return: The removed containers
+        :rtype: List[Container]
+        """
+        with self._lock:
+            if idle_timeout is not None and self._last_used + idle_timeout > time():
+                return []
+
+            containers = self._idle_containers
+            self._idle_containers = []
+            return containers
+
+
+def pool_container_name(experiment_id):
+    """
+    Returns a new unique name for a pooled container.
+
+    :param experiment_id: The experiment id of the pool
+    :type experiment_id: str
+    :return: The container name
+    :rtype: str
+    """
+    return '{}{}-{}'.format(POOL_CONTAINER_PREFIX, experiment_id, uuid4().hex[:12])
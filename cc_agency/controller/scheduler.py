@@ -2,20 +2,47 @@ import os
 import sys
 from threading import Thread, Event
 from time import time, sleep
-from typing import Dict, List
+from typing import Dict, List, Set
 
-import requests
 from bson.objectid import ObjectId
+from pymongo import UpdateOne, ReturnDocument
 
 from cc_core.commons.gpu_info import GPUDevice, match_gpus, get_gpu_requirements, InsufficientGPUError
 from cc_core.commons.red import red_get_mount_connectors_from_inputs
 
 from cc_agency.controller.docker import ClientProxy, fill_experiment_secret_keys
+from cc_agency.controller.placement import create_placement_strategy
+from cc_agency.controller.notifications import NotificationOutbox
+from cc_agency.controller.change_streams import ChangeStreamWatcher, batch_state_pipeline, FINISHED_STATES, \
+    DEFAULT_FALLBACK_INTERVAL
+from cc_agency.controller.images import normalize_image_url
 from cc_agency.commons.helper import batch_failure
+from cc_agency.commons.metrics import REGISTRY
+from cc_agency.commons.tracing import trace_span, SPAN_SCHEDULING
 from cc_agency.commons.secrets import get_experiment_secret_keys
 from cc_agency.commons.secrets import get_batch_secret_keys
 
 _CRON_INTERVAL = 60
+_SCHEDULING_CHUNK_SIZE = 1000
+_VOIDING_REBUILD_GRACE_PERIOD = 60
+
+_SCHEDULE_BATCHES_SECONDS = REGISTRY.histogram(
+    'ccagency_controller_schedule_batches_seconds',
+    'Duration of scheduling passes.'
+)
+_CLUSTER_STATE_SECONDS = REGISTRY.histogram(
+    'ccagency_controller_cluster_state_seconds',
+    'Duration of querying the cluster state.'
+)
+_REGISTERED_BATCHES = REGISTRY.gauge(
+    'ccagency_controller_registered_batches',
+    'Number of registered batches waiting to be scheduled at the start of the last scheduling pass.'
+)
+_NODE_RUNNING_BATCHES = REGISTRY.gauge(
+    'ccagency_controller_node_running_batches',
+    'Number of scheduled and processing batches of a node as seen by the last cluster state query.',
+    ['node']
+)
 
 
 class CompleteNode:
@@ -23,26 +50,40 @@ class CompleteNode:
     Represents a processing node inside a cluster.
     """
 
-    def __init__(self, node_name, online, ram, gpus, ram_available, gpus_available, num_batches_running):
+    def __init__(
+            self, node_name, online, ram, cpus, gpus, ram_available, cpus_available, gpus_available,
+            num_batches_running, max_running_batches=None, images=None
+    ):
         """
         Initialises a new CompleteNode.
 
         :param node_name: The name of the node given by the agency config.
         :param online: Whether the given node is online or not.
         :param ram: The amount of ram of this node.
+        :param cpus: The number of cpus of this node.
         :param gpus: The GPUs that are present on this node. Does include gpus, which are used by batches.
         :param ram_available: The ram that is available. Given by the amount of ram of the node minus the amount of ram
                               used by batches.
+        :param cpus_available: The cpus that are available. Given by the number of cpus of the node minus the cpus
+                               reserved by batches.
         :param gpus_available: The GPUs that are available and not used by batches.
         :param num_batches_running: The number of batches currently running on the node.
+        :param max_running_batches: The maximal number of batches, that are allowed to run on this node at the same
+                                    time. If None the number of batches is not limited.
+        :param images: The normalized urls of the docker images, that are present on this node.
+        :type images: Set[str] or None
         """
         self.node_name = node_name
         self.online = online
         self.ram = ram
+        self.cpus = cpus
         self.gpus = gpus
         self.ram_available = ram_available
+        self.cpus_available = cpus_available
         self.gpus_available = gpus_available
         self.num_batches_running = num_batches_running
+        self.max_running_batches = max_running_batches
+        self.images = images or set()
 
 
 class Scheduler:
@@ -50,6 +91,15 @@ class Scheduler:
         self._conf = conf
         self._mongo = mongo
         self._trustee_client = trustee_client
+        self._placement_strategy = create_placement_strategy(conf.d['controller'].get('placement_strategy'))
+        self._image_prefetch = conf.d['controller']['docker'].get('image_prefetch')
+        self._notification_outbox = NotificationOutbox(conf, mongo)
+
+        # with change streams the cron interval only serves as fallback
+        change_streams = conf.d['controller'].get('change_streams')
+        self._cron_interval = _CRON_INTERVAL
+        if change_streams is not None:
+            self._cron_interval = change_streams.get('fallback_interval', DEFAULT_FALLBACK_INTERVAL)
 
         mongo.db['nodes'].drop()
 
@@ -57,6 +107,11 @@ class Scheduler:
         self._voiding_event = Event()
         self._notification_event = Event()
 
+        self._experiments_to_void = set()  # type: Set[str]
+        # experiments at the head of the queue, whose images were already requested to be prefetched
+        self._prefetched_experiments = set()  # type: Set[str]
+        self._rebuild_voiding_counters()
+
         self._nodes = {
             node_name: ClientProxy(node_name, conf, mongo, trustee_client, self._scheduling_event)
             for node_name
@@ -67,6 +122,16 @@ class Scheduler:
         Thread(target=self._voiding_loop).start()
         Thread(target=self._notification_loop).start()
 
+        # new, retried and finished batches trigger a scheduling cycle
+        if change_streams is not None:
+            ChangeStreamWatcher(
+                mongo,
+                'batches',
+                batch_state_pipeline(['registered'] + FINISHED_STATES),
+                'scheduler',
+                self._scheduling_event.set
+            ).start()
+
     def schedule(self):
         self._scheduling_event.set()
 
@@ -75,95 +140,156 @@ class Scheduler:
             self._notification_event.wait()
             self._notification_event.clear()
 
-            # batches
-            cursor = self._mongo.db['batches'].find(
-                {
-                    'state': {'$in': ['succeeded', 'failed', 'cancelled']},
-                    'notificationsSent': False
-                },
-                {'state': 1}
-            )
+            self._notification_outbox.enqueue_finished_batches()
+            self._notification_outbox.deliver()
 
-            bson_ids = []
-            payload = {'batches': []}
+    def _rebuild_voiding_counters(self, missing_only=False):
+        """
+        Sets the remainingBatches counter of every experiment, whose protected keys are not voided yet, to the number of
+        its batches, whose protected keys are not voided yet. This repairs counters of experiments registered by older
+        versions and counters, which were not decremented, because the controller stopped while voiding a batch.
+        Experiments without any remaining batches are voided by the voiding loop.
+
+        :param missing_only: If True, only experiments without remainingBatches counter are rebuilt. This is done on
+                             every voiding pass, so experiments registered by older versions during the grace period of
+                             the startup rebuild get a counter, too.
+        :type missing_only: bool
+        """
+        # the batches of recently registered experiments might still be inserted by the broker
+        registered_before = time() - _VOIDING_REBUILD_GRACE_PERIOD
 
-            for batch in cursor:
-                bson_id = batch['_id']
-                bson_ids.append(bson_id)
+        query = {'protectedKeysVoided': False, 'registrationTime': {'$lt': registered_before}}
+        if missing_only:
+            query['remainingBatches'] = {'$exists': False}
 
-                payload['batches'].append({
-                    'batchId': str(bson_id),
-                    'state': batch['state']
-                })
+        cursor = self._mongo.db['experiments'].find(query, {'_id': 1})
+        experiment_ids = [str(experiment['_id']) for experiment in cursor]
 
-            self._mongo.db['batches'].update(
-                {'_id': {'$in': bson_ids}},
-                {'$set': {'notificationsSent': True}}
-            )
+        if not experiment_ids:
+            return
+
+        # experiments without any batches have no group in the aggregation
+        remaining_batches_per_experiment = {experiment_id: 0 for experiment_id in experiment_ids}
 
-            notification_hooks = self._conf.d['controller'].get('notification_hooks', [])
+        cursor = self._mongo.db['batches'].aggregate([
+            {'$match': {'experimentId': {'$in': experiment_ids}}},
+            {'$group': {
+                '_id': '$experimentId',
+                'remainingBatches': {'$sum': {'$cond': ['$protectedKeysVoided', 0, 1]}}
+            }}
+        ])
 
-            for hook in notification_hooks:
-                auth = hook.get('auth')
+        for counter in cursor:
+            remaining_batches_per_experiment[counter['_id']] = counter['remainingBatches']
 
-                if auth is not None:
-                    auth = (auth['username'], auth['password'])
+        updates = []
+        for experiment_id, remaining_batches in remaining_batches_per_experiment.items():
+            updates.append(UpdateOne(
+                {'_id': ObjectId(experiment_id), 'remainingBatches': {'$ne': remaining_batches}},
+                {'$set': {'remainingBatches': remaining_batches}, '$inc': {'version': 1}}
+            ))
 
-                try:
-                    r = requests.post(hook['url'], auth=auth, json=payload)
-                    r.raise_for_status()
-                except Exception as e:
-                    debug_info = 'Notification post hook failed:{0}{1}{0}{2}'.format(os.linesep, repr(e), e)
-                    print(debug_info, file=sys.stderr)
+            if remaining_batches <= 0:
+                self._experiments_to_void.add(experiment_id)
+
+        if updates:
+            self._mongo.db['experiments'].bulk_write(updates, ordered=False)
 
     def _voiding_loop(self):
         while True:
             self._voiding_event.wait()
             self._voiding_event.clear()
 
+            # counters of experiments registered by older versions after the startup rebuild
+            self._rebuild_voiding_counters(missing_only=True)
+
             # batches
             cursor = self._mongo.db['batches'].find(
                 {
                     'state': {'$in': ['succeeded', 'failed', 'cancelled']},
                     'protectedKeysVoided': False
-                }
+                },
+                {'experimentId': 1, 'secretsNamespace': 1, 'inputs': 1, 'outputs': 1}
             )
 
             for batch in cursor:
-                bson_id = batch['_id']
+                self._void_batch(batch)
 
-                batch_secret_keys = get_batch_secret_keys(batch)
-                self._trustee_client.delete(batch_secret_keys)
+            # experiments
+            experiment_ids = self._experiments_to_void
+            self._experiments_to_void = set()
 
-                self._mongo.db['batches'].update_one({'_id': bson_id}, {'$set': {'protectedKeysVoided': True}})
+            for experiment_id in experiment_ids:
+                self._void_experiment(experiment_id)
 
-            # experiments
-            cursor = self._mongo.db['experiments'].find(
-                {
-                    'protectedKeysVoided': False
-                }
-            )
+    def _void_batch(self, batch):
+        """
+        Voids the protected keys of the given finished batch and decrements the remainingBatches counter of its
+        experiment. If the counter reaches zero, the experiment is queued for voiding.
 
-            for experiment in cursor:
-                bson_id = experiment['_id']
-                experiment_id = str(bson_id)
+        :param batch: The finished batch
+        :type batch: dict
+        """
+        bson_id = batch['_id']
+        experiment_id = batch['experimentId']
 
-                all_count = self._mongo.db['batches'].count({'experimentId': experiment_id})
+        # batches with secrets namespace are voided together with their experiment
+        if batch.get('secretsNamespace') is None:
+            batch_secret_keys = get_batch_secret_keys(batch)
+            self._trustee_client.delete(batch_secret_keys)
 
-                finished_count = self._mongo.db['batches'].count({
-                    'experimentId': experiment_id,
-                    'state': {'$in': ['succeeded', 'failed', 'cancelled']}
-                })
+        update_result = self._mongo.db['batches'].update_one(
+            {'_id': bson_id, 'protectedKeysVoided': False},
+            {'$set': {'protectedKeysVoided': True}, '$unset': {'blueBatch': ''}, '$inc': {'version': 1}}
+        )
 
-                if all_count == finished_count:
-                    experiment_secret_keys = get_experiment_secret_keys(experiment)
-                    self._trustee_client.delete(experiment_secret_keys)
+        if update_result.modified_count != 1:
+            return
 
-                    self._mongo.db['experiments'].update_one({'_id': bson_id}, {'$set': {'protectedKeysVoided': True}})
+        experiment = self._mongo.db['experiments'].find_one_and_update(
+            {'_id': ObjectId(experiment_id), 'protectedKeysVoided': False, 'remainingBatches': {'$exists': True}},
+            {'$inc': {'remainingBatches': -1, 'version': 1}},
+            projection={'remainingBatches': 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+        if experiment is not None and experiment['remainingBatches'] <= 0:
+            self._experiments_to_void.add(experiment_id)
+
+    def _void_experiment(self, experiment_id):
+        """
+        Voids the protected keys of the given experiment. If the experiment has a secrets namespace, the secrets of the
+        experiment and of all its batches are deleted at once.
+
+        :param experiment_id: The id of the experiment, whose batches are all voided
+        :type experiment_id: str
+        """
+        bson_id = ObjectId(experiment_id)
+
+        experiment = self._mongo.db['experiments'].find_one(
+            {'_id': bson_id, 'protectedKeysVoided': False},
+            {'secretsNamespace': 1, 'container.settings.image': 1}
+        )
+
+        if experiment is None:
+            return
+
+        secrets_namespace = experiment.get('secretsNamespace')
+
+        if secrets_namespace is None:
+            experiment_secret_keys = get_experiment_secret_keys(experiment)
+            self._trustee_client.delete(experiment_secret_keys)
+        else:
+            self._trustee_client.delete_namespace(secrets_namespace)
+
+        self._mongo.db['experiments'].update_one(
+            {'_id': bson_id},
+            {'$set': {'protectedKeysVoided': True}, '$inc': {'version': 1}}
+        )
 
     def _scheduling_loop(self):
         while True:
-            self._scheduling_event.wait(timeout=_CRON_INTERVAL)
+            self._scheduling_event.wait(timeout=self._cron_interval)
             self._scheduling_event.clear()
 
             # void protected keys
@@ -186,6 +312,63 @@ class Scheduler:
             self._schedule_batches()
             self._client_proxies_check_for_batches()
 
+            if self._image_prefetch:
+                self._prefetch_images()
+
+    def _prefetch_images(self):
+        """
+        Triggers client proxies to pull the images of the experiments at the head of the queue, so that the pull is not
+        on the critical path once their batches are scheduled. For every experiment the image is prefetched on the
+        configured number of nodes, which are possibly sufficient for the experiment, but do not have the image yet.
+        Nodes with much free ram are preferred, because they are likely to receive the next batches. The prefetch of an
+        experiment is only requested once, while it stays at the head of the queue.
+        """
+        num_experiments = self._image_prefetch.get('experiments', 1)
+        num_nodes = self._image_prefetch.get('nodes', 1)
+
+        cursor = self._mongo.db['batches'].aggregate([
+            {'$match': {'state': 'registered'}},
+            {'$group': {'_id': '$experimentId', 'registrationTime': {'$min': '$registrationTime'}}},
+            {'$sort': {'registrationTime': 1}},
+            {'$limit': num_experiments}
+        ])
+        head_experiment_ids = [entry['_id'] for entry in cursor]
+
+        # experiments, that left the head of the queue, are forgotten
+        self._prefetched_experiments.intersection_update(head_experiment_ids)
+
+        experiment_ids = [
+            experiment_id for experiment_id in head_experiment_ids
+            if experiment_id not in self._prefetched_experiments
+        ]
+
+        if not experiment_ids:
+            return
+
+        self._prefetched_experiments.update(experiment_ids)
+
+        cluster_nodes = [node for node in self._get_cluster_state() if node.online]
+
+        for experiment_id in experiment_ids:
+            try:
+                experiment = self._get_experiment_of_batch(experiment_id)
+                image_url, auth = ClientProxy._get_image_authentication(experiment)
+            except Exception as e:
+                debug_info = 'Could not prefetch image of experiment "{}":{}{}'.format(experiment_id, os.linesep, e)
+                print(debug_info, file=sys.stderr)
+                continue
+
+            normalized_image_url = normalize_image_url(image_url)
+
+            candidates = [
+                node for node in cluster_nodes
+                if normalized_image_url not in node.images and Scheduler._node_possibly_sufficient(node, experiment)
+            ]
+            candidates.sort(key=lambda n: n.ram_available, reverse=True)
+
+            for node in candidates[:num_nodes]:
+                self._nodes[node.node_name].do_prefetch_image(image_url, auth)
+
     def _client_proxies_check_exited_containers(self):
         """
         Triggers every client proxy to check for exited containers and cancelled batches.
@@ -248,6 +431,7 @@ class Scheduler:
 
         return [gpu for gpu in present_gpus if gpu.device_id not in busy_gpu_ids]
 
+    @_CLUSTER_STATE_SECONDS.time()
     def _get_cluster_state(self):
         """
         :return: a list of complete nodes, which are currently present in the cluster.
@@ -255,7 +439,7 @@ class Scheduler:
         """
         cursor = self._mongo.db['nodes'].find(
             {},
-            {'state': 1, 'ram': 1, 'nodeName': 1}
+            {'state': 1, 'ram': 1, 'cpus': 1, 'nodeName': 1, 'images': 1}
         )
 
         nodes = list(cursor)
@@ -272,7 +456,7 @@ class Scheduler:
 
         cursor = self._mongo.db['experiments'].find(
             {'_id': {'$in': experiment_ids}},
-            {'container.settings.ram': 1}
+            {'container.settings.ram': 1, 'container.settings.cpus': 1}
         )
         experiments = {str(e['_id']): e for e in cursor}
 
@@ -289,6 +473,11 @@ class Scheduler:
                 for b in node_batches
             ])
 
+            used_cpus = sum([
+                experiments[b['experimentId']]['container']['settings'].get('cpus', 0)
+                for b in node_batches
+            ])
+
             available_gpus = self._get_available_gpus(node, batches)
 
             online = node['state'] == 'online'
@@ -297,18 +486,28 @@ class Scheduler:
             if node['ram'] is not None:
                 ram_available = node['ram'] - used_ram
 
+            cpus_available = None
+            if node['cpus'] is not None:
+                cpus_available = node['cpus'] - used_cpus
+
             complete_node = CompleteNode(
                 node_name=node_name,
                 online=online,
                 ram=node['ram'],
+                cpus=node['cpus'],
                 gpus=self._get_present_gpus(node['nodeName']),
                 ram_available=ram_available,
+                cpus_available=cpus_available,
                 gpus_available=available_gpus,
                 num_batches_running=num_batches,
+                max_running_batches=self._nodes[node_name].get_max_running_batches(),
+                images={url for image in node.get('images', {}).values() for url in image['urls']}
             )
 
             complete_nodes.append(complete_node)
 
+            _NODE_RUNNING_BATCHES.set(num_batches, node=node_name)
+
         return complete_nodes
 
     @staticmethod
@@ -325,9 +524,16 @@ class Scheduler:
         if not node.online:
             return False
 
+        if node.max_running_batches is not None and node.num_batches_running >= node.max_running_batches:
+            return False
+
         if node.ram_available < experiment['container']['settings']['ram']:
             return False
 
+        cpus = experiment['container']['settings'].get('cpus')
+        if cpus is not None and node.cpus_available is not None and node.cpus_available < cpus:
+            return False
+
         # check gpus
         gpu_requirements = get_gpu_requirements(experiment['container']['settings'].get('gpus'))
 
@@ -356,6 +562,10 @@ class Scheduler:
         if node.ram < experiment['container']['settings']['ram']:
             return False
 
+        cpus = experiment['container']['settings'].get('cpus')
+        if cpus is not None and node.cpus is not None and node.cpus < cpus:
+            return False
+
         gpu_requirements = get_gpu_requirements(experiment['container']['settings'].get('gpus'))
 
         try:
@@ -378,10 +588,10 @@ class Scheduler:
                 return True
         return False
 
-    @staticmethod
-    def _get_best_node(nodes, experiment):
+    def _get_best_node(self, nodes, experiment):
         """
-        Returns the node, that fits best for the given experiment. If no node could be found returns None
+        Returns the node, that fits best for the given experiment. If no node could be found returns None.
+        The node is selected by the placement strategy configured for this agency.
 
         :param nodes: The nodes, that are available for this experiment.
         :type nodes: List[CompleteNode]
@@ -394,31 +604,9 @@ class Scheduler:
         if not sufficient_nodes:
             return None
 
-        # prefer nodes without GPUs
-        nodes_without_gpus = [node for node in sufficient_nodes if (not node.gpus)]
-        if nodes_without_gpus:
-            sufficient_nodes = nodes_without_gpus
-
-        # prefer nodes with few jobs
-        min_num_batches = None
-        nodes_with_few_batches = []
-        for node in sufficient_nodes:
-            if min_num_batches is None:
-                min_num_batches = node.num_batches_running
-                nodes_with_few_batches.append(node)
-                continue
-
-            if node.num_batches_running < min_num_batches:
-                min_num_batches = node.num_batches_running
-                nodes_with_few_batches = [node]
-            elif node.num_batches_running == min_num_batches:
-                nodes_with_few_batches.append(node)
-
-        # prefer nodes with less free ram
-        nodes_with_few_batches.sort(reverse=False, key=lambda n: n.ram_available)
-
-        return nodes_with_few_batches[0]
+        return self._placement_strategy.select_node(sufficient_nodes, experiment)
 
+    @_SCHEDULE_BATCHES_SECONDS.time()
     def _schedule_batches(self):
         """
         state before _schedule_batches:
@@ -428,23 +616,28 @@ class Scheduler:
         state after _schedule_batches:
         ClientProxies for which a batch is scheduled have a 'check_for_batches' action in their queue.
         Batches that are scheduled have state "scheduled" now and the node property of these batches is filled.
+
+        Consecutive batches of the same experiment are placed together as one chunk. The cluster state is only queried
+        once per scheduling pass and afterwards updated in memory for every placed batch.
         """
-        # list of tuple(batch_id, node_name) with node_names to which the batches were scheduled
-        scheduled_nodes = []
+        # names of nodes to which batches were scheduled
+        scheduled_node_names = set()
         cluster_nodes = self._get_cluster_state()
 
         batch_count_cache = {}  # type: Dict[str, int]
+        experiment_cache = {}  # type: Dict[str, dict]
+        num_registered_batches = 0
 
-        # select batch to be scheduled
-        for next_batch in self._fifo():
-            node_name = self._schedule_batch(next_batch, cluster_nodes, batch_count_cache)
+        # select batches to be scheduled
+        for batch_chunk in self._fifo_chunks():
+            num_registered_batches += len(batch_chunk)
+            node_names = self._schedule_batch_chunk(batch_chunk, cluster_nodes, batch_count_cache, experiment_cache)
+            scheduled_node_names.update(node_names)
 
-            if node_name is not None:
-                cluster_nodes = self._get_cluster_state()
-                scheduled_nodes.append((next_batch['_id'], node_name))
+        _REGISTERED_BATCHES.set(num_registered_batches)
 
         # inform ClientProxies about new batches
-        for batch_id, node_name in scheduled_nodes:
+        for node_name in scheduled_node_names:
             client_proxy = self._nodes[node_name]
 
             client_proxy.do_check_for_batches()
@@ -478,41 +671,64 @@ class Scheduler:
             batch_count_cache[experiment_id] = batch_count
         return batch_count
 
-    def _schedule_batch(self, next_batch, nodes, batch_count_cache):
+    def _schedule_batch_chunk(self, batch_chunk, nodes, batch_count_cache, experiment_cache):
         """
-        Tries to find a node that is capable of processing the given batch. If no capable node could be found, None is
-        returned.
-        If a node was found, that is capable of processing the given batch, this node is written to the node property of
-        the batch. The batches state is then updated to 'scheduled'.
-
-        :param next_batch: The batch to schedule.
-        :param nodes: The nodes on which the batch should be scheduled.
+        Tries to find nodes that are capable of processing the given batches, which all belong to the same experiment.
+        For every batch a node is selected and the resources of this node are reserved in the given nodes. The batches
+        for which a node was found are updated to state 'scheduled' with a single bulk write. Placement stops as soon
+        as no node is sufficient anymore, because all following batches have the same requirements.
+
+        :param batch_chunk: The batches to schedule. All batches have to belong to the same experiment.
+        :type batch_chunk: List[dict]
+        :param nodes: The nodes on which the batches should be scheduled.
         :type nodes: List[CompleteNode]
         :param batch_count_cache: A dictionary mapping experiment ids to the number of batches of this experiment, which
                                   in state processing or scheduled. This dictionary is allowed to overestimate the
                                   number of batches.
         :type batch_count_cache: Dict[str, int]
-        :return: The name of the node on which the given batch is scheduled
-        If the batch could not be scheduled None is returned
-        :raise TrusteeServiceError: If the trustee service is unavailable.
+        :param experiment_cache: A dictionary mapping experiment ids to experiments with filled secrets, that is used to
+                                 fetch every experiment only once per scheduling pass.
+        :type experiment_cache: Dict[str, dict]
+        :return: The names of the nodes on which batches were scheduled
+        :rtype: List[str]
         """
-        batch_id = str(next_batch['_id'])
-        experiment_id = next_batch['experimentId']
+        experiment_id = batch_chunk[0]['experimentId']
+
+        experiment = experiment_cache.get(experiment_id)
+        if experiment is None:
+            try:
+                experiment = self._get_experiment_of_batch(experiment_id)
+            except Exception as e:
+                for batch in batch_chunk:
+                    batch_failure(
+                        self._mongo,
+                        str(batch['_id']),
+                        repr(e),
+                        None,
+                        batch['state'],
+                        disable_retry_if_failed=True
+                    )
+                return []
+            experiment_cache[experiment_id] = experiment
 
-        try:
-            experiment = self._get_experiment_of_batch(experiment_id)
-        except Exception as e:
-            batch_failure(
-                self._mongo,
-                batch_id,
-                repr(e),
-                None,
-                next_batch['state'],
-                disable_retry_if_failed=True
-            )
-            return None
+        # check impossible experiments
+        if not Scheduler._check_nodes_possibly_sufficient(nodes, experiment):
+            debug_info = 'There are no nodes configured that are possibly sufficient for experiment "{}"' \
+                .format(experiment_id)
+            for batch in batch_chunk:
+                batch_failure(
+                    self._mongo,
+                    str(batch['_id']),
+                    debug_info,
+                    None,
+                    batch['state'],
+                    disable_retry_if_failed=True
+                )
+            return []
 
         ram = experiment['container']['settings']['ram']
+        cpus = experiment['container']['settings'].get('cpus')
+        gpu_requirements = get_gpu_requirements(experiment['container']['settings'].get('gpus'))
 
         # limit the number of currently executed batches from a single experiment
         concurrency_limit = experiment.get('execution', {}).get('settings', {}).get('batchConcurrencyLimit', 64)
@@ -520,98 +736,98 @@ class Scheduler:
         # number of batches which are scheduled or processing of the given experiment
         batch_count = self._get_number_of_batches_of_experiment(experiment_id, batch_count_cache)
 
-        if batch_count >= concurrency_limit:
-            return None
-
-        # check impossible experiments
-        if not Scheduler._check_nodes_possibly_sufficient(nodes, experiment):
-            debug_info = 'There are no nodes configured that are possibly sufficient for experiment "{}"' \
-                .format(next_batch['experimentId'])
-            batch_failure(
-                self._mongo,
-                batch_id,
-                debug_info,
-                None,
-                next_batch['state'],
-                disable_retry_if_failed=True
-            )
-            return None
-
-        # select node
-        selected_node = Scheduler._get_best_node(nodes, experiment)
-
-        if selected_node is None:
-            return None
+        allow_insecure_capabilities = self._conf.d['controller']['docker'].get('allow_insecure_capabilities', False)
 
-        # calculate ram / gpus
-        selected_node.ram_available -= ram
+        update_operations = []
+        node_names = []
+        timestamp = time()
+
+        for batch in batch_chunk:
+            if batch_count + len(update_operations) >= concurrency_limit:
+                break
+
+            # check mounting
+            mount_connectors = red_get_mount_connectors_from_inputs(batch['inputs'])
+            is_mounting = bool(mount_connectors)
+
+            if not allow_insecure_capabilities and is_mounting:
+                # set state to failed, because insecure_capabilities are not allowed but needed, by this batch.
+                debug_info = 'FUSE support for this agency is disabled, but the following input/output-keys are ' \
+                             'configured to mount inside a docker container.{}{}'.format(os.linesep, mount_connectors)
+                batch_failure(
+                    self._mongo,
+                    str(batch['_id']),
+                    debug_info,
+                    None,
+                    batch['state'],
+                    disable_retry_if_failed=True
+                )
+                continue
 
-        used_gpu_ids = None
-        if selected_node.gpus_available:
-            gpu_requirements = get_gpu_requirements(experiment['container']['settings'].get('gpus'))
-            available_gpus = selected_node.gpus_available
-            used_gpus = match_gpus(available_gpus, requirements=gpu_requirements)
+            # select node
+            selected_node = self._get_best_node(nodes, experiment)
 
-            used_gpu_ids = []
-            for gpu in used_gpus:
-                used_gpu_ids.append(gpu.device_id)
-                available_gpus.remove(gpu)
+            if selected_node is None:
+                break
 
-        # check mounting
-        mount_connectors = red_get_mount_connectors_from_inputs(next_batch['inputs'])
-        is_mounting = bool(mount_connectors)
+            # calculate ram / cpus / gpus
+            selected_node.ram_available -= ram
+            if cpus is not None and selected_node.cpus_available is not None:
+                selected_node.cpus_available -= cpus
+            selected_node.num_batches_running += 1
 
-        allow_insecure_capabilities = self._conf.d['controller']['docker'].get('allow_insecure_capabilities', False)
+            used_gpu_ids = None
+            if selected_node.gpus_available:
+                available_gpus = selected_node.gpus_available
+                used_gpus = match_gpus(available_gpus, requirements=gpu_requirements)
 
-        if not allow_insecure_capabilities and is_mounting:
-            # set state to failed, because insecure_capabilities are not allowed but needed, by this batch.
-            debug_info = 'FUSE support for this agency is disabled, but the following input/output-keys are ' \
-                         'configured to mount inside a docker container.{}{}'.format(os.linesep, mount_connectors)
-            batch_failure(
-                self._mongo,
-                batch_id,
-                debug_info,
-                None,
-                next_batch['state'],
-                disable_retry_if_failed=True
-            )
-            return None
+                used_gpu_ids = []
+                for gpu in used_gpus:
+                    used_gpu_ids.append(gpu.device_id)
+                    available_gpus.remove(gpu)
 
-        # update batch data
-        update_result = self._mongo.db['batches'].update_one(
-            {'_id': next_batch['_id'], 'state': next_batch['state']},
-            {
-                '$set': {
-                    'state': 'scheduled',
-                    'node': selected_node.node_name,
-                    'usedGPUs': used_gpu_ids,
-                    'mount': is_mounting
-                },
-                '$push': {
-                    'history': {
+            update_operations.append(UpdateOne(
+                {'_id': batch['_id'], 'state': batch['state']},
+                {
+                    '$set': {
                         'state': 'scheduled',
-                        'time': time(),
-                        'debugInfo': None,
                         'node': selected_node.node_name,
-                        'ccagent': None,
-                        'dockerStats': None
+                        'usedGPUs': used_gpu_ids,
+                        'mount': is_mounting
+                    },
+                    '$push': {
+                        'history': {
+                            'state': 'scheduled',
+                            'time': timestamp,
+                            'debugInfo': None,
+                            'node': selected_node.node_name,
+                            'ccagent': None,
+                            'dockerStats': None
+                        },
+                        # the scheduling span covers the time a batch waited in state registered until it was placed
+                        'trace': trace_span(SPAN_SCHEDULING, batch['registeredTime'], timestamp)
+                    },
+                    '$inc': {
+                        'attempts': 1,
+                        'version': 1
                     }
-                },
-                '$inc': {
-                    'attempts': 1
                 }
-            }
-        )
+            ))
+            node_names.append(selected_node.node_name)
 
-        if update_result.modified_count == 1:
-            # The state of the scheduled batch switched from 'registered' to 'scheduled', so increase the batch_count.
-            # batch_count_cache always contains experiment_id, because _get_number_of_batches_of_experiment()
-            # always inserts the given experiment_id
-            batch_count_cache[experiment_id] += 1
+        if not update_operations:
+            return []
 
-            return selected_node.node_name
-        else:
-            return None
+        # update batch data
+        bulk_result = self._mongo.db['batches'].bulk_write(update_operations, ordered=False)
+
+        # Batches which switched from 'registered' to 'scheduled' increase the batch_count. batch_count_cache always
+        # contains experiment_id, because _get_number_of_batches_of_experiment() always inserts the given experiment_id.
+        # Batches that were not modified (e.g. cancelled in the meantime) keep their resources reserved until the next
+        # scheduling pass, which overestimates the cluster usage.
+        batch_count_cache[experiment_id] += bulk_result.modified_count
+
+        return node_names
 
     def _get_experiment_of_batch(self, experiment_id):
         """
@@ -630,10 +846,33 @@ class Scheduler:
         return experiment
 
     def _fifo(self):
+        # registeredTime is the time of the last history entry, which is the last transition to state registered
         cursor = self._mongo.db['batches'].aggregate([
             {'$match': {'state': 'registered'}},
             {'$sort': {'registrationTime': 1}},
-            {'$project': {'experimentId': 1, 'inputs': 1, 'outputs': 1, 'state': 1}}
+            {'$project': {
+                'experimentId': 1,
+                'inputs': 1,
+                'outputs': 1,
+                'state': 1,
+                'registeredTime': {'$arrayElemAt': ['$history.time', -1]}
+            }}
         ])
         for b in cursor:
             yield b
+
+    def _fifo_chunks(self):
+        """
+        Groups the batches given by _fifo() into chunks of consecutive batches, that belong to the same experiment.
+
+        :return: A generator yielding lists of batches
+        """
+        chunk = []
+        for b in self._fifo():
+            if chunk and (chunk[0]['experimentId'] != b['experimentId'] or len(chunk) >= _SCHEDULING_CHUNK_SIZE):
+                yield chunk
+                chunk = []
+            chunk.append(b)
+
+        if chunk:
+            yield chunk
@@ -0,0 +1,4 @@
+from cc_agency.tools.benchmark_pool.main import main
+
+if __name__ == '__main__':
+    main()
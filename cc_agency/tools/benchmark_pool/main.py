@@ -0,0 +1,144 @@
+import io
+import json
+import tarfile
+from argparse import ArgumentParser
+from time import time
+
+import docker
+
+from cc_agency.controller.pool import POOL_CONTAINER_COMMAND, pool_container_name
+
+DESCRIPTION = 'Benchmark the batch throughput of fresh containers against pooled containers (reuseContainers).'
+
+DEFAULT_BASE_URL = 'unix://var/run/docker.sock'
+DEFAULT_IMAGE = 'docker.io/busybox:latest'
+DEFAULT_NUM_BATCHES = 100
+BENCHMARK_WORK_DIR = '/tmp/ccpool-benchmark'
+
+
+def attach_args(parser):
+    parser.add_argument(
+        '--base-url', action='store', type=str, metavar='BASE_URL', default=DEFAULT_BASE_URL,
+        help='Docker engine BASE_URL, default is "{}".'.format(DEFAULT_BASE_URL)
+    )
+    parser.add_argument(
+        '--image', action='store', type=str, metavar='IMAGE', default=DEFAULT_IMAGE,
+        help='Run the batches in IMAGE, default is "{}".'.format(DEFAULT_IMAGE)
+    )
+    parser.add_argument(
+        '-n', '--num-batches', action='store', type=int, metavar='NUM_BATCHES', default=DEFAULT_NUM_BATCHES,
+        help='Run NUM_BATCHES batches per mode, default is {}.'.format(DEFAULT_NUM_BATCHES)
+    )
+
+
+def main():
+    parser = ArgumentParser(description=DESCRIPTION)
+    attach_args(parser)
+    args = parser.parse_args()
+
+    return run(**args.__dict__)
+
+
+def _batch_archive(batch_index):
+    """
+    Creates a tar archive containing the working directory of a batch with a small file, like the blue file of a batch.
+    """
+    data = json.dumps({'batch': batch_index}).encode('utf-8')
+
+    base_dir = BENCHMARK_WORK_DIR.lstrip('/')
+    work_dir = '{}/{}'.format(base_dir, batch_index)
+
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode='w') as tar:
+        # the directories are owned by the batch user, so the batch user can remove its working directory
+        for directory in [base_dir, work_dir]:
+            info = tarfile.TarInfo(directory)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.uid = 1000
+            info.gid = 1000
+            tar.addfile(info)
+
+        info = tarfile.TarInfo('{}/blue.json'.format(work_dir))
+        info.size = len(data)
+        info.uid = 1000
+        info.gid = 1000
+        tar.addfile(info, io.BytesIO(data))
+    f.seek(0)
+    return f
+
+
+def _result(mode, durations):
+    total = sum(durations)
+    return {
+        'mode': mode,
+        'batches': len(durations),
+        'totalSeconds': total,
+        'meanSecondsPerBatch': total / len(durations),
+        'maxSecondsPerBatch': max(durations),
+        'batchesPerSecond': len(durations) / total if total > 0 else None
+    }
+
+
+def _benchmark_fresh_containers(client, image, num_batches):
+    """
+    Runs every batch in a new container, which is created, started, waited for and removed, as the controller does for
+    batches without reuseContainers.
+    """
+    durations = []
+    for _ in range(num_batches):
+        start = time()
+        client.containers.run(image, ['cat', '/proc/self/status'], user='1000:1000', remove=True)
+        durations.append(time() - start)
+    return durations
+
+
+def _benchmark_pooled_container(client, image, num_batches):
+    """
+    Runs every batch via exec in one pooled container. Like the controller, every batch gets its own working directory
+    via put_archive, which is removed after the batch. Checks, that no working directory of a previous batch is visible
+    to the following batch.
+
+    :return: A tuple (durations, isolation_violations)
+    """
+    container = client.containers.run(
+        image, POOL_CONTAINER_COMMAND, name=pool_container_name('benchmark'), user='1000:1000', detach=True
+    )
+
+    durations = []
+    isolation_violations = 0
+    try:
+        for batch_index in range(num_batches):
+            work_dir = '{}/{}'.format(BENCHMARK_WORK_DIR, batch_index)
+
+            start = time()
+            container.put_archive('/', _batch_archive(batch_index))
+            container.exec_run(['cat', '/proc/self/status'], user='1000:1000', workdir=work_dir)
+            container.exec_run(['rm', '-rf', work_dir], user='1000:1000')
+            durations.append(time() - start)
+
+            # the working directories of previous batches must not be visible anymore
+            exit_code, output = container.exec_run(['ls', '-A', BENCHMARK_WORK_DIR], user='1000:1000')
+            if exit_code == 0 and output.strip():
+                isolation_violations += 1
+    finally:
+        container.remove(force=True)
+
+    return durations, isolation_violations
+
+
+def run(base_url, image, num_batches):
+    client = docker.DockerClient(base_url=base_url, version='auto')
+    client.images.pull(image)
+
+    fresh = _result('fresh', _benchmark_fresh_containers(client, image, num_batches))
+
+    durations, isolation_violations = _benchmark_pooled_container(client, image, num_batches)
+    pooled = _result('pooled', durations)
+    pooled['isolationViolations'] = isolation_violations
+
+    print(json.dumps({
+        'image': image,
+        'results': [fresh, pooled],
+        'speedup': fresh['totalSeconds'] / pooled['totalSeconds'] if pooled['totalSeconds'] > 0 else None
+    }, indent=4))
@@ -13,7 +13,10 @@ def attach_args(parser):
     )
     parser.add_argument(
         action='store', type=str, nargs='+', metavar='COLLECTIONS', dest='collections',
-        choices=['experiments', 'batches', 'users', 'tokens', 'block_entries', 'callback_tokens'],
+        choices=[
+            'experiments', 'batches', 'users', 'tokens', 'block_entries', 'callback_tokens', 'notifications',
+            'notificationCursors', 'resumeTokens'
+        ],
         help='Collections to be dropped.'
     )
 
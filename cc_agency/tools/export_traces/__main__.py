@@ -0,0 +1,4 @@
+from cc_agency.tools.export_traces.main import main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import json
+import sys
+from argparse import ArgumentParser
+
+from cc_agency.commons.conf import Conf
+from cc_agency.commons.db import Mongo
+from cc_agency.commons.tracing import batch_timeline, TIMELINE_BATCH_PROJECTION
+
+DESCRIPTION = 'Export batch timelines as json lines for offline analysis.'
+
+EXPORT_CHUNK_SIZE = 1000
+
+
+def attach_args(parser):
+    parser.add_argument(
+        '-c', '--conf-file', action='store', type=str, metavar='CONF_FILE',
+        help='CONF_FILE (yaml) as local path.'
+    )
+    parser.add_argument(
+        '-o', '--output-file', action='store', type=str, metavar='OUTPUT_FILE',
+        help='Write timelines to OUTPUT_FILE instead of stdout.'
+    )
+    parser.add_argument(
+        '--experiment-id', action='store', type=str, metavar='EXPERIMENT_ID',
+        help='Only export batches of the experiment EXPERIMENT_ID.'
+    )
+    parser.add_argument(
+        '--since', action='store', type=float, metavar='TIMESTAMP',
+        help='Only export batches registered at or after the unix timestamp TIMESTAMP.'
+    )
+
+
+def main():
+    parser = ArgumentParser(description=DESCRIPTION)
+    attach_args(parser)
+    args = parser.parse_args()
+
+    return run(**args.__dict__)
+
+
+def _write_timelines(mongo, batches, f):
+    batch_ids = [str(batch['_id']) for batch in batches]
+    notifications = {
+        notification['batchId']: notification
+        for notification in mongo.db['notifications'].find(
+            {'batchId': {'$in': batch_ids}},
+            {'batchId': 1, 'deliveredTime': 1}
+        )
+    }
+
+    for batch_id, batch in zip(batch_ids, batches):
+        print(json.dumps(batch_timeline(batch, notifications.get(batch_id))), file=f)
+
+
+def run(conf_file, output_file, experiment_id, since):
+    conf = Conf(conf_file)
+    mongo = Mongo(conf)
+
+    query = {}
+    if experiment_id:
+        query['experimentId'] = experiment_id
+    if since is not None:
+        query['registrationTime'] = {'$gte': since}
+
+    cursor = mongo.db['batches'].find(query, TIMELINE_BATCH_PROJECTION).sort('_id', 1)
+
+    f = sys.stdout if output_file is None else open(output_file, 'w')
+    try:
+        batches = []
+        for batch in cursor:
+            batches.append(batch)
+            if len(batches) >= EXPORT_CHUNK_SIZE:
+                _write_timelines(mongo, batches, f)
+                batches = []
+
+        if batches:
+            _write_timelines(mongo, batches, f)
+    finally:
+        if f is not sys.stdout:
+            f.close()
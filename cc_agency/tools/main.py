@@ -7,10 +7,14 @@ from cc_agency.version import VERSION
 from cc_agency.tools.create_db_user.main import main as create_db_user_main
 from cc_agency.tools.create_broker_user.main import main as create_broker_user_main
 from cc_agency.tools.drop_db_collections.main import main as drop_db_collections_main
+from cc_agency.tools.export_traces.main import main as export_traces_main
+from cc_agency.tools.benchmark_pool.main import main as benchmark_pool_main
 
 from cc_agency.tools.create_db_user.main import DESCRIPTION as CREATE_DB_USER_DESCRIPTION
 from cc_agency.tools.create_broker_user.main import DESCRIPTION as CREATE_BROKER_USER_DESCRIPTION
 from cc_agency.tools.drop_db_collections.main import DESCRIPTION as DROP_DB_COLLECTIONS_DESCRIPTION
+from cc_agency.tools.export_traces.main import DESCRIPTION as EXPORT_TRACES_DESCRIPTION
+from cc_agency.tools.benchmark_pool.main import DESCRIPTION as BENCHMARK_POOL_DESCRIPTION
 
 
 SCRIPT_NAME = 'ccagency'
@@ -21,7 +25,9 @@ DESCRIPTION = 'CC-Agency Copyright (C) 2018  Christoph Jansen. This software is
 MODES = OrderedDict([
     ('create-db-user', {'main': create_db_user_main, 'description': CREATE_DB_USER_DESCRIPTION}),
     ('create-broker-user', {'main': create_broker_user_main, 'description': CREATE_BROKER_USER_DESCRIPTION}),
-    ('drop-db-collections', {'main': drop_db_collections_main, 'description': DROP_DB_COLLECTIONS_DESCRIPTION})
+    ('drop-db-collections', {'main': drop_db_collections_main, 'description': DROP_DB_COLLECTIONS_DESCRIPTION}),
+    ('export-traces', {'main': export_traces_main, 'description': EXPORT_TRACES_DESCRIPTION}),
+    ('benchmark-pool', {'main': benchmark_pool_main, 'description': BENCHMARK_POOL_DESCRIPTION})
 ])
 
 
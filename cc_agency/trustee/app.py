@@ -5,6 +5,7 @@ from flask import Flask, jsonify, request
 from werkzeug.exceptions import Unauthorized
 
 from cc_agency.commons.conf import Conf
+from cc_agency.trustee.store import create_secret_store, DEFAULT_NAMESPACE
 
 DESCRIPTION = 'CC-Agency Trustee.'
 
@@ -23,8 +24,7 @@ conf = Conf(args.conf_file)
 username = conf.d['trustee']['username']
 password = conf.d['trustee']['password']
 
-
-secrets = {}
+secret_store = create_secret_store(conf.d['trustee'])
 
 
 def _verify_user(auth):
@@ -52,12 +52,9 @@ def post_secrets():
     _verify_user(request.authorization)
 
     data = request.json
+    namespace = request.args.get('namespace', default=DEFAULT_NAMESPACE, type=str)
 
-    existing_keys = []
-
-    for key in data:
-        if key in secrets:
-            existing_keys.append(key)
+    existing_keys = secret_store.put(data, namespace)
 
     if existing_keys:
         return jsonify({
@@ -67,8 +64,6 @@ def post_secrets():
             'inspect': False
         })
 
-    secrets.update(data)
-
     return jsonify({
         'state': 'success'
     })
@@ -79,15 +74,9 @@ def get_secrets():
     _verify_user(request.authorization)
 
     data = request.json
+    namespace = request.args.get('namespace', default=DEFAULT_NAMESPACE, type=str)
 
-    collected = {}
-    missing_keys = []
-
-    for key in data:
-        try:
-            collected[key] = secrets[key]
-        except KeyError:
-            missing_keys.append(key)
+    collected, missing_keys = secret_store.get(data, namespace)
 
     if missing_keys:
         return jsonify({
@@ -108,12 +97,20 @@ def delete_secrets():
     _verify_user(request.authorization)
 
     data = request.json
+    namespace = request.args.get('namespace', default=DEFAULT_NAMESPACE, type=str)
+
+    secret_store.delete(data, namespace)
+
+    return jsonify({
+        'state': 'success'
+    })
+
+
+@app.route('/namespaces/<namespace>', methods=['DELETE'])
+def delete_namespace(namespace):
+    _verify_user(request.authorization)
 
-    for key in data:
-        try:
-            del secrets[key]
-        except KeyError:
-            pass
+    secret_store.delete_namespace(namespace)
 
     return jsonify({
         'state': 'success'
@@ -0,0 +1,270 @@
+import base64
+import json
+import os
+import sqlite3
+from threading import Lock, local
+from typing import Dict
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from cc_agency.commons.helper import create_kdf
+
+SALT_LENGTH = 16
+SQLITE_TIMEOUT = 30
+# SQLite limits the number of host parameters of a single statement to 999 in older versions
+SQLITE_MAX_PARAMETERS = 900
+
+_PASSWORD_CHECK_KEY = 'password_check'
+_PASSWORD_CHECK_VALUE = b'cc-agency-trustee'
+
+# secrets stored without namespace, e.g. by older brokers, are kept in this namespace
+DEFAULT_NAMESPACE = ''
+
+
+class SecretStore:
+    """
+    Stores the secrets of the trustee service. All operations are batched, i.e. they handle many keys at once.
+    Secrets are stored in namespaces, usually one namespace per experiment, so that all secrets of a namespace can be
+    deleted with a single operation.
+    """
+
+    def put(self, secrets, namespace=DEFAULT_NAMESPACE):
+        """
+        Stores the given secrets. If any of the given keys already exists, no secret is stored.
+
+        :param secrets: A dictionary mapping secret keys to secrets
+        :type secrets: dict
+        :param namespace: The namespace to store the secrets in
+        :type namespace: str
+        :return: A list of keys, that already exist. If this list is empty, all secrets were stored.
+        :rtype: List[str]
+        """
+        raise NotImplementedError()
+
+    def get(self, keys, namespace=DEFAULT_NAMESPACE):
+        """
+        Collects the secrets of the given keys.
+
+        :param keys: The secret keys to collect
+        :type keys: List[str]
+        :param namespace: The namespace of the given keys
+        :type namespace: str
+        :return: A tuple (collected, missing_keys). collected is a dictionary mapping the found keys to their secrets,
+                 missing_keys is a list of the keys, that could not be found.
+        :rtype: Tuple[dict, List[str]]
+        """
+        raise NotImplementedError()
+
+    def delete(self, keys, namespace=DEFAULT_NAMESPACE):
+        """
+        Deletes the secrets of the given keys. Keys, that do not exist, are ignored.
+
+        :param keys: The secret keys to delete
+        :type keys: List[str]
+        :param namespace: The namespace of the given keys
+        :type namespace: str
+        """
+        raise NotImplementedError()
+
+    def delete_namespace(self, namespace):
+        """
+        Deletes all secrets of the given namespace. Namespaces, that do not exist, are ignored.
+
+        :param namespace: The namespace to delete
+        :type namespace: str
+        """
+        raise NotImplementedError()
+
+
+class MemorySecretStore(SecretStore):
+    """
+    Keeps secrets in memory of the current process. Secrets are lost on restart and are not shared between multiple
+    trustee processes.
+    """
+
+    def __init__(self):
+        self._namespaces = {}  # type: Dict[str, dict]
+        self._lock = Lock()
+
+    def put(self, secrets, namespace=DEFAULT_NAMESPACE):
+        with self._lock:
+            namespace_secrets = self._namespaces.setdefault(namespace, {})
+            existing_keys = [key for key in secrets if key in namespace_secrets]
+            if not existing_keys:
+                namespace_secrets.update(secrets)
+        return existing_keys
+
+    def get(self, keys, namespace=DEFAULT_NAMESPACE):
+        collected = {}
+        missing_keys = []
+
+        with self._lock:
+            namespace_secrets = self._namespaces.get(namespace, {})
+            for key in keys:
+                try:
+                    collected[key] = namespace_secrets[key]
+                except KeyError:
+                    missing_keys.append(key)
+
+        return collected, missing_keys
+
+    def delete(self, keys, namespace=DEFAULT_NAMESPACE):
+        with self._lock:
+            namespace_secrets = self._namespaces.get(namespace, {})
+            for key in keys:
+                namespace_secrets.pop(key, None)
+
+    def delete_namespace(self, namespace):
+        with self._lock:
+            self._namespaces.pop(namespace, None)
+
+
+class SQLiteSecretStore(SecretStore):
+    """
+    Keeps secrets in a local SQLite database, so that secrets survive restarts and can be shared by multiple trustee
+    processes on the same host. Secrets are encrypted with Fernet. The encryption key is derived from the trustee
+    password and a random salt, which is created once and kept in the meta table of the database.
+    """
+
+    def __init__(self, path, password):
+        """
+        :param path: The path of the SQLite database file
+        :type path: str
+        :param password: The password to derive the encryption key from
+        :type password: str
+
+        :raise ValueError: If the database was created with another password
+        """
+        self._path = os.path.expanduser(path)
+        self._local = local()
+
+        # the connection used for initialization is closed, because the process might fork afterwards
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS secrets '
+                    '(namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (namespace, key))'
+                )
+                connection.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('salt', os.urandom(SALT_LENGTH)))
+
+            salt = connection.execute('SELECT value FROM meta WHERE key = ?', ('salt',)).fetchone()[0]
+            self._fernet = Fernet(base64.urlsafe_b64encode(create_kdf(salt).derive(password.encode('utf-8'))))
+
+            with connection:
+                connection.execute(
+                    'INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                    (_PASSWORD_CHECK_KEY, self._fernet.encrypt(_PASSWORD_CHECK_VALUE))
+                )
+
+            password_check = connection.execute(
+                'SELECT value FROM meta WHERE key = ?', (_PASSWORD_CHECK_KEY,)
+            ).fetchone()[0]
+        finally:
+            connection.close()
+
+        try:
+            self._fernet.decrypt(password_check)
+        except InvalidToken:
+            raise ValueError(
+                'The secret store "{}" was created with another trustee password.'.format(self._path)
+            )
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def _connection(self):
+        """
+        Returns the SQLite connection of the current thread. Connections are not shared between threads or processes.
+
+        :return: A SQLite connection in autocommit mode
+        :rtype: sqlite3.Connection
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.connection = self._connect()
+            self._local.pid = pid
+        return self._local.connection
+
+    @staticmethod
+    def _chunks(keys):
+        keys = list(keys)
+        for i in range(0, len(keys), SQLITE_MAX_PARAMETERS):
+            yield keys[i:i + SQLITE_MAX_PARAMETERS]
+
+    @staticmethod
+    def _select_keys(connection, columns, keys, namespace):
+        for chunk in SQLiteSecretStore._chunks(keys):
+            query = 'SELECT {} FROM secrets WHERE namespace = ? AND key IN ({})'.format(
+                columns, ','.join('?' * len(chunk))
+            )
+            yield from connection.execute(query, [namespace] + chunk)
+
+    def put(self, secrets, namespace=DEFAULT_NAMESPACE):
+        rows = [
+            (namespace, key, self._fernet.encrypt(json.dumps(secret).encode('utf-8')))
+            for key, secret in secrets.items()
+        ]
+
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            existing_keys = [row[0] for row in SQLiteSecretStore._select_keys(connection, 'key', secrets, namespace)]
+            if not existing_keys:
+                connection.executemany('INSERT INTO secrets VALUES (?, ?, ?)', rows)
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+        return existing_keys
+
+    def get(self, keys, namespace=DEFAULT_NAMESPACE):
+        connection = self._connection()
+
+        collected = {}
+        for key, value in SQLiteSecretStore._select_keys(connection, 'key, value', keys, namespace):
+            collected[key] = json.loads(self._fernet.decrypt(value).decode('utf-8'))
+
+        missing_keys = [key for key in keys if key not in collected]
+
+        return collected, missing_keys
+
+    def delete(self, keys, namespace=DEFAULT_NAMESPACE):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'DELETE FROM secrets WHERE namespace = ? AND key = ?', [(namespace, key) for key in keys]
+            )
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def delete_namespace(self, namespace):
+        connection = self._connection()
+        connection.execute('DELETE FROM secrets WHERE namespace = ?', (namespace,))
+
+
+def create_secret_store(trustee_conf):
+    """
+    Creates the secret store configured in the trustee section of the agency config.
+
+    :param trustee_conf: The trustee section of the agency config
+    :type trustee_conf: dict
+    :return: A new secret store. If no store is configured, a MemorySecretStore is returned.
+    :rtype: SecretStore
+    """
+    store_conf = trustee_conf.get('store', {})
+    backend = store_conf.get('backend', 'memory')
+
+    if backend == 'sqlite':
+        if 'path' not in store_conf:
+            raise ValueError('The sqlite secret store requires "path" in the trustee store config.')
+        return SQLiteSecretStore(store_conf['path'], trustee_conf['password'])
+
+    return MemorySecretStore()